@@ -1,8 +1,21 @@
+import time
+import inspect
+import functools
 import numpy as np
 import pandas as pd
 
-from get_financial_report import get_financial_report
+from get_financial_report import get_financial_report, get_ticker_indexed_dataset
+from market_data import StatementMatrix
+from metric_engine import metric, metric_scope, get_required_datasets, persist_metrics, invalidate_metrics
+from rules import run_test
 from config import display_tests, investor_threshold
+from utils.profiling import Profiler
+
+
+def load_price_factors_dataset(dataset: str, market: str='us', data_dir: str='data', variant: str='daily'):
+    # Imported here, the factor table is only read by the reports that use the price factors
+    from price_factors import get_price_factors_dataset
+    return get_price_factors_dataset(market, data_dir)
 
 
 class Firm:
@@ -29,56 +42,190 @@ class Firm:
     data_dir: str (default='data')
         A path of a directory where the data from Simfin's API will be written to once downloaded. In the next calls,
         the data will be read from this path instead of an API call
+    variant: str (default='annual')
+        'annual' to analyze the firm's annual statements, or 'ttm' to analyze trailing-twelve-month
+        statements, derived from the quarterly statements (balance sheets are those of the latest quarter).
+        In 'ttm' mode, every "year" of a metric is a period of twelve months that ends at the latest quarter
+    profile: bool (default=False)
+        If True, the call count and cumulative time of every get_*/*_test method, and the latency of the
+        report, are recorded in the firm's profiler
+    incremental: bool (default=False)
+        If True, the firm's metrics are memoized across reports, and update_share_prices only
+        invalidates the metrics that depend on the share prices
+    income, balance, cash_flow, curr_share_data: pd.DataFrame
+        The firm's statements and latest share prices. Each one is loaded the first time it is used
+    price_factors: pd.DataFrame
+        The firm's row of the factor table of price_factors.py (momentum, volatility, drawdown and
+        52-week range of its daily share prices), empty if the factors weren't computed
 
     Methods
     ---------
-    generate_firm_report()
+    generate_firm_report(tests=display_tests)
         Generates a report with financial ratios and metrics for the firm, including buy/
         sell/hold recommendations according to famous investors' benchmarks.
+    get_required_datasets(tests=display_tests)
+        Returns the statements that a report of the given tests reads, without loading anything.
+    load_market_dataset(statement, market='us', data_dir='data', variant='annual')
+        Loads the whole-market dataset of a statement, through its loader in statement_loaders.
+    get_profile()
+        Returns the stats that were recorded in profiling mode.
+    get_dcf_valuation(paths=10000, **kwargs)
+        Returns the distribution of the firm's intrinsic value per share by a Monte Carlo DCF, and its margin of safety.
+    get_percentiles(level='industry')
+        Returns the percentile of every scalar metric within the firm's sector or industry.
+    update_share_prices(curr_share_data=None)
+        Replaces the firm's share prices, so the next report recalculates the price-dependent metrics.
 
 
     """
-    def __init__(self, ticker: str, market: str='us', data_dir='data'):
+    # Firms are kept resident in long-running processes, so they don't carry a __dict__
+    __slots__ = ('ticker', 'market', 'data_dir', 'variant', '_statements', '_statement_matrices', '_metric_cache',
+                 'profiler')
+    # Maps each statement attribute to its dataset and variant
+    statement_datasets = {'income': ('income', 'annual'),
+                          'balance': ('balance', 'annual'),
+                          'cash_flow': ('cashflow', 'annual'),
+                          'curr_share_data': ('shareprices', 'latest'),
+                          'price_factors': ('pricefactors', 'daily')}
+    # Maps the statements that aren't SimFin datasets to the function that loads their whole-market
+    # dataset, with the arguments of get_ticker_indexed_dataset (which loads the rest)
+    statement_loaders = {'price_factors': load_price_factors_dataset}
+
+    def __init__(self, ticker: str, market: str='us', data_dir='data', variant: str='annual', profile: bool=False,
+                 incremental: bool=False):
+        if variant not in ['annual', 'ttm']:
+            raise ValueError(f"The variant must be 'annual' or 'ttm', got {variant}")
         self.ticker = ticker
         self.market = market
         self.data_dir = data_dir
-        self.income = get_financial_report('income', ticker, market, data_dir)
-        self.balance = get_financial_report('balance', ticker, market, data_dir)
-        self.cash_flow = get_financial_report('cashflow', ticker, market, data_dir)
-        self.curr_share_data = get_financial_report('shareprices', ticker, market, data_dir, variant='latest')
+        self.variant = variant
+        self._statements = dict()
+        self._statement_matrices = dict()
+        self._metric_cache = None
+        if incremental:
+            persist_metrics(self)
+        self.profiler = None
+        if profile:
+            self._enable_profiling()
+
+    def _enable_profiling(self):
+        self.profiler = Profiler()
+        # The instance has no __dict__ to hold wrapped methods, so it's switched to a profiled subclass
+        self.__class__ = _get_profiled_class(type(self))
+
+    def get_profile(self) -> pd.DataFrame:
+        """
+        The stats of profiling mode: a row per method, with its number of calls and its cumulative
+        (including nested calls) and maximal time in seconds, sorted by the cumulative time.
+        """
+        if self.profiler is None:
+            raise ValueError("Profiling is off, instantiate the firm with profile=True")
+        stats = pd.DataFrame.from_dict(self.profiler.get_stats(), orient='index').drop(columns=['rows', 'histogram'])
+        return stats.sort_values(by='total_time', ascending=False)
+
+    @classmethod
+    def get_required_datasets(cls, tests: dict=display_tests) -> list:
+        return get_required_datasets(cls, tests)
+
+    @classmethod
+    def get_statement_source(cls, statement: str, variant: str='annual') -> tuple:
+        """ The loader, dataset and variant of a statement's whole-market dataset, for a firm of the given variant """
+        dataset, dataset_variant = cls.statement_datasets[statement]
+        if dataset_variant == 'annual':
+            dataset_variant = variant
+        return cls.statement_loaders.get(statement, get_ticker_indexed_dataset), dataset, dataset_variant
+
+    @classmethod
+    def load_market_dataset(cls, statement: str, market: str='us', data_dir: str='data', variant: str='annual'):
+        """ The whole-market dataset that a firm's statement is read from, e.g. to load it ahead of the firms """
+        loader, dataset, dataset_variant = cls.get_statement_source(statement, variant)
+        return loader(dataset, market, data_dir, dataset_variant)
+
+    def load_statement(self, statement: str) -> pd.DataFrame:
+        if statement not in self._statements:
+            loader, dataset, variant = self.get_statement_source(statement, self.variant)
+            self._statements[statement] = get_financial_report(dataset, self.ticker, self.market, self.data_dir,
+                                                               variant=variant, loader=loader)
+        return self._statements[statement]
+
+    def update_share_prices(self, curr_share_data: pd.DataFrame=None):
+        """
+        Replace the firm's share prices with curr_share_data (by default, they're read again from
+        the latest shareprices dataset). In incremental mode, the fundamental metrics stay memoized,
+        and only the metrics that depend on the share prices are calculated again by the next report.
+        """
+        if curr_share_data is None:
+            self._statements.pop('curr_share_data', None)
+        else:
+            self._statements['curr_share_data'] = curr_share_data
+        invalidate_metrics(self, ['curr_share_data'])
 
-    def get_latest_report_year(self, report_kind: str):
+    def get_share_data(self, column: str):
+        """ A value of the firm's latest share prices record, e.g. 'Close' or 'Shares Outstanding' """
+        return self.curr_share_data[column].values[0]
+
+    @property
+    def income(self):
+        return self.load_statement('income')
+
+    @property
+    def balance(self):
+        return self.load_statement('balance')
+
+    @property
+    def cash_flow(self):
+        return self.load_statement('cash_flow')
+
+    @property
+    def curr_share_data(self):
+        return self.load_statement('curr_share_data')
+
+    @property
+    def price_factors(self):
+        return self.load_statement('price_factors')
+
+    def get_price_factor(self, column: str) -> float:
+        """ A factor of the firm's daily share prices (see price_factors.factor_columns), NaN if it wasn't computed """
+        if not len(self.price_factors):
+            return np.nan
+        return float(self.price_factors[column].values[0])
+
+    def get_statement_matrix(self, report_kind: str) -> StatementMatrix:
         if report_kind not in ['income', 'balance', 'cash_flow']:
             raise ValueError(f"A report named {report_kind} does not exist")
-        report = getattr(self, report_kind)
-        return report[report['Fiscal Year'] == report['Fiscal Year'].max()]['Fiscal Year'].values[0]
+        if report_kind not in self._statement_matrices:
+            self._statement_matrices[report_kind] = StatementMatrix(self.load_statement(report_kind))
+        return self._statement_matrices[report_kind]
+
+    def get_latest_report_year(self, report_kind: str):
+        return self.get_statement_matrix(report_kind).latest_year
 
     def get_latest_annual_data(self, report_kind: str, column: str, years_back: int):
-        latest_year = self.get_latest_report_year(report_kind)
-        earliest_year = latest_year - years_back
-        report = getattr(self, report_kind)
-        report.sort_values(by='Fiscal Year', ascending=False, inplace=True)
-        values = report[report['Fiscal Year'] > earliest_year][column].values
-        values = np.nan_to_num(values, nan=0)
+        values = self.get_statement_matrix(report_kind).get_latest_data(column, years_back)
         if len(values) == 1:
             return values[0]
         else:
             return values
 
+    @metric('income')
     def get_last_revenues(self, years_back: int=1):
         return self.get_latest_annual_data(report_kind='income', column='Revenue', years_back=years_back)
 
+    @metric('get_last_revenues')
     def last_revenue_test(self):
         return bool(self.get_last_revenues() > (350 * 10 ^ 6))
 
+    @metric('income')
     def get_last_profits(self, years_back: int=5):
         return self.get_latest_annual_data(report_kind='income', column='Net Income (Common)', years_back=years_back)
 
+    @metric('get_last_profits')
     def positive_last_profits_test(self, years_back: int=5):
         # TODO ask Yotam if this is relevant
         lowest_profit = min(self.get_last_profits(years_back=years_back))
         return lowest_profit > 0
 
+    @metric('get_last_profits')
     def consistent_profits_growth_test(self, years_back: int=5):
         profits = self.get_last_profits(years_back=years_back)
         for index, profit in enumerate(profits[:-1]):
@@ -86,10 +233,12 @@ class Firm:
                 return False
         return True
 
+    @metric('get_last_profits')
     def get_profits_growth_rolling_2_years(self):
         profits = self.get_last_profits(years_back=5)
         return ((profits[0] + profits[-1])/(profits[-2] + profits[-3])) - 1
 
+    @metric('get_last_profits')
     def get_profits_growth_array(self, years_back: int=5):
         growth_list = list()
         profits = self.get_last_profits(years_back=years_back)
@@ -99,31 +248,38 @@ class Firm:
             growth_list.append(percentage)
         return np.array(growth_list)
 
+    @metric('get_profits_growth_array')
     def get_avg_profit_growth(self, years_back=5):
         growth_array = self.get_profits_growth_array(years_back=years_back)
         return np.mean(growth_array)
 
+    @metric('consistent_profits_growth_test', 'get_profits_growth_rolling_2_years')
     def profits_growth_test(self, threshold: float=0.3):
         if not self.consistent_profits_growth_test(years_back=5):
             return False
         return self.get_profits_growth_rolling_2_years() > threshold
 
+    @metric('curr_share_data', 'get_last_profits')
     def get_eps(self):
-        shares_num = self.curr_share_data['Shares Outstanding'].values[0]
+        shares_num = self.get_share_data('Shares Outstanding')
         profit = self.get_last_profits(years_back=1)
         return profit / shares_num
 
+    @metric('curr_share_data')
     def get_current_stock_price(self):
-        return self.curr_share_data['Close'].values[0]
+        return self.get_share_data('Close')
 
+    @metric('get_current_stock_price', 'get_eps')
     def get_earnings_multiplier(self):
         return self.get_current_stock_price() / self.get_eps()
 
+    @metric('get_earnings_multiplier')
     def earnings_multiplier_test(self, threshold: float=15.0):
         if not (isinstance(threshold, int) or isinstance(threshold, float)):
             return ValueError(f"Threshold arg must be numeric. The argument that was passed is {threshold}")
         return self.get_earnings_multiplier() < threshold
 
+    @metric('balance')
     def get_current_ratio(self):
         current_assets = \
             self.get_latest_annual_data(report_kind='balance', column='Total Current Assets', years_back=1)
@@ -131,50 +287,61 @@ class Firm:
             self.get_latest_annual_data(report_kind='balance', column='Total Current Liabilities', years_back=1)
         return current_assets / current_liabilities
 
+    @metric('get_current_ratio')
     def current_ratio_test(self, threshold: float=2):
         return self.get_current_ratio() > threshold
 
+    @metric('balance')
     def get_shareholders_equity(self, years_back: int=1):
         total_assets = self.get_latest_annual_data(report_kind='balance', column='Total Assets', years_back=years_back)
         total_liabilities = \
         self.get_latest_annual_data(report_kind='balance', column='Total Liabilities', years_back=years_back)
         return total_assets - total_liabilities
 
+    @metric('balance', 'get_shareholders_equity')
     def get_equity_multiplier(self):
         total_assets = self.get_latest_annual_data(report_kind='balance', column='Total Assets', years_back=1)
         shareholders_equity = self.get_shareholders_equity(years_back=1)
         return total_assets / shareholders_equity
 
+    @metric('get_earnings_multiplier', 'get_equity_multiplier')
     def equity_earnings_test(self, threshold: float=22.0):
         return (self.get_earnings_multiplier() * self.get_equity_multiplier()) < threshold
 
+    @metric('balance')
     def get_working_capital(self, years_back: int=1):
         current_assets = self.get_latest_annual_data(report_kind='balance', column='Total Current Assets', years_back=years_back)
         current_liabilities = self.get_latest_annual_data(report_kind='balance', column='Total Current Liabilities', years_back=years_back)
         return current_assets - current_liabilities
 
+    @metric('get_working_capital')
     def get_delta_working_capital(self):
         working_capital = self.get_working_capital(years_back=2)
         return working_capital[0] - working_capital[1]
 
+    @metric('balance')
     def get_long_term_liabilities(self):
         return self.get_latest_annual_data(report_kind='balance', column='Total Noncurrent Liabilities', years_back=1)
 
+    @metric('get_working_capital', 'get_long_term_liabilities')
     def working_capital_long_term_liabilities_test(self):
         return bool(self.get_working_capital() > self.get_long_term_liabilities())
 
+    @metric('income')
     def get_tax_rate(self):
         pre_tax_income = self.get_latest_annual_data(report_kind='income', column='Pretax Income (Loss)', years_back=1)
         income_tax_expense = self.get_latest_annual_data(report_kind='income', column='Income Tax (Expense) Benefit, Net',
                                                          years_back=1)
         return ((-1) * income_tax_expense) / pre_tax_income
 
+    @metric('income', 'get_tax_rate')
     def get_nopat(self):
         tax_rate = self.get_tax_rate()
         operating_income = self.get_latest_annual_data(report_kind='income', column='Operating Income (Loss)',
                                                          years_back=1)
         return operating_income * (1-tax_rate)
 
+    @metric('income', 'balance')
     def get_capex(self):
         depreciation_amortization = \
         self.get_latest_annual_data(report_kind='income', column='Depreciation & Amortization',
@@ -183,6 +350,7 @@ class Firm:
                                           years_back=2)
         return PPE[0] - PPE[1] + depreciation_amortization
 
+    @metric('income', 'get_nopat', 'get_capex', 'get_delta_working_capital')
     def get_fcff(self):
         nopat = self.get_nopat()
         depreciation_amortization = self.get_latest_annual_data(report_kind='income', column='Depreciation & Amortization',
@@ -191,57 +359,90 @@ class Firm:
         delta_working_capital = self.get_delta_working_capital()
         return nopat + depreciation_amortization - capex - delta_working_capital
 
+    @metric('get_fcff')
     def positive_fcff_test(self):
         return self.get_fcff() > 0
 
+    def get_dcf_valuation(self, paths: int=10000, **kwargs) -> dict:
+        """
+        The firm's intrinsic value per share by a Monte Carlo DCF of its FCFF (see dcf.simulate_dcf
+        for the model and its parameters): the mean and quantiles of the value, the margin of
+        safety against the current stock price and the probability that the stock is undervalued
+        """
+        from dcf import simulate_dcf
+        with metric_scope(self), np.errstate(all='ignore'):
+            valuation = simulate_dcf(self.get_fcff(), self.get_net_debt(), self.get_share_data('Shares Outstanding'),
+                                     self.get_current_stock_price(), paths=paths, **kwargs)
+        return {name: values[0] for name, values in valuation.items()}
+
+    @metric('income', 'balance')
     def get_roa(self):
         net_income = self.get_latest_annual_data(report_kind='income', column='Net Income', years_back=1)
         total_assets = self.get_latest_annual_data(report_kind='balance', column='Total Assets', years_back=1)
         return net_income / total_assets
 
+    @metric('get_roa')
     def roa_test(self, threshold: int=0.12):
         return self.get_roa() > threshold
 
+    @metric('income', 'get_shareholders_equity')
     def get_average_roe(self, years_back: int=5):
         net_income = self.get_latest_annual_data(report_kind='income', column='Net Income', years_back=years_back)
         shareholders_equity = self.get_shareholders_equity(years_back=years_back)
-        roe_array = net_income / shareholders_equity
+        # The income (a flow) and the balance (a stock) can have different histories, e.g. the first TTM
+        # income record of a young firm is a year after its first balance sheet, so they're paired by year
+        income_years = self.get_statement_matrix('income').get_latest_years(years_back)
+        balance_years = self.get_statement_matrix('balance').get_latest_years(years_back)
+        common_years = np.intersect1d(income_years, balance_years)
+        roe_array = np.atleast_1d(net_income)[np.isin(income_years, common_years)] / \
+            np.atleast_1d(shareholders_equity)[np.isin(balance_years, common_years)]
         return np.mean(roe_array)
 
+    @metric('get_average_roe')
     def roe_5_years_test(self, threshold: int=0.15):
         return self.get_average_roe() > threshold
 
+    @metric('income')
     def get_net_income_5_years(self):
         net_income = self.get_latest_annual_data(report_kind='income', column='Net Income', years_back=5)
         return np.sum(net_income)
 
+    @metric('get_net_income_5_years', 'get_long_term_liabilities')
     def net_income_long_liabilities_test(self):
         net_income_sum = self.get_net_income_5_years()
         long_term_liabilities = self.get_long_term_liabilities()
         return net_income_sum > long_term_liabilities
 
+    @metric('income')
     def get_last_year_net_income_growth(self):
         net_income = self.get_latest_annual_data(report_kind='income', column='Net Income', years_back=2)
         return net_income[0] - net_income[1]
 
+    @metric('balance')
     def get_retained_earnings(self, years_back: int=1):
         return self.get_latest_annual_data(report_kind='balance', column='Retained Earnings', years_back=years_back)
 
+    @metric('get_last_year_net_income_growth', 'get_retained_earnings')
     def get_profits_growth_to_surplus(self):
         return self.get_last_year_net_income_growth() / self.get_retained_earnings()
 
+    @metric('get_profits_growth_to_surplus')
     def profits_growth_to_surplus_test(self, threshold: float=0.12):
         return self.get_profits_growth_to_surplus() > threshold
 
+    @metric('get_current_stock_price', 'get_eps')
     def get_pe_ratio(self):
         return self.get_current_stock_price() / self.get_eps()
 
+    @metric('get_pe_ratio', 'get_avg_profit_growth')
     def get_peg_ratio(self):
         return self.get_pe_ratio() / self.get_avg_profit_growth()
 
+    @metric('get_peg_ratio')
     def peg_ratio_test(self, threshold: float=1.0):
         return self.get_peg_ratio() < threshold
 
+    @metric('balance')
     def get_net_debt(self):
         short_term_debt = self.get_latest_annual_data(report_kind='balance', column='Short Term Debt', years_back=1)
         long_term_debt = self.get_latest_annual_data(report_kind='balance', column='Long Term Debt', years_back=1)
@@ -250,15 +451,19 @@ class Firm:
                                                            years_back=1)
         return short_term_debt + long_term_debt - cash_and_equivalents
 
+    @metric('get_net_debt', 'get_shareholders_equity')
     def get_debt_equity_ratio(self):
         return self.get_net_debt() / self.get_shareholders_equity()
 
+    @metric('get_debt_equity_ratio')
     def debt_equity_ratio_test(self, threshold: float=0.8):
         return self.get_debt_equity_ratio() < threshold
 
+    @metric('get_profits_growth_array')
     def get_last_profits_growth_rate(self):
         return self.get_profits_growth_array()[0]
 
+    @metric('get_avg_profit_growth', 'get_last_profits_growth_rate')
     def lynch_profits_growth_test(self, years_back: int=5):
         avg_profits_growth = self.get_avg_profit_growth(years_back=years_back)
         last_profits_growth = self.get_last_profits_growth_rate()
@@ -272,28 +477,35 @@ class Firm:
         else:
             return False
 
+    @metric('balance')
     def get_last_inventories(self, years_back: int=2):
         return self.get_latest_annual_data(report_kind='balance', column='Inventories', years_back=years_back)
 
+    @metric('get_last_revenues', 'get_last_inventories')
     def get_inventories_revenue_ratio(self, years_back: int=2):
         revenues = self.get_last_revenues(years_back=years_back)
         inventories = self.get_last_inventories(years_back=years_back)
         return inventories / revenues
 
+    @metric('get_inventories_revenue_ratio')
     def get_inventories_revenue_growth(self):
         ratio_array = self.get_inventories_revenue_ratio(years_back=2)
         return (ratio_array[0] / ratio_array[1]) - 1
 
+    @metric('get_inventories_revenue_growth')
     def inventories_revenue_growth_test(self, threshold: float=0.05):
         growth_rate = self.get_inventories_revenue_growth()
         return growth_rate < threshold
 
+    @metric('get_last_profits')
     def get_two_years_profits(self):
         return self.get_last_profits(years_back=2)
 
+    @metric('get_two_years_profits')
     def positive_last_two_profits_test(self):
         return np.min(self.get_two_years_profits()) > 0
 
+    @metric('get_avg_profit_growth', 'get_last_revenues')
     def lynch_profit_revenue_test(self, years_back: int=5):
         avg_profits_growth = self.get_avg_profit_growth(years_back=years_back)
         revenue = self.get_last_revenues(years_back=1)
@@ -304,20 +516,84 @@ class Firm:
         else:
             return False
 
+    @metric('curr_share_data', 'get_current_stock_price')
     def get_market_cap(self):
         stock_price = self.get_current_stock_price()
-        stocks_num = self.curr_share_data['Shares Outstanding'].values[0]
+        stocks_num = self.get_share_data('Shares Outstanding')
         return stock_price * stocks_num
 
+    @metric('get_market_cap')
     def market_cap_test(self, threshold: int=150000000):
         return self.get_market_cap() > threshold
 
+    @metric('get_market_cap', 'get_last_revenues')
     def get_market_cap_revenue(self):
         return self.get_market_cap() / self.get_last_revenues()
 
+    @metric('get_market_cap_revenue')
     def market_cap_revenue_test(self, threshold: float=1.5):
         return self.get_market_cap_revenue() < threshold
 
+    @metric('price_factors')
+    def get_momentum_12_1(self):
+        return self.get_price_factor('momentum_12_1')
+
+    @metric('price_factors')
+    def get_momentum_6m(self):
+        return self.get_price_factor('momentum_6m')
+
+    @metric('price_factors')
+    def get_volatility_1y(self):
+        return self.get_price_factor('volatility_1y')
+
+    @metric('price_factors')
+    def get_max_drawdown_1y(self):
+        return self.get_price_factor('max_drawdown_1y')
+
+    @metric('price_factors')
+    def get_high_52w(self):
+        return self.get_price_factor('high_52w')
+
+    @metric('price_factors')
+    def get_low_52w(self):
+        return self.get_price_factor('low_52w')
+
+    @metric('price_factors')
+    def get_range_position_52w(self):
+        return self.get_price_factor('range_position_52w')
+
+    def get_percentile(self, metric_name: str, level: str='industry') -> float:
+        """
+        The percentile (0-100) of one of the firm's metrics (e.g. 'get_roa') within its sector or
+        industry, looked up in the market's percentile index. NaN if the firm has no group
+        """
+        # Imported here, since the index is built from the whole market's metrics
+        from peer_percentiles import get_percentile_index
+        index = get_percentile_index(self.market, self.data_dir, level, self.variant)
+        group = index.get_ticker_group(self.ticker)
+        if group is None:
+            return np.nan
+        with np.errstate(all='ignore'):
+            return index.get_percentile(metric_name, group, float(getattr(self, metric_name)()))
+
+    def get_percentiles(self, level: str='industry') -> dict:
+        """
+        Maps each scalar get_* metric of the firm to its percentile within its sector or industry
+        (NaN for the metrics that can't be calculated from the firm's history)
+        """
+        from peer_percentiles import get_percentile_index
+        index = get_percentile_index(self.market, self.data_dir, level, self.variant)
+        percentiles = dict()
+        with metric_scope(self):
+            # MarketMetrics has a few helper metrics that Firm doesn't
+            for metric_name in [name for name in index.sorted_values if hasattr(self, name)]:
+                try:
+                    percentiles[metric_name] = self.get_percentile(metric_name, level)
+                except (IndexError, ValueError, ZeroDivisionError):
+                    # e.g. a metric of 5 years over a shorter history
+                    percentiles[metric_name] = np.nan
+        return percentiles
+
     @staticmethod
     def format_numbers(num):
         if num > 1000000:
@@ -355,35 +631,69 @@ class Firm:
             lambda row: self.check_investor_threshold(row['investor_test_pass_rate'], row['investor']), axis=1)
         return df
 
-    def generate_firm_report(self) -> pd.DataFrame:
+    def generate_firm_report(self, tests: dict=display_tests) -> pd.DataFrame:
         '''
         Generate a conclusive report about the firm, including the display of
         financial metrics and relations, based on Benchmarks that were defined
         by famous investors.
 
+        Parameters
+        ---------
+            tests (dict): The tests to include, in the format of config.display_tests.
+                Only the statements these tests need are loaded
+
         Returns
         ---------
             report (pd.DataFrame): A conclusive report about the firm
         '''
-        df_list = list()
-        for investor in display_tests.keys():
-            for test in display_tests[investor]:
-                test_dict = dict()
-                desc_dict = dict()
-                test_func_name = '_'.join(test.split()) + '_test'
-                test_func = getattr(self, test_func_name)
-                test_passed = test_func()
-                test_dict.update({'investor': investor, 'test_id': test, 'description': display_tests[investor][test]['description'],
-                                  'test_passed': test_passed})
-                for idx, display_func in enumerate(display_tests[investor][test]['display_functions']):
-                    test_disp_func = getattr(self, display_func)
-                    disp_func_val = test_disp_func()
-                    if isinstance(disp_func_val, np.ndarray):
-                        disp_func_val = list(disp_func_val)
-                    desc_dict.update({display_tests[investor][test]['display_functions_desc'][
-                                          idx]: self.format_related_values(disp_func_val)})
-                test_dict.update({'related_values': desc_dict})
-                df_list.append(test_dict)
+        with metric_scope(self):
+            df_list = list()
+            for investor in tests.keys():
+                for test in tests[investor]:
+                    test_dict = dict()
+                    desc_dict = dict()
+                    test_passed = run_test(self, test, tests[investor][test])
+                    test_dict.update({'investor': investor, 'test_id': test, 'description': tests[investor][test]['description'],
+                                      'test_passed': test_passed})
+                    for idx, display_func in enumerate(tests[investor][test]['display_functions']):
+                        test_disp_func = getattr(self, display_func)
+                        disp_func_val = test_disp_func()
+                        if isinstance(disp_func_val, np.ndarray):
+                            disp_func_val = list(disp_func_val)
+                        desc_dict.update({tests[investor][test]['display_functions_desc'][
+                                              idx]: self.format_related_values(disp_func_val)})
+                    test_dict.update({'related_values': desc_dict})
+                    df_list.append(test_dict)
         summary_df = pd.DataFrame(df_list)
         summary_df = self.summarize_investor_test(summary_df)
         return summary_df
+
+
+_profiled_classes = dict()
+
+
+def _get_profiled_class(cls):
+    """
+    A subclass of cls whose get_*/*_test methods (and the report's methods) record every call
+    in the instance's profiler
+    """
+    if cls not in _profiled_classes:
+        def profiled(func, name):
+            @functools.wraps(func)
+            def wrapper(self, *args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(self, *args, **kwargs)
+                finally:
+                    self.profiler.record(name, time.perf_counter() - start)
+            return wrapper
+
+        members = {'__slots__': ()}
+        for name in dir(cls):
+            if name.startswith('get_') or name.endswith('_test') or \
+                    name in ['load_statement', 'summarize_investor_test', 'generate_firm_report']:
+                member = inspect.getattr_static(cls, name)
+                if inspect.isfunction(member):
+                    members[name] = profiled(member, name)
+        _profiled_classes[cls] = type(f"Profiled{cls.__name__}", (cls,), members)
+    return _profiled_classes[cls]
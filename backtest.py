@@ -0,0 +1,199 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+from get_financial_report import ensure_dataset_file
+from market_data import MarketData, StatementTensor, load_statement_columns, statement_columns
+from market_metrics import MarketMetrics
+from screener import get_test_results, summarize_market_tests
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+price_columns = ['Close', 'Adj. Close', 'Shares Outstanding']
+
+
+class MarketHistory:
+    """
+    The whole annual history of every firm in a market, with the publish date of every
+    record, so the statements can be rebuilt as they were available at any past date.
+    Note that SimFin's records hold their latest (restated) values.
+
+    Attributes
+    ----------
+    market: str
+        The market where the firms are traded
+    data_dir: str (default='data')
+        The directory of Simfin's data
+    tickers: np.ndarray
+        The sorted universe of tickers: the firms that have income statements and balance sheets
+    statements: dict
+        Maps a report kind ('income', 'balance') to its StatementTensor over the whole history
+    """
+    def __init__(self, market: str='us', data_dir: str='data'):
+        self.market = market
+        self.data_dir = data_dir
+        reports = load_statement_columns(market, data_dir, extra_columns=['Publish Date', 'Report Date'])
+        tickers = None
+        for report in reports.values():
+            report_tickers = set(report['Ticker'].dropna())
+            tickers = report_tickers if tickers is None else tickers & report_tickers
+        self.tickers = np.array(sorted(tickers))
+        self.statements = dict()
+        for report_kind, report in reports.items():
+            # A record without a publish date is considered available from its report date
+            report = report.assign(**{'Publish Date': report['Publish Date'].fillna(report['Report Date'])})
+            self.statements[report_kind] = StatementTensor(report, self.tickers, statement_columns[report_kind],
+                                                           depth=None, date_column='Publish Date')
+        logger.info(f"Loaded the history of {len(self.tickers)} firms in market {market}")
+
+    @property
+    def fiscal_years(self) -> np.ndarray:
+        years = self.statements['income'].years
+        return np.unique(years[~np.isnan(years)]).astype(int)
+
+    def as_of(self, date, share_prices: dict, depth: int=5) -> MarketData:
+        """ The market's data as it was available at date, with the given share prices (aligned on the tickers) """
+        statements = {report_kind: tensor.as_of(date, depth) for report_kind, tensor in self.statements.items()}
+        return MarketData.from_arrays(self.market, self.data_dir, self.tickers, statements, share_prices)
+
+
+def load_price_snapshots(tickers: np.ndarray, dates: np.ndarray, market: str='us', data_dir: str='data',
+                         chunksize: int=10 ** 6) -> dict:
+    """
+    Get every ticker's last daily share prices on or before each of dates, by streaming the
+    daily shareprices dataset in chunks. The dates must be sorted. A price is only taken from
+    the period since the previous date, so a firm that stopped trading gets no price afterwards.
+
+    Returns
+    ---------
+        snapshots (dict): Maps each column of price_columns to a (ticker x date) array, NaN where
+            there is no price
+    """
+    path = ensure_dataset_file('shareprices', market, data_dir, variant='daily')
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    ticker_index = pd.Index(tickers)
+    shape = (len(tickers), len(dates))
+    snapshots = {column: np.full(shape, np.nan) for column in price_columns}
+    snapshot_days = np.full(shape, np.iinfo(np.int64).min).ravel()
+    for chunk in pd.read_csv(path, sep=';', usecols=['Ticker', 'Date'] + price_columns, chunksize=chunksize):
+        codes = ticker_index.get_indexer(chunk['Ticker'])
+        days = chunk['Date'].values.astype('datetime64[D]')
+        # The i-th date's snapshot is the last price in (dates[i - 1], dates[i]]
+        periods = np.searchsorted(dates, days, side='left')
+        valid = (codes >= 0) & (periods < len(dates))
+        keys = (codes * len(dates) + periods)[valid]
+        days = days[valid].astype(np.int64)
+        order = np.lexsort((days, keys))
+        keys, days = keys[order], days[order]
+        last = np.append(keys[1:] != keys[:-1], True)
+        rows = np.flatnonzero(valid)[order][last]
+        keys, days = keys[last], days[last]
+        newer = days >= snapshot_days[keys]
+        keys, rows = keys[newer], rows[newer]
+        snapshot_days[keys] = days[newer]
+        for column in price_columns:
+            snapshots[column].ravel()[keys] = chunk[column].values[rows]
+    return snapshots
+
+
+def get_evaluation_date(fiscal_year: int, evaluation_day: str='04-01') -> np.datetime64:
+    """ The date a fiscal year's reports are evaluated at: evaluation_day (MM-DD) of the following year """
+    return np.datetime64(f"{fiscal_year + 1}-{evaluation_day}", 'D')
+
+
+def iter_backtest(market: str='us', data_dir: str='data', start_year: int=None, end_year: int=None,
+                  evaluation_day: str='04-01', chunksize: int=10 ** 6):
+    """
+    Run every test of display_tests for every firm as of each fiscal year, using only the
+    records published by that year's evaluation date and the share prices of that date.
+    The results are yielded a year at a time, so only one year's results are in memory.
+
+    Yields
+    ---------
+        fiscal_year (int): The evaluated fiscal year
+        report (pd.DataFrame): The columns of screen_market, plus 'fiscal_year', 'as_of_date', the
+            'latest_fiscal_year' of the firm's records and the 'forward_return' of its shares until
+            the next fiscal year's evaluation date
+    """
+    history = MarketHistory(market, data_dir)
+    fiscal_years = history.fiscal_years
+    start_year = fiscal_years.min() if start_year is None else start_year
+    end_year = fiscal_years.max() if end_year is None else end_year
+    years = np.arange(start_year, end_year + 1)
+    # One more date, to price the returns of the last year
+    dates = np.array([get_evaluation_date(year, evaluation_day) for year in np.append(years, end_year + 1)])
+    snapshots = load_price_snapshots(history.tickers, dates, market, data_dir, chunksize)
+    with np.errstate(all='ignore'):
+        forward_returns = snapshots['Adj. Close'][:, 1:] / snapshots['Adj. Close'][:, :-1] - 1
+    for idx, year in enumerate(years):
+        share_prices = {column: snapshots[column][:, idx] for column in ['Close', 'Shares Outstanding']}
+        data = history.as_of(dates[idx], share_prices)
+        # The firms that had published reports and were trading at the evaluation date
+        eligible = ~np.isnan(share_prices['Close'])
+        for tensor in data.statements.values():
+            eligible &= ~np.isnan(tensor.years[:, 0])
+        test_results = get_test_results(MarketMetrics(data))
+        test_results = {investor: {test: passed[eligible] for test, passed in tests.items()}
+                        for investor, tests in test_results.items()}
+        report = summarize_market_tests(history.tickers[eligible], test_results)
+        firm_data = pd.DataFrame({'ticker': history.tickers[eligible],
+                                  'latest_fiscal_year': data.statements['income'].years[eligible, 0].astype(int),
+                                  'forward_return': forward_returns[eligible, idx]})
+        report = report.merge(firm_data, on='ticker', how='left')
+        report.insert(0, 'as_of_date', str(dates[idx]))
+        report.insert(0, 'fiscal_year', year)
+        logger.info(f"Backtested {eligible.sum()} firms as of {dates[idx]}")
+        yield year, report
+
+
+def summarize_backtest_year(report: pd.DataFrame) -> pd.DataFrame:
+    """ The number of firms and their mean and median forward returns, by investor and recommendation """
+    recommendations = report.drop_duplicates(subset=['ticker', 'investor'])
+    summary = recommendations.groupby(['fiscal_year', 'investor', 'investor_recommendation'])['forward_return'] \
+        .agg(firms='size', mean_return='mean', median_return='median')
+    return summary.reset_index()
+
+
+def run_backtest(market: str='us', data_dir: str='data', start_year: int=None, end_year: int=None,
+                 evaluation_day: str='04-01', output_path: str=None) -> pd.DataFrame:
+    '''
+    Backtest the investors' recommendations over the market's history.
+
+    Parameters
+    ---------
+        output_path (str): Optional CSV file that the detailed results of every year are appended to
+
+    Returns
+    ---------
+        summary (pd.DataFrame): A row per fiscal year, investor and recommendation, with the number
+            of firms and their mean and median forward returns
+    '''
+    if output_path is not None and os.path.exists(output_path):
+        os.remove(output_path)
+    summaries = list()
+    for year, report in iter_backtest(market, data_dir, start_year, end_year, evaluation_day):
+        if output_path is not None:
+            report.to_csv(output_path, mode='a', header=not os.path.exists(output_path), index=False)
+        summaries.append(summarize_backtest_year(report))
+    return pd.concat(summaries, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest the investors' recommendations over a market's history")
+    parser.add_argument('--market', default='us')
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--start-year', type=int, default=None)
+    parser.add_argument('--end-year', type=int, default=None)
+    parser.add_argument('--evaluation-day', default='04-01',
+                        help="The day (MM-DD) after a fiscal year's end when its reports are evaluated")
+    parser.add_argument('--output', default=None, help='A CSV file for the detailed results')
+    args = parser.parse_args()
+    summary = run_backtest(args.market, args.data_dir, args.start_year, args.end_year, args.evaluation_day,
+                           args.output)
+    print(summary.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
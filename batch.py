@@ -0,0 +1,114 @@
+import os
+import argparse
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from Firm import Firm
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def _load_market_datasets(market: str, data_dir: str):
+    # Runs once in every worker process, so each dataset the report needs is parsed once
+    # per worker and then served to all of the worker's firms from the process-wide cache
+    for statement in Firm.get_required_datasets():
+        Firm.load_market_dataset(statement, market, data_dir)
+
+
+def _generate_firm_report(ticker: str, market: str, data_dir: str) -> pd.DataFrame:
+    report = Firm(ticker=ticker, market=market, data_dir=data_dir).generate_firm_report()
+    report.insert(0, 'ticker', ticker)
+    return report
+
+
+def read_tickers_file(path: str) -> list:
+    with open(path, 'r') as tickers_file:
+        return [line.strip() for line in tickers_file if line.strip()]
+
+
+def iter_firm_reports(tickers: list, market: str='us', data_dir: str='data', workers: int=None,
+                      report_func=_generate_firm_report):
+    """
+    Generate the reports of several firms over a pool of processes, in the order they finish.
+    report_func(ticker, market, data_dir) runs in the workers, and must be a module-level
+    function so it can be pickled (by default, it generates the firm's report).
+
+    Yields
+    ---------
+        ticker (str), report, error (Exception): The result of report_func, or the error that
+            was raised while running it (then the report is None)
+    """
+    tickers = list(dict.fromkeys(tickers))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_load_market_datasets,
+                             initargs=(market, data_dir)) as executor:
+        futures = {executor.submit(report_func, ticker, market, data_dir): ticker for ticker in tickers}
+        for done_num, future in enumerate(as_completed(futures), start=1):
+            ticker = futures[future]
+            try:
+                report = future.result()
+                error = None
+                logger.info(f"[{done_num}/{len(tickers)}] Generated a report for firm {ticker}")
+            except Exception as e:
+                report = None
+                error = e
+                logger.warning(f"[{done_num}/{len(tickers)}] Failed to generate a report for firm {ticker}: {e!r}")
+            yield ticker, report, error
+
+
+def generate_batch_report(tickers: list, market: str='us', data_dir: str='data', workers: int=None,
+                          output_path: str=None):
+    '''
+    Generate the reports of several firms in parallel, and combine them into one report.
+    A firm that fails (e.g. a ticker that doesn't exist in the market) doesn't stop the batch.
+
+    Parameters
+    ---------
+        tickers (list): The firms' tickers
+        market (str): The market where the firms are traded
+        data_dir (str): The directory of Simfin's data
+        workers (int): The number of worker processes (default: the number of CPUs)
+        output_path (str): Optional CSV path. Every firm's report is appended to it as soon as it's done
+
+    Returns
+    ---------
+        report (pd.DataFrame): The combined report, with a 'ticker' column
+        errors (dict): Maps each firm that failed to the error message
+    '''
+    reports = list()
+    errors = dict()
+    if output_path is not None and os.path.exists(output_path):
+        os.remove(output_path)
+    for ticker, report, error in iter_firm_reports(tickers, market, data_dir, workers):
+        if error is not None:
+            errors[ticker] = repr(error)
+            continue
+        reports.append(report)
+        if output_path is not None:
+            report.to_csv(output_path, mode='a', header=not os.path.exists(output_path), index=False)
+    combined_report = pd.concat(reports, ignore_index=True) if reports else pd.DataFrame()
+    logger.info(f"Generated {len(reports)} reports, {len(errors)} firms failed")
+    return combined_report, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate the reports of a list of firms in parallel')
+    parser.add_argument('tickers', nargs='*', help="The firms' tickers")
+    parser.add_argument('--file', help='A file with a ticker in each line')
+    parser.add_argument('--market', default='us')
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--workers', type=int, default=None, help='The number of worker processes')
+    parser.add_argument('--output', default='batch_report.csv', help='The CSV path of the combined report')
+    args = parser.parse_args()
+    tickers = list(args.tickers)
+    if args.file:
+        tickers += read_tickers_file(args.file)
+    if not tickers:
+        parser.error('Pass tickers as arguments or with --file')
+    _, errors = generate_batch_report(tickers, args.market, args.data_dir, args.workers, args.output)
+    for ticker, error in errors.items():
+        logger.warning(f"{ticker}: {error}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import os
+import hashlib
+import zipfile
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def build_fixture_zips(data_dir: str, fixtures_dir: str) -> list:
+    """ Zip every dataset CSV of data_dir (e.g. a synthetic market) like SimFin's bulk downloads """
+    os.makedirs(fixtures_dir, exist_ok=True)
+    paths = list()
+    for file_name in sorted(os.listdir(data_dir)):
+        if file_name.endswith('.csv'):
+            path = os.path.join(fixtures_dir, file_name[:-len('.csv')] + '.zip')
+            with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+                zip_file.write(os.path.join(data_dir, file_name), arcname=file_name)
+            paths.append(path)
+    return paths
+
+
+class BulkRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves <market>-<dataset>-<variant>.zip files of the server's fixtures_dir for requests in
+    the format of SimFin's bulk API (?dataset=...&variant=...&market=...), with support for
+    Range and If-Range. The first truncated_responses responses of every file are cut in the
+    middle, to imitate dropped connections.
+    """
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        name = '-'.join(query.get(key, [''])[0] for key in ['market', 'dataset', 'variant'])
+        path = os.path.join(self.server.fixtures_dir, f"{name}.zip")
+        if not os.path.exists(path):
+            self.send_response(400)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(b'{"error": "Unknown dataset"}')
+            return
+        with open(path, 'rb') as zip_file:
+            content = zip_file.read()
+        etag = '"' + hashlib.md5(content).hexdigest() + '"'
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range', etag) == etag:
+            start = int(range_header.split('=')[1].split('-')[0])
+            if start >= len(content):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{len(content) - 1}/{len(content)}")
+            with self.server.lock:
+                self.server.resumed_count[name] = self.server.resumed_count.get(name, 0) + 1
+        else:
+            self.send_response(200)
+        body = content[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        with self.server.lock:
+            self.server.requests_count[name] = self.server.requests_count.get(name, 0) + 1
+            truncate = self.server.requests_count[name] <= self.server.truncated_responses
+        self.wfile.write(body[:len(body) // 2] if truncate else body)
+
+
+def start_bulk_server(fixtures_dir: str, port: int=0, truncated_responses: int=0) -> ThreadingHTTPServer:
+    """ Start serving the fixtures in a background thread. The server's URL is http://127.0.0.1:<server_port> """
+    server = ThreadingHTTPServer(('127.0.0.1', port), BulkRequestHandler)
+    server.fixtures_dir = fixtures_dir
+    server.truncated_responses = truncated_responses
+    server.requests_count = dict()
+    # The number of Range requests that were answered with the rest of the file, by dataset name
+    server.resumed_count = dict()
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="A local stand-in for SimFin's bulk API, serving fixture zips")
+    parser.add_argument('fixtures_dir')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--truncated-responses', type=int, default=0,
+                        help='The number of responses of every file that are cut in the middle')
+    args = parser.parse_args()
+    server = start_bulk_server(args.fixtures_dir, args.port, args.truncated_responses)
+    logger.info(f"Serving {args.fixtures_dir} at http://127.0.0.1:{server.server_port}")
+    threading.Event().wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import warnings
+import numpy as np
+
+from benchmarks.synthetic_data import generate_market_data, get_tickers
+from get_financial_report import load_dataset, clear_dataset_cache
+from Firm import Firm
+from firm_store import FirmStore
+from batch import generate_batch_report
+from screener import screen_market
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_RESULTS_PATH = os.path.join(os.path.dirname(__file__), 'results', 'benchmarks.jsonl')
+
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def time_call(func, repeat: int=1) -> float:
+    """ The best wall time of repeat calls, in seconds """
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def _generate_reports(tickers, data_dir, store: FirmStore=None):
+    failed = 0
+    for ticker in tickers:
+        try:
+            firm = Firm(ticker=ticker, data_dir=data_dir) if store is None else store.get_firm(ticker)
+            firm.generate_firm_report()
+        except Exception:
+            # Short synthetic histories fail like real ones do, they're still timed
+            failed += 1
+    return failed
+
+
+def run_benchmarks(tickers_num: int, data_dir: str, sample_size: int=20, batch_size: int=50,
+                   workers: int=None, repeat: int=3) -> dict:
+    """
+    Time the main code paths over a synthetic market of tickers_num firms.
+
+    Returns
+    ---------
+        timings (dict): Maps each benchmark to its best wall time in seconds
+    """
+    generate_market_data(data_dir, tickers_num)
+    sample = list(get_tickers(tickers_num)[:sample_size])
+    timings = dict()
+
+    def load_datasets():
+        clear_dataset_cache()
+        for report_kind, variant in [('income', 'annual'), ('balance', 'annual'), ('shareprices', 'latest')]:
+            load_dataset(report_kind, data_dir=data_dir, variant=variant)
+
+    timings['dataset_load'] = time_call(load_datasets, repeat)
+    # The following benchmarks are measured with the datasets cached, like in a long-running process
+    timings['firm_construction'] = time_call(
+        lambda: [Firm(ticker=ticker, data_dir=data_dir).income for ticker in sample], repeat) / len(sample)
+    timings['generate_firm_report'] = time_call(lambda: _generate_reports(sample, data_dir), repeat) / len(sample)
+    store = FirmStore(data_dir=data_dir)
+    timings['compact_firm_report'] = time_call(lambda: _generate_reports(sample, data_dir, store), repeat) / len(sample)
+    batch_tickers = list(get_tickers(tickers_num)[:batch_size])
+    timings['batch_report'] = time_call(
+        lambda: generate_batch_report(batch_tickers, data_dir=data_dir, workers=workers), 1)
+    timings['screen_market'] = time_call(lambda: screen_market(data_dir=data_dir), repeat)
+    return timings
+
+
+def record_results(results: dict, path: str=DEFAULT_RESULTS_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as results_file:
+        results_file.write(json.dumps(results) + '\n')
+
+
+def read_results(path: str=DEFAULT_RESULTS_PATH) -> list:
+    if not os.path.exists(path):
+        return list()
+    with open(path, 'r') as results_file:
+        return [json.loads(line) for line in results_file if line.strip()]
+
+
+def compare_results(current: dict, path: str=DEFAULT_RESULTS_PATH):
+    """ Log the ratio between each timing and the last recorded timing of another commit, for the same market size """
+    previous = [results for results in read_results(path) if results['tickers_num'] == current['tickers_num'] and
+                results['commit'] != current['commit']]
+    if not previous:
+        logger.info("There are no recorded results of another commit to compare to")
+        return
+    baseline = previous[-1]
+    for name, timing in current['timings'].items():
+        if name in baseline['timings']:
+            ratio = timing / baseline['timings'][name]
+            logger.info(f"{name}: {timing:.4f}s vs {baseline['timings'][name]:.4f}s at {baseline['commit']} "
+                        f"({ratio:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the value screener over synthetic SimFin-shaped data')
+    parser.add_argument('--tickers', type=int, nargs='+', default=[10, 1000],
+                        help='Market sizes (numbers of firms) to benchmark')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes of the batch benchmark')
+    parser.add_argument('--output', default=DEFAULT_RESULTS_PATH, help='The JSON lines file to record results in')
+    args = parser.parse_args()
+    warnings.filterwarnings('ignore', category=RuntimeWarning)
+    for tickers_num in args.tickers:
+        with tempfile.TemporaryDirectory() as data_dir:
+            # The per-firm INFO logs would be timed too
+            logging.disable(logging.INFO)
+            try:
+                timings = run_benchmarks(tickers_num, data_dir, workers=args.workers, repeat=args.repeat)
+            finally:
+                logging.disable(logging.NOTSET)
+        results = {'commit': get_git_commit(), 'timestamp': time.time(), 'python': platform.python_version(),
+                   'numpy': np.__version__, 'tickers_num': tickers_num, 'timings': timings}
+        logger.info(f"Benchmark results for {tickers_num} firms: {json.dumps(timings)}")
+        compare_results(results, args.output)
+        record_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+
+from benchmarks.synthetic_data import generate_market_data, get_tickers
+from benchmarks.run_benchmarks import get_git_commit, record_results, compare_results
+from get_financial_markets import MARKETS_CACHE_FILE_NAME, default_markets
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_RESULTS_PATH = os.path.join(os.path.dirname(__file__), 'results', 'startup.jsonl')
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in a fresh interpreter, so the imports are timed cold
+_startup_script = '''
+import sys, json, time, logging
+start = time.perf_counter()
+import {module}
+timings = {{'import': time.perf_counter() - start}}
+if {serve}:
+    logging.disable(logging.INFO)
+    import dash_app
+    client = dash_app.app.server.test_client()
+    start = time.perf_counter()
+    client.get('/')
+    client.get('/_dash-layout')
+    timings['first_request'] = time.perf_counter() - start
+    start = time.perf_counter()
+    key = dash_app.report_jobs.submit({ticker!r}, 'us')
+    while dash_app.report_jobs.get_status(key)['state'] in ['pending', 'running']:
+        time.sleep(0.005)
+    timings['first_report'] = time.perf_counter() - start
+print(json.dumps(timings))
+'''
+
+
+def time_startup(module: str, data_dir: str, ticker: str, serve: bool=False) -> dict:
+    script = _startup_script.format(module=module, serve=serve, ticker=ticker)
+    env = dict(os.environ, VALUE_SCREENER_DATA_DIR=data_dir, PYTHONPATH=REPO_DIR)
+    output = subprocess.check_output([sys.executable, '-c', script], cwd=REPO_DIR, env=env, text=True,
+                                     stderr=subprocess.DEVNULL)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run_startup_benchmarks(tickers_num: int, data_dir: str, repeat: int=3) -> dict:
+    """
+    Time a cold start: importing the modules in a fresh interpreter, the dashboard's first
+    request (its page and layout) and its first firm report, which loads the datasets.
+
+    Returns
+    ---------
+        timings (dict): Maps each benchmark to its best wall time in seconds
+    """
+    generate_market_data(data_dir, tickers_num)
+    # A warm markets cache, like a server that ran before
+    with open(os.path.join(data_dir, MARKETS_CACHE_FILE_NAME), 'w') as cache_file:
+        json.dump(default_markets, cache_file)
+    ticker = get_tickers(tickers_num)[0]
+    timings = dict()
+    for module in ['get_financial_report', 'Firm']:
+        timings[f"import_{module}"] = min(time_startup(module, data_dir, ticker)['import'] for _ in range(repeat))
+    dash_runs = [time_startup('dash_app', data_dir, ticker, serve=True) for _ in range(repeat)]
+    timings['import_dash_app'] = min(run['import'] for run in dash_runs)
+    timings['first_request'] = min(run['first_request'] for run in dash_runs)
+    timings['first_report'] = min(run['first_report'] for run in dash_runs)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the modules' import time and the dashboard's first requests")
+    parser.add_argument('--tickers', type=int, default=1000, help='The number of firms in the synthetic market')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=DEFAULT_RESULTS_PATH, help='The JSON lines file to record results in')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as data_dir:
+        timings = run_startup_benchmarks(args.tickers, data_dir, repeat=args.repeat)
+    results = {'commit': get_git_commit(), 'timestamp': time.time(), 'python': platform.python_version(),
+               'numpy': np.__version__, 'tickers_num': args.tickers, 'timings': timings}
+    logger.info(f"Startup benchmark results: {json.dumps(timings)}")
+    compare_results(results, args.output)
+    record_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
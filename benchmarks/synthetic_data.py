@@ -0,0 +1,327 @@
+import os
+import numpy as np
+import pandas as pd
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+statement_id_columns = ['Ticker', 'SimFinId', 'Currency', 'Fiscal Year', 'Fiscal Period', 'Report Date',
+                        'Publish Date', 'Restated Date', 'Shares (Basic)', 'Shares (Diluted)']
+
+
+def get_tickers(tickers_num: int) -> np.ndarray:
+    return np.array([f"SYN{idx:05d}" for idx in range(tickers_num)])
+
+
+def _get_firm_years(rng, tickers_num: int, years_num: int, last_year: int):
+    """ The (ticker index, fiscal year) of every annual report. Some firms have a shorter history """
+    history_lengths = np.where(rng.random(tickers_num) < 0.8, years_num, rng.integers(2, years_num + 1, tickers_num))
+    firm_idx = np.repeat(np.arange(tickers_num), history_lengths)
+    # Years are counted backwards from the last year, inside every firm's block of rows
+    starts = np.repeat(np.cumsum(history_lengths) - history_lengths, history_lengths)
+    years = last_year - (np.arange(len(firm_idx)) - starts)
+    return firm_idx, years
+
+
+def _statement_ids(tickers, firm_idx, years, shares):
+    return {
+        'Ticker': tickers[firm_idx],
+        'SimFinId': firm_idx + 1,
+        'Currency': 'USD',
+        'Fiscal Year': years,
+        'Fiscal Period': 'FY',
+        'Report Date': [f"{year}-12-31" for year in years],
+        'Publish Date': [f"{year + 1}-02-28" for year in years],
+        'Restated Date': [f"{year + 1}-02-28" for year in years],
+        'Shares (Basic)': shares,
+        'Shares (Diluted)': shares * 1.02
+    }
+
+
+def _with_missing_values(rng, values: np.ndarray, missing_rate: float) -> np.ndarray:
+    return np.where(rng.random(len(values)) < missing_rate, np.nan, values)
+
+
+def generate_statements(tickers_num: int, years_num: int=10, last_year: int=2022, seed: int=0) -> dict:
+    """
+    Generate random income statements, balance sheets and cash flow statements with the
+    columns of SimFin's annual datasets.
+
+    Returns
+    ---------
+        statements (dict): Maps 'income', 'balance' and 'cashflow' to a DataFrame
+    """
+    rng = np.random.default_rng(seed)
+    tickers = get_tickers(tickers_num)
+    firm_idx, years = _get_firm_years(rng, tickers_num, years_num, last_year)
+    rows_num = len(firm_idx)
+    base_revenue = rng.lognormal(mean=20, sigma=1.5, size=tickers_num)
+    growth = rng.normal(0.05, 0.1, tickers_num)
+    revenue = base_revenue[firm_idx] * (1 + growth[firm_idx]) ** (years - last_year) * rng.normal(1, 0.05, rows_num)
+    shares = (base_revenue / rng.uniform(5, 200, tickers_num))[firm_idx]
+    ids = _statement_ids(tickers, firm_idx, years, shares)
+
+    cost_of_revenue = -revenue * rng.uniform(0.3, 0.8, rows_num)
+    gross_profit = revenue + cost_of_revenue
+    sga = -revenue * rng.uniform(0.05, 0.2, rows_num)
+    research = -revenue * rng.uniform(0, 0.1, rows_num)
+    depreciation = -revenue * rng.uniform(0.01, 0.08, rows_num)
+    operating_income = gross_profit + sga + research + depreciation
+    interest = -revenue * rng.uniform(0, 0.03, rows_num)
+    pretax_income = operating_income + interest
+    income_tax = -np.clip(pretax_income, 0, None) * rng.uniform(0.1, 0.3, rows_num)
+    net_income = pretax_income + income_tax
+    income = pd.DataFrame({
+        **ids,
+        'Revenue': revenue,
+        'Cost of Revenue': cost_of_revenue,
+        'Gross Profit': gross_profit,
+        'Operating Expenses': sga + research + depreciation,
+        'Selling, General & Administrative': sga,
+        'Research & Development': _with_missing_values(rng, research, 0.3),
+        'Depreciation & Amortization': depreciation,
+        'Operating Income (Loss)': operating_income,
+        'Non-Operating Income (Loss)': interest,
+        'Interest Expense, Net': interest,
+        'Pretax Income (Loss), Adj.': pretax_income,
+        'Abnormal Gains (Losses)': _with_missing_values(rng, np.zeros(rows_num), 0.8),
+        'Pretax Income (Loss)': pretax_income,
+        'Income Tax (Expense) Benefit, Net': income_tax,
+        'Income (Loss) from Continuing Operations': net_income,
+        'Net Extraordinary Gains (Losses)': _with_missing_values(rng, np.zeros(rows_num), 0.9),
+        'Net Income': net_income,
+        'Net Income (Common)': net_income * rng.uniform(0.97, 1, rows_num)
+    })
+
+    total_assets = revenue * rng.uniform(0.5, 3, rows_num)
+    cash = total_assets * rng.uniform(0.02, 0.2, rows_num)
+    receivables = total_assets * rng.uniform(0.05, 0.2, rows_num)
+    inventories = total_assets * rng.uniform(0, 0.2, rows_num)
+    current_assets = cash + receivables + inventories
+    ppe = total_assets * rng.uniform(0.1, 0.5, rows_num)
+    long_term_investments = total_assets * rng.uniform(0, 0.1, rows_num)
+    noncurrent_assets = total_assets - current_assets
+    payables = total_assets * rng.uniform(0.05, 0.15, rows_num)
+    short_term_debt = total_assets * rng.uniform(0, 0.1, rows_num)
+    current_liabilities = payables + short_term_debt
+    long_term_debt = total_assets * rng.uniform(0, 0.4, rows_num)
+    noncurrent_liabilities = long_term_debt * rng.uniform(1, 1.3, rows_num)
+    total_liabilities = current_liabilities + noncurrent_liabilities
+    total_equity = total_assets - total_liabilities
+    retained_earnings = total_equity * rng.uniform(-0.2, 0.8, rows_num)
+    balance = pd.DataFrame({
+        **ids,
+        'Cash, Cash Equivalents & Short Term Investments': cash,
+        'Accounts & Notes Receivable': receivables,
+        'Inventories': _with_missing_values(rng, inventories, 0.1),
+        'Total Current Assets': current_assets,
+        'Property, Plant & Equipment, Net': ppe,
+        'Long Term Investments & Receivables': long_term_investments,
+        'Other Long Term Assets': noncurrent_assets - ppe - long_term_investments,
+        'Total Noncurrent Assets': noncurrent_assets,
+        'Total Assets': total_assets,
+        'Payables & Accruals': payables,
+        'Short Term Debt': _with_missing_values(rng, short_term_debt, 0.1),
+        'Total Current Liabilities': current_liabilities,
+        'Long Term Debt': long_term_debt,
+        'Total Noncurrent Liabilities': noncurrent_liabilities,
+        'Total Liabilities': total_liabilities,
+        'Share Capital & Additional Paid-In Capital': total_equity - retained_earnings,
+        'Treasury Stock': _with_missing_values(rng, -total_equity * 0.05, 0.5),
+        'Retained Earnings': retained_earnings,
+        'Total Equity': total_equity,
+        'Total Liabilities & Equity': total_assets
+    })
+
+    change_in_working_capital = revenue * rng.normal(0, 0.02, rows_num)
+    operating_cash_flow = net_income - depreciation + change_in_working_capital
+    capex = -revenue * rng.uniform(0.02, 0.1, rows_num)
+    dividends = -np.clip(net_income, 0, None) * rng.uniform(0, 0.5, rows_num)
+    debt_change = revenue * rng.normal(0, 0.03, rows_num)
+    cash_flow = pd.DataFrame({
+        **ids,
+        'Net Income/Starting Line': net_income,
+        'Depreciation & Amortization': -depreciation,
+        'Non-Cash Items': _with_missing_values(rng, revenue * 0.01, 0.3),
+        'Change in Working Capital': change_in_working_capital,
+        'Change in Accounts Receivable': change_in_working_capital * 0.4,
+        'Change in Inventories': change_in_working_capital * 0.3,
+        'Change in Accounts Payable': change_in_working_capital * 0.3,
+        'Change in Other': _with_missing_values(rng, np.zeros(rows_num), 0.5),
+        'Net Cash from Operating Activities': operating_cash_flow,
+        'Change in Fixed Assets & Intangibles': capex,
+        'Net Change in Long Term Investment': _with_missing_values(rng, np.zeros(rows_num), 0.5),
+        'Net Cash from Acquisitions & Divestitures': _with_missing_values(rng, np.zeros(rows_num), 0.7),
+        'Net Cash from Investing Activities': capex,
+        'Dividends Paid': dividends,
+        'Cash from (Repayment of) Debt': debt_change,
+        'Cash from (Repurchase of) Equity': _with_missing_values(rng, np.zeros(rows_num), 0.6),
+        'Net Cash from Financing Activities': dividends + debt_change,
+        'Net Change in Cash': operating_cash_flow + capex + dividends + debt_change
+    })
+    return {'income': income, 'balance': balance, 'cashflow': cash_flow}
+
+
+def generate_quarterly_statements(tickers_num: int, years_num: int=10, last_year: int=2022, seed: int=0) -> dict:
+    """
+    Generate quarterly statements, with the columns of SimFin's quarterly datasets, by
+    splitting the annual statements of generate_statements into four quarters. The flows of
+    a fiscal year's quarters sum up to its annual values, and its Q4 balance sheet is the annual
+    one. Some firms haven't reported all the quarters of the last fiscal year yet.
+
+    Returns
+    ---------
+        statements (dict): Maps 'income', 'balance' and 'cashflow' to a DataFrame
+    """
+    rng = np.random.default_rng(seed + 3)
+    annual = generate_statements(tickers_num, years_num, last_year, seed)
+    rows_num = len(annual['income'])
+    weights = rng.dirichlet(np.full(4, 20), rows_num)
+    balance_noise = np.column_stack([rng.uniform(0.95, 1.05, (rows_num, 3)), np.ones(rows_num)])
+    reported_quarters = np.where(rng.random(tickers_num) < 0.7, 4, rng.integers(1, 4, tickers_num))
+    statements = dict()
+    for report_kind, df in annual.items():
+        numeric_columns = [column for column in df.select_dtypes(include='number').columns
+                           if column not in ['SimFinId', 'Fiscal Year', 'Shares (Basic)', 'Shares (Diluted)']]
+        quarters = list()
+        for quarter in range(4):
+            quarter_df = df.copy()
+            factors = balance_noise[:, quarter] if report_kind == 'balance' else weights[:, quarter]
+            quarter_df[numeric_columns] = df[numeric_columns].values * factors[:, None]
+            quarter_df['Fiscal Period'] = f"Q{quarter + 1}"
+            quarter_df['Report Date'] = [f"{year}-{3 * quarter + 3:02d}-{[31, 30, 30, 31][quarter]}"
+                                         for year in df['Fiscal Year']]
+            quarters.append(quarter_df)
+        quarterly = pd.concat(quarters).sort_values(by=['SimFinId', 'Fiscal Year', 'Fiscal Period'], kind='mergesort')
+        quarter_numbers = quarterly['Fiscal Period'].str[1].astype(int).values
+        not_reported = (quarterly['Fiscal Year'].values == last_year) & \
+            (quarter_numbers > reported_quarters[quarterly['SimFinId'].values - 1])
+        statements[report_kind] = quarterly[~not_reported].reset_index(drop=True)
+    return statements
+
+
+def generate_latest_share_prices(tickers_num: int, date: str='2023-03-31', seed: int=0) -> pd.DataFrame:
+    """ Generate random share prices, with the columns of SimFin's 'latest' shareprices dataset """
+    rng = np.random.default_rng(seed + 1)
+    close = rng.lognormal(mean=3.5, sigma=1, size=tickers_num)
+    return pd.DataFrame({
+        'Ticker': get_tickers(tickers_num),
+        'SimFinId': np.arange(tickers_num) + 1,
+        'Date': date,
+        'Open': close * rng.uniform(0.97, 1.03, tickers_num),
+        'Low': close * rng.uniform(0.95, 1, tickers_num),
+        'High': close * rng.uniform(1, 1.05, tickers_num),
+        'Close': close,
+        'Adj. Close': close,
+        'Dividend': _with_missing_values(rng, close * 0.01, 0.7),
+        'Volume': rng.integers(1000, 10 ** 7, tickers_num),
+        'Shares Outstanding': rng.lognormal(mean=18, sigma=1.5, size=tickers_num)
+    })
+
+
+def generate_daily_share_prices(tickers_num: int, start_date: str='2013-01-01', end_date: str='2023-03-31',
+                                seed: int=0) -> pd.DataFrame:
+    """
+    Generate random daily share prices (a random walk per firm), with the columns of SimFin's
+    'daily' shareprices dataset. Some firms stop trading before end_date, like delisted firms.
+    """
+    rng = np.random.default_rng(seed + 2)
+    dates = pd.bdate_range(start_date, end_date).strftime('%Y-%m-%d').values
+    days_num = len(dates)
+    trading_days = np.where(rng.random(tickers_num) < 0.9, days_num, rng.integers(days_num // 4, days_num + 1,
+                                                                                    tickers_num))
+    firm_idx = np.repeat(np.arange(tickers_num), trading_days)
+    starts = np.repeat(np.cumsum(trading_days) - trading_days, trading_days)
+    day_idx = np.arange(len(firm_idx)) - starts
+    log_returns = rng.normal(0.0003, 0.02, len(firm_idx))
+    # The random walks restart at the first day of every firm
+    log_returns[day_idx == 0] = 0
+    cumulative = np.cumsum(log_returns)
+    close = rng.lognormal(mean=3.5, sigma=1, size=tickers_num)[firm_idx] * \
+        np.exp(cumulative - np.repeat(cumulative[starts[day_idx == 0]], trading_days))
+    shares = rng.lognormal(mean=18, sigma=1.5, size=tickers_num)[firm_idx]
+    return pd.DataFrame({
+        'Ticker': get_tickers(tickers_num)[firm_idx],
+        'SimFinId': firm_idx + 1,
+        'Date': dates[day_idx],
+        'Open': close * rng.uniform(0.99, 1.01, len(firm_idx)),
+        'Low': close * rng.uniform(0.97, 1, len(firm_idx)),
+        'High': close * rng.uniform(1, 1.03, len(firm_idx)),
+        'Close': close,
+        'Adj. Close': close,
+        'Dividend': np.nan,
+        'Volume': rng.integers(1000, 10 ** 7, len(firm_idx)),
+        'Shares Outstanding': shares
+    })
+
+
+def generate_companies(tickers_num: int, seed: int=0) -> tuple:
+    """
+    Generate random firm details and industries, with the columns of SimFin's companies and
+    industries datasets. Some firms have no industry, like in SimFin's data.
+
+    Returns
+    ---------
+        companies (pd.DataFrame), industries (pd.DataFrame)
+    """
+    rng = np.random.default_rng(seed + 3)
+    sectors = {'Technology': ['Software', 'Semiconductors', 'Hardware'],
+               'Financial Services': ['Banks', 'Insurance'],
+               'Healthcare': ['Biotechnology', 'Medical Devices', 'Drug Manufacturers'],
+               'Industrials': ['Aerospace & Defense', 'Machinery'],
+               'Consumer Cyclical': ['Retail - Apparel', 'Restaurants']}
+    industries = pd.DataFrame([(sector, industry) for sector, sector_industries in sectors.items()
+                               for industry in sector_industries], columns=['Sector', 'Industry'])
+    industries.insert(0, 'IndustryId', 100000 + np.arange(len(industries)) + 1)
+    industry_ids = rng.choice(industries['IndustryId'].values, tickers_num).astype(float)
+    industry_ids[rng.random(tickers_num) < 0.02] = np.nan
+    tickers = get_tickers(tickers_num)
+    companies = pd.DataFrame({
+        'Ticker': tickers,
+        'SimFinId': np.arange(tickers_num) + 1,
+        'Company Name': [f"Synthetic {ticker} Inc" for ticker in tickers],
+        'IndustryId': pd.array(industry_ids, dtype='Int64'),
+        'ISIN': np.nan,
+        'End of financial year (month)': 12.0,
+        'Number Employees': rng.integers(10, 100000, tickers_num),
+        'Business Summary': np.nan,
+        'Market': 'us',
+        'CIK': np.nan,
+        'Main Currency': 'USD'
+    })
+    return companies, industries
+
+
+def write_dataset(df: pd.DataFrame, report_kind: str, market: str='us', data_dir: str='data', variant: str='annual'):
+    """ Write a dataset where sf.load expects it, in SimFin's CSV format, so it's read instead of downloaded """
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f"{market}-{report_kind}-{variant}.csv")
+    df.to_csv(path, sep=';', index=False)
+    return path
+
+
+def generate_market_data(data_dir: str, tickers_num: int, years_num: int=10, market: str='us', seed: int=0,
+                         daily_prices: bool=False, quarterly: bool=False, companies: bool=False):
+    """
+    Write a synthetic market's income, balance, cashflow (annual, and quarterly if quarterly)
+    and shareprices (latest, and daily if daily_prices) datasets, and the companies and
+    industries datasets if companies, into data_dir. sf.load reads
+    fresh files from data_dir instead of downloading them, so the synthetic market stands in
+    for SimFin's data without an API key or network.
+    """
+    for report_kind, df in generate_statements(tickers_num, years_num, seed=seed).items():
+        write_dataset(df, report_kind, market, data_dir)
+    write_dataset(generate_latest_share_prices(tickers_num, seed=seed), 'shareprices', market, data_dir,
+                  variant='latest')
+    if quarterly:
+        for report_kind, df in generate_quarterly_statements(tickers_num, years_num, seed=seed).items():
+            write_dataset(df, report_kind, market, data_dir, variant='quarterly')
+    if daily_prices:
+        write_dataset(generate_daily_share_prices(tickers_num, start_date=f"{2023 - years_num}-01-01", seed=seed),
+                      'shareprices', market, data_dir, variant='daily')
+    if companies:
+        companies_df, industries_df = generate_companies(tickers_num, seed=seed)
+        companies_df.to_csv(os.path.join(data_dir, f"{market}-companies.csv"), sep=';', index=False)
+        industries_df.to_csv(os.path.join(data_dir, 'industries.csv'), sep=';', index=False)
+    logger.info(f"Generated the data of {tickers_num} synthetic firms in {data_dir}")
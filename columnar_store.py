@@ -0,0 +1,250 @@
+import os
+import sys
+import json
+import time
+import shutil
+import threading
+import numpy as np
+import pandas as pd
+
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+STORE_DIR_NAME = 'columnar'
+META_FILE_NAME = 'meta.json'
+GENERATIONS_DIR_NAME = 'generations'
+CURRENT_FILE_NAME = 'CURRENT'
+INGESTED_DATASETS = [('income', 'annual'), ('balance', 'annual'), ('cashflow', 'annual'), ('shareprices', 'latest')]
+
+_open_stores = dict()
+_open_stores_lock = threading.Lock()
+# Maps each data_dir to the (mtime, generation) of its CURRENT file when it was last read
+_current_generations = dict()
+
+
+class ColumnarDataset:
+    """
+    A whole-market dataset stored on disk as one typed .npy file per column, plus a
+    ticker->row range index. The columns are memory-mapped, so reading one firm's
+    records only touches that firm's rows.
+
+    Attributes
+    ----------
+    path: str
+        The directory of the stored dataset
+    meta: dict
+        The stored dataset's columns, dtypes, ticker offsets and source file mtime
+    ticker_offsets: dict
+        Maps each ticker to the (start, stop) row range of its records
+    generation: str
+        The generation the store was published in (see publish_generation), None if it was
+        ingested in place
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, META_FILE_NAME), 'r') as meta_file:
+            self.meta = json.load(meta_file)
+        self.ticker_offsets = {ticker: tuple(offsets) for ticker, offsets in self.meta['ticker_offsets'].items()}
+        self.columns = {column['name']: np.load(os.path.join(path, column['file']), mmap_mode='r')
+                        for column in self.meta['columns']}
+        self.generation = self.meta.get('generation')
+
+    @property
+    def source_mtime(self):
+        return self.meta['source_mtime']
+
+    def get_ticker_rows(self, ticker: str) -> pd.DataFrame:
+        start, stop = self.ticker_offsets.get(ticker, (0, 0))
+        return self.get_rows(start, stop)
+
+    def get_columns(self, columns: list) -> pd.DataFrame:
+        return self.get_rows(0, self.meta['num_rows'], columns)
+
+    def get_rows(self, start: int, stop: int, columns: list=None) -> pd.DataFrame:
+        if columns is not None:
+            missing = [column for column in columns if column not in self.columns]
+            if missing:
+                # Like selecting the columns of a DataFrame, which the CSV backend does
+                raise KeyError(f"{missing} not in the columns of the store {self.path}")
+        data = dict()
+        for column in self.meta['columns']:
+            if columns is not None and column['name'] not in columns:
+                continue
+            values = np.array(self.columns[column['name']][start:stop])
+            if column['kind'] == 'str':
+                values = pd.Series(values, dtype=object).replace('', np.nan).values
+            data[column['name']] = values
+        return pd.DataFrame(data, columns=columns)
+
+
+def get_store_path(report_kind, market='us', data_dir='data', variant='annual', generation: str=None):
+    if generation is not None:
+        return os.path.join(get_generation_path(generation, data_dir), f"{market}-{report_kind}-{variant}")
+    return os.path.join(data_dir, STORE_DIR_NAME, f"{market}-{report_kind}-{variant}")
+
+
+def get_generation_path(generation: str, data_dir='data'):
+    return os.path.join(data_dir, STORE_DIR_NAME, GENERATIONS_DIR_NAME, generation)
+
+
+def get_current_generation(data_dir='data'):
+    """ The generation that the CURRENT file of data_dir points at, None if nothing was published """
+    current_path = os.path.join(data_dir, STORE_DIR_NAME, CURRENT_FILE_NAME)
+    try:
+        current_mtime = os.stat(current_path).st_mtime_ns
+    except OSError:
+        return None
+    cached = _current_generations.get(data_dir)
+    if cached is not None and cached[0] == current_mtime:
+        return cached[1]
+    try:
+        with open(current_path, 'r') as current_file:
+            generation = current_file.read().strip() or None
+    except OSError:
+        return None
+    _current_generations[data_dir] = (current_mtime, generation)
+    return generation
+
+
+def write_store(data: pd.DataFrame, ticker_offsets: dict, path: str, source_mtime: float, generation: str=None):
+    """
+    Write a dataset, already sorted by ticker, as a columnar store. The store is written
+    to a temporary directory first and then swapped in, so readers never see a partial store.
+    """
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    columns_meta = list()
+    for idx, column in enumerate(data.columns):
+        file_name = f"{idx}.npy"
+        values = data[column]
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            kind = 'numeric'
+            values = values.values
+        else:
+            # Fixed-width strings can be memory-mapped, unlike python objects
+            kind = 'str'
+            values = values.fillna('').astype(str).values.astype(str)
+        np.save(os.path.join(tmp_path, file_name), values)
+        columns_meta.append({'name': column, 'file': file_name, 'kind': kind, 'dtype': str(values.dtype)})
+    meta = {'columns': columns_meta,
+            'num_rows': len(data),
+            'source_mtime': source_mtime,
+            'generation': generation,
+            'ticker_offsets': {ticker: [int(start), int(stop)] for ticker, (start, stop) in ticker_offsets.items()}}
+    with open(os.path.join(tmp_path, META_FILE_NAME), 'w') as meta_file:
+        json.dump(meta, meta_file)
+    old_path = path + '.old'
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def ingest_dataset(report_kind, market='us', data_dir='data', variant='annual') -> str:
+    """
+    Convert a downloaded SimFin dataset into a columnar store under data_dir.
+
+    Returns
+    ---------
+        path (str): The path of the written store
+    """
+    # Imported here, since get_financial_report reads from the columnar store
+    from get_financial_report import load_dataset
+    dataset = load_dataset(report_kind, market, data_dir, variant)
+    path = get_store_path(report_kind, market, data_dir, variant)
+    write_store(dataset.data, dataset.ticker_offsets, path, dataset.mtime)
+    logger.info(f"Ingested {len(dataset.data)} {report_kind} ({variant}) records of market {market} into {path}")
+    return path
+
+
+def ingest_market(market='us', data_dir='data'):
+    return [ingest_dataset(report_kind, market, data_dir, variant) for report_kind, variant in INGESTED_DATASETS]
+
+
+def publish_generation(markets: list=None, data_dir='data', datasets: list=None, keep: int=2) -> str:
+    '''
+    Ingest the datasets of several markets into a new generation of columnar stores, and make
+    it the current one. Run by a single loader process, while any number of worker processes
+    read the stores: the workers memory-map the same files, so the operating system keeps one
+    copy of the data in its page cache for all of them. The CURRENT file is replaced
+    atomically, and every worker switches to the new generation on its next read, without a
+    restart. Until then it keeps reading the previous generation, which is removed only once
+    it's older than the last keep generations (a worker's open memory maps stay valid anyway).
+
+    Parameters
+    ---------
+        markets (list): The markets to ingest (default: ['us']). A generation holds all the
+            markets that are served, the markets that are left out are read like before it was published
+        datasets (list): (dataset, variant) pairs to ingest (default: INGESTED_DATASETS)
+        keep (int): The number of generations to keep, including the new one
+
+    Returns
+    ---------
+        generation (str): The new generation's name
+    '''
+    # Imported here, since get_financial_report reads from the columnar store
+    from get_financial_report import load_dataset
+    markets = markets or ['us']
+    datasets = datasets or INGESTED_DATASETS
+    generation = f"{time.time_ns()}-{os.getpid()}"
+    for market in markets:
+        for report_kind, variant in datasets:
+            dataset = load_dataset(report_kind, market, data_dir, variant)
+            write_store(dataset.data, dataset.ticker_offsets,
+                        get_store_path(report_kind, market, data_dir, variant, generation), dataset.mtime, generation)
+    current_path = os.path.join(data_dir, STORE_DIR_NAME, CURRENT_FILE_NAME)
+    with open(current_path + '.tmp', 'w') as current_file:
+        current_file.write(generation)
+    os.replace(current_path + '.tmp', current_path)
+    logger.info(f"Published generation {generation} of markets {markets}")
+    generations_dir = os.path.join(data_dir, STORE_DIR_NAME, GENERATIONS_DIR_NAME)
+    # The names start with the creation time, so they sort by age
+    for old_generation in sorted(os.listdir(generations_dir))[:-keep]:
+        shutil.rmtree(get_generation_path(old_generation, data_dir), ignore_errors=True)
+    return generation
+
+
+def open_store(report_kind, market='us', data_dir='data', variant='annual'):
+    """
+    Open the columnar store of a dataset, from the current generation if one was published
+    and holds the dataset, and from the store that was ingested in place otherwise. Opened
+    stores are kept per process, and reopened if a new generation was published or the store
+    was ingested again.
+
+    Returns
+    ---------
+        dataset (ColumnarDataset): The opened store, or None if it does not exist
+    """
+    paths = [get_store_path(report_kind, market, data_dir, variant)]
+    generation = get_current_generation(data_dir)
+    if generation is not None:
+        paths.insert(0, get_store_path(report_kind, market, data_dir, variant, generation))
+    for path in paths:
+        try:
+            meta_mtime = os.path.getmtime(os.path.join(path, META_FILE_NAME))
+            break
+        except OSError:
+            continue
+    else:
+        return None
+    key = (report_kind, variant, market, data_dir)
+    with _open_stores_lock:
+        cached = _open_stores.get(key)
+        if cached is not None and cached[:2] == (path, meta_mtime):
+            dataset = cached[2]
+        else:
+            dataset = ColumnarDataset(path)
+            _open_stores[key] = (path, meta_mtime, dataset)
+    return dataset
+
+
+if __name__ == '__main__':
+    # Usage: python columnar_store.py [market] [data_dir]
+    #        python columnar_store.py --publish [data_dir] [market ...]
+    if sys.argv[1:2] == ['--publish']:
+        publish_generation(sys.argv[3:] or None, *sys.argv[2:3])
+    else:
+        ingest_market(*sys.argv[1:3])
@@ -1,5 +1,7 @@
-import json
+import os
 import base64
+import threading
+import flask
 import dash
 import dash_bootstrap_components as dbc
 import pandas as pd
@@ -8,32 +10,100 @@ from dash import html
 from dash import dash_table
 from dash.dependencies import Input, Output, State
 
-from Firm import Firm
+from report_jobs import ReportJobs, get_data_version
 from get_financial_markets import get_financial_markets
 from utils.logger import get_logger
-from config import investor_threshold
+from utils.ttl_cache import TTLCache
+from utils.profiling import global_profiler, latency_buckets
+from config import display_tests, investor_threshold
 
 
 app = dash.Dash(external_stylesheets=[dbc.themes.BOOTSTRAP])
+# The WSGI application, for multi-process servers (e.g. gunicorn dash_app:server)
+server = app.server
 
-financial_markets = get_financial_markets()
+data_dir = os.environ.get('VALUE_SCREENER_DATA_DIR', 'data')
+# The markets whose datasets are loaded in the background once the server starts serving, e.g. "us,de"
+preload_markets = [market for market in os.environ.get('VALUE_SCREENER_PRELOAD', '').split(',') if market]
 
 logger = get_logger(__name__)
 
+# The reports are kept on the server, shared by all sessions (and by all the worker processes, through
+# the report jobs' files), and the browser only holds a report's key
+report_store = TTLCache(maxsize=256, ttl=60 * 60)
+
+
+# Resolved from the module's location, so the app can be imported (e.g. by gunicorn) from any directory
+RESOURCES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dash_resources')
+
+
+def encode_investor_picture(investor: str, resources_dir: str=RESOURCES_DIR) -> str:
+    # The file names don't always match the investors' names' case (e.g. "O'shaughnessy")
+    file_names = {file_name.lower(): file_name for file_name in os.listdir(resources_dir)}
+    with open(os.path.join(resources_dir, file_names[f"{investor}.png".lower()]), 'rb') as image_file:
+        return base64.b64encode(image_file.read()).decode()
+
+
+investor_pictures = {investor: encode_investor_picture(investor) for investor in display_tests.keys()}
+
+
+def prepare_investor_reports(report_df: pd.DataFrame) -> dict:
+    """ Split a firm's report into the tables and pass rates that the investors' tabs display """
+    investor_reports = dict()
+    for investor, investor_df in report_df.groupby('investor', sort=False):
+        pass_rate = investor_df['investor_test_pass_rate'].values[0]
+        investor_df = investor_df.copy()
+        investor_df['related_values'] = investor_df['related_values'].astype('str')
+        investor_df['test_passed'] = investor_df['test_passed'].astype('str')
+        investor_df.drop(columns=['investor', 'test_id', 'investor_test_pass_rate', 'investor_recommendation'],
+                         inplace=True)
+        investor_df.rename(columns={'description': 'Test description', 'test_passed': 'Test passed?',
+                                    'related_values': 'Related values'}, inplace=True)
+        investor_reports[investor] = {
+            'columns': [{"name": i, "id": i} for i in investor_df.columns],
+            'records': investor_df.to_dict('records'),
+            'pass_rate': pass_rate
+        }
+    return investor_reports
+
+
+def rank_leaderboard(market: str, k: int) -> pd.DataFrame:
+    # Imported by the first ranking, to keep the server's startup fast
+    from ranking import rank_market
+    ranking, _ = rank_market(market, data_dir, k=k, with_reports=False)
+    return ranking.round(3)
+
+
+# Rankings of whole markets, by market, k and data version
+ranking_store = TTLCache(maxsize=32, ttl=60 * 60)
+
+# Reports are generated in the background, and concurrent requests for the same firm share one job
+report_jobs = ReportJobs(report_store, prepare=prepare_investor_reports, data_dir=data_dir)
+# A ranking reads a whole market, so they're generated one at a time, in the background like the reports
+ranking_jobs = ReportJobs(ranking_store, workers=1, data_dir=data_dir, name='ranking_job')
+_preload_started = threading.Event()
+
+
+@app.server.before_request
+def start_preload():
+    # Started by the first request, when the server (or each WSGI worker) is already serving
+    if preload_markets and not _preload_started.is_set():
+        _preload_started.set()
+        report_jobs.preload(preload_markets)
+
 colors = {
     'background': '#111111',
     'text': '#7FDBFF'
 }
 
-app.layout = dbc.Container(html.Div(
+firm_page = html.Div(
+    id="firm-page",
     children=[
-        html.H1(children='The Value Screener'),
         html.Div(children=([html.P('''
                             Choose a firm to asses:
                         ''', style={'font-size': '15px', 'fontWeight': 'bold'}),
                             # html.Br(),
-                            dcc.Dropdown(id='market-dropdown',
-                                         options=[{'label': key, 'value': val} for key, val in financial_markets.items()],
+                            dcc.Dropdown(id='market-dropdown', options=[],
                                          placeholder="Choose the firm's market")])),
                             html.Br(),
                             dcc.Input(placeholder="Insert the firm's ticker", style={'Align': 'cen'},
@@ -48,6 +118,7 @@ app.layout = dbc.Container(html.Div(
             className="mb-3",
             n_clicks=0
         ),
+        html.Div(id="job-status", className="mb-3"),
         dbc.Tabs(
             [
                 dbc.Tab(label="Benjamin Graham", tab_id="Benjamin Graham"),
@@ -62,26 +133,96 @@ app.layout = dbc.Container(html.Div(
         html.Div(id="tab-content", className="p-4"),
         html.Div(id="tab-summary", className="p-4", style={'margin': 'auto', 'text-align': 'center',
                                                            'font-size': '30px', 'font-family': 'sans-serif'}),
-        dcc.Store(id="firm-report")
+        dcc.Store(id="firm-report"),
+        dcc.Store(id="report-job"),
+        dcc.Interval(id="job-interval", interval=500, disabled=True)
 
     ]
+)
+
+leaderboard_page = html.Div(
+    id="leaderboard-page",
+    children=[
+        html.P('''
+                Rank the firms of a market by their investors' tests pass rates:
+            ''', style={'font-size': '15px', 'fontWeight': 'bold'}),
+        dcc.Dropdown(id='leaderboard-market-dropdown', options=[], placeholder="Choose the market"),
+        html.Br(),
+        dcc.Input(id='leaderboard-k-input', type='number', min=1, max=500, value=50,
+                  placeholder="Number of firms"),
+        html.Br(),
+        html.Br(),
+        dbc.Button("Rank", color="primary", block=True, id="leaderboard-button", className="mb-3", n_clicks=0),
+        html.Div(id="leaderboard-content", className="p-4"),
+        dcc.Store(id="leaderboard-job"),
+        dcc.Interval(id="leaderboard-interval", interval=500, disabled=True)
+    ]
+)
+
+app.layout = dbc.Container(html.Div(
+    children=[
+        dcc.Location(id="url"),
+        html.H1(children='The Value Screener'),
+        dbc.Nav([dbc.NavLink("Firm report", href="/", active="exact"),
+                 dbc.NavLink("Leaderboard", href="/leaderboard", active="exact")],
+                pills=True, className="mb-3"),
+        firm_page,
+        leaderboard_page
+    ]
 ))
 
 
 @app.callback(
+    Output("firm-page", "style"),
+    Output("leaderboard-page", "style"),
+    Input("url", "pathname")
+)
+def display_page(pathname):
+    # Both pages stay in the layout, so the firm report is kept while the leaderboard is shown
+    if pathname == '/leaderboard':
+        return {'display': 'none'}, {'display': 'block'}
+    return {'display': 'block'}, {'display': 'none'}
+
+
+@app.callback(
+    Output("market-dropdown", "options"),
+    Output("leaderboard-market-dropdown", "options"),
+    Input("url", "pathname")
+)
+def load_market_options(pathname):
+    # Read from the local cache on every page load, so the server doesn't wait for SimFin to start,
+    # and a list that was refreshed in the background is shown without a restart
+    options = [{'label': key, 'value': val} for key, val in get_financial_markets(data_dir, wait=False).items()]
+    return options, options
+
+
+@app.callback(
+    Output("report-job", "data"),
     Output("firm-report", "data"),
+    Output("job-interval", "disabled"),
+    Output("job-status", "children"),
     Input("button", "n_clicks"),
+    Input("job-interval", "n_intervals"),
     State("ticker-input", "value"),
-    State("market-dropdown", "value")
+    State("market-dropdown", "value"),
+    State("report-job", "data")
 )
-def get_full_report(n_clicks, ticker_input, market_input):
+def get_full_report(n_clicks, n_intervals, ticker_input, market_input, job_key):
     if n_clicks == 0:
-        return None
+        return None, None, True, None
+    if dash.ctx.triggered_id == "button":
+        # Returns at once, the report is generated in the background and polled by the interval
+        job_key = report_jobs.submit(ticker_input, market_input)
+    status = report_jobs.get_status(job_key)
+    if status['state'] == 'done':
+        return job_key, job_key, True, None
+    elif status['state'] == 'failed':
+        return job_key, None, True, dbc.Alert(f"Failed to generate the report: {status['error']}", color="danger")
+    elif status['state'] == 'unknown':
+        # The report was evicted from the cache while the page was polling
+        return None, None, True, dbc.Alert("The report has expired, please generate it again", color="warning")
     else:
-        firm = Firm(ticker=ticker_input, market=market_input)
-        report_df = firm.generate_firm_report()
-        json_df = report_df.to_json()
-        return json_df
+        return job_key, dash.no_update, False, html.Div([dbc.Spinner(size="sm"), f" {status['stage']}..."])
 
 
 @app.callback(
@@ -89,21 +230,15 @@ def get_full_report(n_clicks, ticker_input, market_input):
     Input("tabs", "active_tab"),
     Input("firm-report", "data")
     )
-def render_investor_report(investor, firm_report):
-    if not pd.isnull(investor) and not pd.isnull(firm_report):
+def render_investor_report(investor, report_key):
+    if not pd.isnull(investor) and not pd.isnull(report_key):
         logger.info(f"Rendering {investor}'s tab")
-        logger.info(f"Fetching {investor}'s report")
-        report_json = json.loads(firm_report)
-        report_df = pd.DataFrame.from_dict(report_json)
-        investor_df = report_df[report_df['investor'] == investor]
-        investor_df['related_values'] = investor_df['related_values'].astype('str')
-        investor_df['test_passed'] = investor_df['test_passed'].astype('str')
-        investor_df.drop(columns=['investor', 'test_id', 'investor_test_pass_rate', 'investor_recommendation'],
-                         inplace=True)
-        investor_df.rename(columns={'description': 'Test description', 'test_passed': 'Test passed?',
-                                    'related_values': 'Related values'}, inplace=True)
-        return dash_table.DataTable(id="table", columns=[{"name": i, "id": i} for i in investor_df.columns],
-                                    data=investor_df.to_dict('records'), style_cell={'text-align': 'left'},
+        investor_reports = report_jobs.get_result(report_key)
+        if investor_reports is None:
+            return html.P("The report has expired, please generate it again")
+        investor_report = investor_reports[investor]
+        return dash_table.DataTable(id="table", columns=investor_report['columns'],
+                                    data=investor_report['records'], style_cell={'text-align': 'left'},
                                     style_data_conditional=[
                                         {
                                             'if': {
@@ -131,12 +266,13 @@ def render_investor_report(investor, firm_report):
     Input("firm-report", "data"),
     State("tabs", "active_tab")
     )
-def summarize_investor_tests(data_table, firm_report, investor):
-    if not pd.isnull(data_table) and not pd.isnull(firm_report):
+def summarize_investor_tests(data_table, report_key, investor):
+    if not pd.isnull(data_table) and not pd.isnull(report_key):
+        investor_reports = report_jobs.get_result(report_key)
+        if investor_reports is None:
+            return None
         logger.info(f"Rendering {investor}'s recommendation")
-        report_df = pd.DataFrame.from_dict(json.loads(firm_report))
-        investor_df = report_df[report_df['investor'] == investor]
-        investor_pass_rate = investor_df['investor_test_pass_rate'].values[0]
+        investor_pass_rate = investor_reports[investor]['pass_rate']
         investor_thresholds = investor_threshold[investor]
         if investor_pass_rate > investor_thresholds['buy']:
             return html.P([f"Investor's tests pass rate: {investor_pass_rate}", html.Br(), f"Investor's recommendation: Buy"])
@@ -153,15 +289,70 @@ def summarize_investor_tests(data_table, firm_report, investor):
     Input("tabs", "active_tab"),
     Input("firm-report", "data")
 )
-def render_investor_picture(investor, firm_report):
-    if not pd.isnull(firm_report):
-        investor_pic_path = f"dash_resources//{investor}.png"
-        encoded_image = base64.b64encode(open(investor_pic_path, 'rb').read())
+def render_investor_picture(investor, report_key):
+    if not pd.isnull(report_key):
         logger.info("Rendering investor image")
-        return html.Img(src='data:image/png;base64,{}'.format(encoded_image.decode()), style={'margin-left': 'auto',
+        return html.Img(src='data:image/png;base64,{}'.format(investor_pictures[investor]), style={'margin-left': 'auto',
                                                                                               'margin-right': 'auto',
                                                                                               'display': 'block'})
 
 
+@app.callback(
+    Output("leaderboard-job", "data"),
+    Output("leaderboard-content", "children"),
+    Output("leaderboard-interval", "disabled"),
+    Input("leaderboard-button", "n_clicks"),
+    Input("leaderboard-interval", "n_intervals"),
+    State("leaderboard-market-dropdown", "value"),
+    State("leaderboard-k-input", "value"),
+    State("leaderboard-job", "data")
+)
+def render_leaderboard(n_clicks, n_intervals, market_input, k, job_key):
+    if n_clicks == 0 or pd.isnull(market_input) or pd.isnull(k):
+        return None, None, True
+    if dash.ctx.triggered_id == "leaderboard-button":
+        # Returns at once, the market is ranked in the background and polled by the interval
+        key = f"ranking:{market_input}:{int(k)}:{get_data_version(market_input, data_dir)}"
+        job_key = ranking_jobs.submit_task(key, rank_leaderboard, market_input, int(k))
+    if job_key is None:
+        return None, None, True
+    status = ranking_jobs.get_status(job_key)
+    if status['state'] == 'done':
+        ranking = ranking_jobs.get_result(job_key)
+        return job_key, dash_table.DataTable(id="leaderboard-table",
+                                             columns=[{"name": i, "id": i} for i in ranking.columns],
+                                             data=ranking.to_dict('records'), sort_action='native', page_size=25,
+                                             style_cell={'text-align': 'left'}), True
+    elif status['state'] == 'failed':
+        return job_key, dbc.Alert(f"Failed to rank the market: {status['error']}", color="danger"), True
+    elif status['state'] == 'unknown':
+        return None, dbc.Alert("The ranking has expired, please rank the market again", color="warning"), True
+    else:
+        return job_key, html.Div([dbc.Spinner(size="sm"), " Ranking the market..."]), False
+
+
+@app.server.route('/metrics')
+def metrics():
+    """
+    The stats of the report jobs and data loads, with latency histograms (the number of calls
+    per bucket, keyed by the bucket's upper bound in seconds), the caches' hit rates and the
+    published data generation that the worker reads, as JSON
+    """
+    stats = global_profiler.get_stats()
+    for name_stats in stats.values():
+        name_stats['histogram'] = {f"<={bucket}": count for bucket, count in
+                                   zip(latency_buckets, name_stats['histogram'])}
+    from columnar_store import get_current_generation
+    report_lookups = report_store.hits + report_store.misses
+    return flask.jsonify({
+        'data_generation': get_current_generation(data_dir),
+        'stats': stats,
+        'counters': global_profiler.get_counters(),
+        'hit_rates': {'report_store': report_store.hits / report_lookups if report_lookups else None,
+                      'dataset_cache': global_profiler.get_hit_rate('dataset_cache')},
+        'report_store_size': len(report_store)
+    })
+
+
 if __name__ == '__main__':
     app.run_server()
@@ -0,0 +1,113 @@
+import time
+import numpy as np
+import pandas as pd
+
+from market_data import MarketData
+from market_metrics import MarketMetrics
+from metric_engine import metric_scope
+from utils.logger import get_logger
+from utils.profiling import global_profiler
+
+logger = get_logger(__name__)
+
+default_quantiles = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+def get_discount_factors_sum(growth: np.ndarray, discount: np.ndarray, years: int) -> np.ndarray:
+    """ The sum over t = 1..years of ((1 + growth) / (1 + discount)) ^ t, in closed form """
+    ratio = (1 + growth) / (1 + discount)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(np.isclose(ratio, 1), years, ratio * (1 - ratio ** years) / (1 - ratio))
+
+
+def simulate_dcf(fcff: np.ndarray, net_debt: np.ndarray, shares: np.ndarray, prices: np.ndarray, paths: int=10000,
+                 growth_mean=0.05, growth_std=0.03, discount_mean=0.09, discount_std=0.015,
+                 terminal_growth: float=0.025, years: int=5, quantiles: tuple=default_quantiles,
+                 max_elements: int=1 << 24, seed: int=0) -> dict:
+    '''
+    Value firms with a Monte Carlo discounted cash flow model. Every path draws a growth rate of
+    the FCFF over the forecast years and a discount rate (WACC), and the firm's value is the
+    discounted FCFF of the forecast years plus a Gordon terminal value, less the net debt, per
+    share. The discounted sum is in closed form, so a path costs a few array operations, and the
+    (path x firm) arrays are calculated for a chunk of firms at a time, with at most max_elements
+    values per chunk. The results are reproducible for the same seed and max_elements.
+
+    Parameters
+    ---------
+        fcff, net_debt, shares, prices (np.ndarray): A value per firm, e.g. of MarketMetrics.get_fcff
+        paths (int): The number of simulated paths per firm
+        growth_mean, growth_std, discount_mean, discount_std: The means and standard deviations of
+            the normally distributed rates, scalars or a value per firm
+        terminal_growth (float): The growth rate after the forecast years. Discount rates are kept
+            at least 1% above it
+        years (int): The number of forecast years
+        quantiles (tuple): The quantiles of the intrinsic value to return
+
+    Returns
+    ---------
+        valuation (dict): Maps 'mean' and every quantile (e.g. 'q0.5') to the intrinsic value per
+            share of every firm, 'margin_of_safety' to (median value - price) / median value (NaN
+            when the median value isn't positive) and 'undervalued_probability' to the share of
+            the paths whose value is above the price
+    '''
+    fcff, net_debt, shares, prices = [np.asarray(values, dtype=float).ravel() for values in
+                                      (fcff, net_debt, shares, prices)]
+    firms_num = len(fcff)
+    # The median is always calculated, for the margin of safety
+    quantiles = tuple(sorted(set(quantiles) | {0.5}))
+    rates = {name: np.broadcast_to(np.asarray(values, dtype=float), (firms_num,)) for name, values in
+             [('growth_mean', growth_mean), ('growth_std', growth_std), ('discount_mean', discount_mean),
+              ('discount_std', discount_std)]}
+    chunk_size = max(1, max_elements // max(paths, 1))
+    rng = np.random.default_rng(seed)
+    valuation = {name: np.full(firms_num, np.nan) for name in
+                 ['mean'] + [f"q{q}" for q in quantiles] + ['undervalued_probability']}
+    start_time = time.perf_counter()
+    for start in range(0, firms_num, chunk_size):
+        chunk = slice(start, min(start + chunk_size, firms_num))
+        size = chunk.stop - chunk.start
+        # (path x firm) rates, drawn for the whole chunk at once
+        growth = rates['growth_mean'][chunk] + rates['growth_std'][chunk] * rng.standard_normal((paths, size))
+        discount = rates['discount_mean'][chunk] + rates['discount_std'][chunk] * rng.standard_normal((paths, size))
+        discount = np.maximum(discount, terminal_growth + 0.01)
+        forecast_value = fcff[chunk] * get_discount_factors_sum(growth, discount, years)
+        terminal_value = fcff[chunk] * (1 + growth) ** years * (1 + terminal_growth) / \
+            ((discount - terminal_growth) * (1 + discount) ** years)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = (forecast_value + terminal_value - net_debt[chunk]) / shares[chunk]
+        valuation['mean'][chunk] = values.mean(axis=0)
+        for q, value in zip(quantiles, np.quantile(values, quantiles, axis=0)):
+            valuation[f"q{q}"][chunk] = value
+        undervalued = (values > prices[chunk]).mean(axis=0)
+        valuation['undervalued_probability'][chunk] = np.where(np.isnan(values).any(axis=0) | np.isnan(prices[chunk]),
+                                                               np.nan, undervalued)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        median = valuation['q0.5']
+        valuation['margin_of_safety'] = np.where(median > 0, (median - prices) / median, np.nan)
+    global_profiler.record('simulate_dcf', time.perf_counter() - start_time, rows=firms_num)
+    return valuation
+
+
+def value_market(market: str='us', data_dir: str='data', variant: str='annual', paths: int=10000,
+                 **kwargs) -> pd.DataFrame:
+    '''
+    Value every firm in a market with simulate_dcf, from the FCFF, net debt, shares outstanding
+    and current stock price of MarketMetrics.
+
+    Parameters
+    ---------
+        kwargs: The model's parameters, see simulate_dcf
+
+    Returns
+    ---------
+        valuation (pd.DataFrame): A row per ticker, with its 'fcff', 'price', and the columns of
+            simulate_dcf's valuation
+    '''
+    metrics = MarketMetrics(MarketData(market, data_dir, variant=variant))
+    with np.errstate(all='ignore'), metric_scope(metrics):
+        fcff = metrics.get_fcff()
+        prices = metrics.get_current_stock_price()
+        valuation = simulate_dcf(fcff, metrics.get_net_debt(), metrics.get_shares_outstanding(), prices,
+                                 paths=paths, **kwargs)
+    logger.info(f"Valued {len(metrics.tickers)} firms in market {market} with {paths} paths each")
+    return pd.DataFrame({'ticker': metrics.tickers, 'fcff': fcff, 'price': prices, **valuation})
@@ -0,0 +1,130 @@
+import weakref
+import numpy as np
+import pandas as pd
+
+from Firm import Firm
+from market_data import MarketData, StatementMatrix, align_share_prices
+from metric_engine import invalidate_metrics
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class FirmStore:
+    """
+    The statements and latest share prices of every firm in a market, stored as a struct of
+    arrays: one contiguous (ticker x record x column) float array per statement, with only
+    the columns the metrics use (market_data.statement_columns), and one array per share price
+    column. A firm is a CompactFirm, whose statements are views into these arrays, so keeping
+    thousands of firms resident costs a few arrays instead of thousands of DataFrames.
+
+    Attributes
+    ----------
+    data: MarketData
+        The market's arrays
+    ticker_index: dict
+        Maps each ticker to its index in the arrays
+    """
+    __slots__ = ('data', 'ticker_index', '_records_num', '_incremental_firms')
+
+    def __init__(self, market: str='us', data_dir: str='data', variant: str='annual', depth: int=5):
+        # The store copies the columns it needs, so the whole-market DataFrames aren't kept in the dataset cache
+        self._set_data(MarketData(market, data_dir, depth=depth, variant=variant, keep_cached=False))
+
+    @classmethod
+    def from_market_data(cls, data: MarketData):
+        store = cls.__new__(cls)
+        store._set_data(data)
+        return store
+
+    def _set_data(self, data: MarketData):
+        self.data = data
+        # The live firms whose metrics are memoized, so update_share_prices can invalidate them
+        self._incremental_firms = weakref.WeakSet()
+        self.ticker_index = {ticker: idx for idx, ticker in enumerate(data.tickers)}
+        # The records of every firm are a prefix of its rows, the rest are NaN
+        self._records_num = {report_kind: (~np.isnan(tensor.years)).sum(axis=1)
+                             for report_kind, tensor in data.statements.items()}
+
+    def __len__(self):
+        return len(self.data.tickers)
+
+    def __contains__(self, ticker):
+        return ticker in self.ticker_index
+
+    def __iter__(self):
+        return (self.get_firm(ticker) for ticker in self.data.tickers)
+
+    def get_firm(self, ticker: str, profile: bool=False, incremental: bool=False):
+        if ticker not in self.ticker_index:
+            raise KeyError(f"{ticker} is not in the store of market {self.data.market}")
+        firm = CompactFirm(self, ticker, profile=profile, incremental=incremental)
+        if incremental:
+            self._incremental_firms.add(firm)
+        return firm
+
+    def get_statement_matrix(self, idx: int, report_kind: str) -> StatementMatrix:
+        """ A firm's statement as views into the store's arrays """
+        if report_kind not in self.data.statements:
+            raise ValueError(f"A report named {report_kind} does not exist in the store")
+        tensor = self.data.statements[report_kind]
+        records_num = self._records_num[report_kind][idx]
+        return StatementMatrix.from_arrays(tensor.years[idx, :records_num], tensor.values[idx, :records_num],
+                                           tensor.column_index)
+
+    def update_share_prices(self, curr_share_data: pd.DataFrame):
+        """
+        Replace the share prices of every firm (indexed by ticker, NaN for the firms that are missing),
+        and invalidate the price-dependent metrics of the incremental firms that are still held
+        """
+        self.data.share_prices = align_share_prices(curr_share_data, self.data.tickers)
+        for firm in list(self._incremental_firms):
+            invalidate_metrics(firm, ['curr_share_data'])
+
+
+class CompactFirm(Firm):
+    """
+    A Firm whose statements and share prices are views into a FirmStore, with the same
+    get_*/*_test methods and report as Firm. Its statements hold only the columns the metrics
+    use, and are built as DataFrames only when they're accessed (e.g. firm.income).
+
+    Attributes
+    ----------
+    store: FirmStore
+        The store that holds the firm's arrays
+    """
+    # A weak reference, so the store can track its live incremental firms
+    __slots__ = ('store', '_index', '__weakref__')
+
+    def __init__(self, store: FirmStore, ticker: str, profile: bool=False, incremental: bool=False):
+        self.store = store
+        self._index = store.ticker_index[ticker]
+        super().__init__(ticker, store.data.market, store.data.data_dir, store.data.variant, profile=profile,
+                         incremental=incremental)
+
+    def load_statement(self, statement: str) -> pd.DataFrame:
+        if statement == 'curr_share_data':
+            return pd.DataFrame({column: [values[self._index]] for column, values in
+                                 self.store.data.share_prices.items()})
+        if statement not in self.store.data.statements:
+            # The statements the store doesn't hold (e.g. the cash flow) are read like a Firm's
+            return super().load_statement(statement)
+        matrix = self.get_statement_matrix(statement)
+        report = pd.DataFrame(matrix.values, columns=list(matrix.column_index.keys()))
+        report.insert(0, 'Fiscal Year', matrix.years.astype(int))
+        return report
+
+    def get_statement_matrix(self, report_kind: str) -> StatementMatrix:
+        if report_kind not in self.store.data.statements:
+            return super().get_statement_matrix(report_kind)
+        return self.store.get_statement_matrix(self._index, report_kind)
+
+    def get_share_data(self, column: str):
+        return self.store.data.share_prices[column][self._index]
+
+    def update_share_prices(self, curr_share_data: pd.DataFrame=None):
+        """ Replace the firm's share prices in the store (by default, keep the store's prices) """
+        if curr_share_data is not None:
+            for column, values in self.store.data.share_prices.items():
+                values[self._index] = curr_share_data[column].values[0]
+        invalidate_metrics(self, ['curr_share_data'])
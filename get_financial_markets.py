@@ -1,15 +1,83 @@
 import os
-import simfin as sf
+import json
+import time
+import threading
 
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
 
-sf.set_api_key(api_key=os.getenv('SIMFIN_KEY'))
+MARKETS_CACHE_FILE_NAME = 'markets.json'
+# The markets that SimFin supported when this list was written, used until the list is first downloaded
+default_markets = {'US': 'us', 'Canada': 'ca', 'China': 'cn', 'Germany': 'de', 'Singapore': 'sg', 'Italy': 'it'}
 
+_refresh_lock = threading.Lock()
 
-def get_financial_markets(data_dir: str='data'):
+
+def load_financial_markets(data_dir: str='data') -> dict:
+    """ Load the list of markets from SimFin (it may be downloaded), and cache it in data_dir """
+    # simfin is imported here, so importing this module is fast. Its API key is set once, like the reports'
+    from get_financial_report import _get_simfin, _simfin_lock
+    sf = _get_simfin()
     logger.info("Loading a list of the financial markets")
-    sf.set_data_dir(data_dir)
-    markets_df = sf.load_markets()
-    return {val: key for key, val in markets_df['Market Name'].items()}
+    with _simfin_lock:
+        sf.set_data_dir(data_dir)
+        markets_df = sf.load_markets()
+    markets = {val: key for key, val in markets_df['Market Name'].items()}
+    os.makedirs(data_dir, exist_ok=True)
+    cache_path = os.path.join(data_dir, MARKETS_CACHE_FILE_NAME)
+    with open(cache_path + '.tmp', 'w') as cache_file:
+        json.dump(markets, cache_file)
+    os.replace(cache_path + '.tmp', cache_path)
+    return markets
+
+
+def _refresh_in_background(data_dir: str):
+    if not _refresh_lock.acquire(blocking=False):
+        # Already refreshing
+        return
+
+    def refresh():
+        try:
+            load_financial_markets(data_dir)
+        except Exception as e:
+            logger.warning(f"Failed to refresh the list of the financial markets: {e!r}")
+        finally:
+            _refresh_lock.release()
+
+    threading.Thread(target=refresh, name='markets-refresh', daemon=True).start()
+
+
+def get_financial_markets(data_dir: str='data', refresh_days: float=30, wait: bool=True) -> dict:
+    '''
+    Get the list of markets, from its local cache when there is one. A stale cache is returned
+    at once and refreshed in the background.
+
+    Parameters
+    ---------
+        refresh_days (float): The age of the cache, in days, after which it's refreshed
+        wait (bool): If there is no cache, whether to wait for the list to load. Otherwise,
+            default_markets are returned and the list is loaded in the background
+
+    Returns
+    ---------
+        markets (dict): Maps each market's name to its id
+    '''
+    cache_path = os.path.join(data_dir, MARKETS_CACHE_FILE_NAME)
+    try:
+        with open(cache_path, 'r') as cache_file:
+            markets = json.load(cache_file)
+    except (OSError, ValueError):
+        markets = None
+    if markets is not None:
+        if time.time() - os.path.getmtime(cache_path) > refresh_days * 86400:
+            _refresh_in_background(data_dir)
+        return markets
+    if not wait:
+        _refresh_in_background(data_dir)
+        return dict(default_markets)
+    try:
+        return load_financial_markets(data_dir)
+    except Exception as e:
+        logger.warning(f"Failed to load the list of the financial markets, using the default list: {e!r}")
+        return dict(default_markets)
@@ -1,17 +1,190 @@
 import os
-import simfin as sf
+import time
+import threading
+import numpy as np
 
 from utils.logger import get_logger
+from utils.profiling import global_profiler
 
 logger = get_logger(__name__)
 
-sf.set_api_key(api_key=os.environ.get('SIMFIN_KEY', 'free'))
+_dataset_cache = dict()
+# Guards the lookups and inserts of _dataset_cache and _dataset_locks only, never a parse
+_dataset_cache_lock = threading.Lock()
+# One lock per cache key, so a dataset is parsed once while other datasets are parsed concurrently
+_dataset_locks = dict()
+# simfin's data directory is process-wide, so setting it and loading through simfin are serialized
+_simfin_lock = threading.Lock()
+_simfin_ready = False
 
 
-def get_financial_report(report_kind, ticker, market='us', data_dir='data', variant='annual'):
-    sf.set_data_dir(data_dir)
-    all_firms = sf.load(dataset=report_kind, variant=variant, market=market)
-    all_firms.reset_index(inplace=True)
-    ticker_report = all_firms[all_firms['Ticker'] == ticker]
+def _get_simfin():
+    """ Import simfin and set its API key on first use, so importing this module doesn't import simfin (or pandas) """
+    global _simfin_ready
+    import simfin as sf
+    if not _simfin_ready:
+        sf.set_api_key(api_key=os.environ.get('SIMFIN_KEY', 'free'))
+        _simfin_ready = True
+    return sf
+
+
+class TickerIndexedDataset:
+    """
+    A whole-market SimFin dataset, sorted by ticker, with the row offsets of every ticker.
+    Looking up a single ticker is a dictionary lookup followed by a positional slice,
+    instead of a boolean mask over the whole market.
+
+    Attributes
+    ----------
+    data: pd.DataFrame
+        The market's dataset, sorted by ticker (the original row order is kept within each ticker)
+    mtime: float
+        The modification time of the dataset's file when it was loaded
+    ticker_offsets: dict
+        Maps each ticker to the (start, stop) row range of its records in data
+    """
+    def __init__(self, data, mtime: float):
+        data = data[data['Ticker'].notna()]
+        data = data.sort_values(by='Ticker', kind='mergesort').reset_index(drop=True)
+        tickers, starts = np.unique(data['Ticker'].values.astype(str), return_index=True)
+        stops = np.append(starts[1:], len(data))
+        self.data = data
+        self.mtime = mtime
+        self.ticker_offsets = {ticker: (start, stop) for ticker, start, stop in zip(tickers, starts, stops)}
+
+    def get_ticker_rows(self, ticker: str):
+        start, stop = self.ticker_offsets.get(ticker, (0, 0))
+        # A copy, so callers can't modify the shared dataset
+        return self.data.iloc[start:stop].copy()
+
+    def get_columns(self, columns: list):
+        return self.data[columns]
+
+
+def get_dataset_path(report_kind, market='us', data_dir='data', variant='annual'):
+    return os.path.join(data_dir, f"{market}-{report_kind}-{variant}.csv")
+
+
+def _get_file_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def ensure_dataset_file(report_kind, market='us', data_dir='data', variant='annual', refresh_days: int=30) -> str:
+    """
+    Download a dataset's file through refresh_data if it's missing or older than refresh_days, without
+    parsing it. Used for datasets that are too large to load at once and are read in chunks instead.
+    If the download fails, an existing older file is used.
+    """
+    # Imported here, since the download needs requests
+    from refresh_data import refresh_data
+    path = get_dataset_path(report_kind, market, data_dir, variant)
+    result = refresh_data(data_dir, [market], [(report_kind, variant)], refresh_days=refresh_days)
+    if result['errors']:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Failed to download the {market} {report_kind} ({variant}) dataset: "
+                                    f"{result['errors']}")
+        logger.warning(f"Failed to refresh the {market} {report_kind} ({variant}) dataset, using the existing file")
+    return path
+
+
+def _get_dataset_lock(key) -> threading.Lock:
+    with _dataset_cache_lock:
+        return _dataset_locks.setdefault(key, threading.Lock())
+
+
+def _get_cached_dataset(key, mtime):
+    with _dataset_cache_lock:
+        cached = _dataset_cache.get(key)
+    if cached is not None and mtime is not None and cached.mtime == mtime:
+        return cached
+    return None
+
+
+def _read_dataset_file(report_kind, market='us', data_dir='data', variant='annual', refresh_days: int=30):
+    """ Parse a dataset's file, which simfin downloads first if it's missing or older than refresh_days """
+    path = get_dataset_path(report_kind, market, data_dir, variant)
+    mtime = _get_file_mtime(path)
+    if mtime is not None and time.time() - mtime < refresh_days * 86400:
+        import pandas as pd
+        # The format that sf.load reads, parsed without holding simfin's process-wide data directory
+        return pd.read_csv(path, sep=';', header=0)
+    with _simfin_lock:
+        sf = _get_simfin()
+        sf.set_data_dir(data_dir)
+        return sf.load(dataset=report_kind, variant=variant, market=market, refresh_days=refresh_days)
+
+
+def load_dataset(report_kind, market='us', data_dir='data', variant='annual',
+                 keep_cached: bool=True) -> TickerIndexedDataset:
+    """
+    Load a whole-market dataset through a process-wide cache. The dataset is parsed once per
+    (dataset, variant, market, data_dir), and parsed again only if its file on disk has changed.
+    The 'ttm' variant holds the trailing-twelve-month records derived from the 'quarterly' dataset.
+    With keep_cached=False, a dataset that isn't cached yet is parsed without being kept in the cache
+    (e.g. by callers that copy the columns they need and drop the rest).
+    """
+    key = (report_kind, variant, market, data_dir)
+    # The TTM records are derived from the quarterly records once per load
+    source_variant = 'quarterly' if variant == 'ttm' else variant
+    path = get_dataset_path(report_kind, market, data_dir, source_variant)
+    cached = _get_cached_dataset(key, _get_file_mtime(path))
+    if cached is not None:
+        global_profiler.count('dataset_cache_hit')
+        return cached
+    with _get_dataset_lock(key):
+        # Another thread might have loaded the dataset while this one waited for the key's lock
+        cached = _get_cached_dataset(key, _get_file_mtime(path))
+        if cached is not None:
+            global_profiler.count('dataset_cache_hit')
+            return cached
+        global_profiler.count('dataset_cache_miss')
+        logger.info(f"Loading the {market} {report_kind} ({variant}) dataset")
+        start = time.perf_counter()
+        all_firms = _read_dataset_file(report_kind, market, data_dir, source_variant)
+        all_firms.reset_index(inplace=True)
+        if variant == 'ttm':
+            from ttm import get_ttm_report
+            all_firms = get_ttm_report(all_firms, report_kind)
+        # The file might have been downloaded, so its mtime is read again
+        dataset = TickerIndexedDataset(all_firms, _get_file_mtime(path))
+        global_profiler.record(f"dataset_load:{market}-{report_kind}-{variant}", time.perf_counter() - start,
+                               rows=len(dataset.data))
+        if keep_cached:
+            with _dataset_cache_lock:
+                _dataset_cache[key] = dataset
+        return dataset
+
+
+def clear_dataset_cache():
+    with _dataset_cache_lock:
+        _dataset_cache.clear()
+
+
+def get_ticker_indexed_dataset(report_kind, market='us', data_dir='data', variant='annual', keep_cached: bool=True):
+    """
+    Get a whole-market dataset, read from its columnar store when the store exists and was
+    ingested from the current CSV file, and from the CSV file otherwise (see load_dataset for
+    keep_cached). A store of a published generation is read until the next generation is
+    published, even if the CSV file has changed.
+    """
+    from columnar_store import open_store
+    store = open_store(report_kind, market, data_dir, variant)
+    if store is not None:
+        csv_mtime = _get_file_mtime(get_dataset_path(report_kind, market, data_dir, variant))
+        if store.generation is not None or csv_mtime is None or csv_mtime == store.source_mtime:
+            return store
+        logger.info(f"The columnar store of the {market} {report_kind} ({variant}) dataset is stale, reading the CSV")
+    return load_dataset(report_kind, market, data_dir, variant, keep_cached=keep_cached)
+
+
+def get_financial_report(report_kind, ticker, market='us', data_dir='data', variant='annual',
+                         loader=get_ticker_indexed_dataset):
+    """ A firm's rows of a whole-market dataset, which loader(report_kind, market, data_dir, variant) loads """
+    start = time.perf_counter()
+    ticker_report = loader(report_kind, market, data_dir, variant).get_ticker_rows(ticker)
+    global_profiler.record(f"get_financial_report:{report_kind}", time.perf_counter() - start, rows=len(ticker_report))
     logger.info(f"Got {len(ticker_report)} {report_kind} records for firm {ticker}")
     return ticker_report
@@ -0,0 +1,237 @@
+import numpy as np
+import pandas as pd
+
+from get_financial_report import get_ticker_indexed_dataset
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+statement_columns = {
+    'income': ['Revenue', 'Net Income', 'Net Income (Common)', 'Pretax Income (Loss)',
+               'Income Tax (Expense) Benefit, Net', 'Operating Income (Loss)', 'Depreciation & Amortization'],
+    'balance': ['Total Current Assets', 'Total Current Liabilities', 'Total Assets', 'Total Liabilities',
+                'Total Noncurrent Liabilities', 'Property, Plant & Equipment, Net', 'Retained Earnings',
+                'Short Term Debt', 'Long Term Debt', 'Cash, Cash Equivalents & Short Term Investments', 'Inventories']
+}
+share_columns = ['Close', 'Shares Outstanding']
+
+
+def _read_only(array: np.ndarray) -> np.ndarray:
+    """ A read-only view of array, so a metric that modifies its input in place raises instead of corrupting it """
+    view = array.view()
+    view.setflags(write=False)
+    return view
+
+
+class StatementMatrix:
+    """
+    The annual records of one financial statement of one firm, as a dense (fiscal year x
+    column) matrix of the statement's numeric columns. The rows are sorted from the latest
+    fiscal year backwards, so the reports of the last n years are a slice of the first rows.
+
+    Attributes
+    ----------
+    years: np.ndarray
+        The fiscal years of the rows
+    values: np.ndarray
+        The (fiscal year x column) values, with missing values as 0. Read-only, since the slices
+        that get_latest_data returns are memoized by the metrics and shared between them
+    column_index: dict
+        Maps each column name to its index in values
+    """
+    __slots__ = ('years', 'values', 'column_index')
+
+    def __init__(self, report: pd.DataFrame):
+        report = report.sort_values(by='Fiscal Year', ascending=False, kind='mergesort')
+        columns = report.select_dtypes(include='number').columns
+        self.years = _read_only(report['Fiscal Year'].values)
+        self.values = _read_only(np.nan_to_num(report[columns].values.astype(float), nan=0))
+        self.column_index = {column: idx for idx, column in enumerate(columns)}
+
+    @classmethod
+    def from_arrays(cls, years: np.ndarray, values: np.ndarray, column_index: dict):
+        """ A matrix over existing arrays (e.g. views into a FirmStore), without copying them """
+        matrix = cls.__new__(cls)
+        matrix.years = _read_only(years)
+        matrix.values = _read_only(values)
+        matrix.column_index = column_index
+        return matrix
+
+    @property
+    def latest_year(self):
+        return self.years[0]
+
+    def get_latest_data(self, column: str, years_back: int) -> np.ndarray:
+        """ The column's values from the reports of the last years_back fiscal years, latest first """
+        earliest_year = self.latest_year - years_back
+        # The years are sorted in descending order, so the years > earliest_year are a prefix
+        rows_num = np.searchsorted(-self.years, -earliest_year, side='left')
+        return self.values[:rows_num, self.column_index[column]]
+
+    def get_latest_years(self, years_back: int) -> np.ndarray:
+        """ The fiscal years of the values that get_latest_data returns, latest first """
+        earliest_year = self.latest_year - years_back
+        return self.years[:np.searchsorted(-self.years, -earliest_year, side='left')]
+
+
+class StatementTensor:
+    """
+    The annual records of one financial statement for many firms, as a dense
+    (ticker x record x column) array. For every ticker, the records are sorted from the
+    latest fiscal year backwards, so record 0 is always the firm's latest report.
+
+    Attributes
+    ----------
+    tickers: np.ndarray
+        The tickers, in the order of the tensor's first axis
+    columns: list
+        The statement's columns, in the order of the tensor's last axis
+    values: np.ndarray
+        The (ticker x record x column) values. Missing values in a report are 0 (like
+        Firm.get_latest_annual_data), and records a firm doesn't have are NaN
+    years: np.ndarray
+        The (ticker x record) fiscal years of the records, NaN where a firm has no record
+    dates: np.ndarray
+        The (ticker x record) dates of date_column (e.g. 'Publish Date'), NaT where a firm has
+        no record. None if no date_column was given
+    """
+    def __init__(self, report: pd.DataFrame, tickers: np.ndarray, columns: list, depth: int=5,
+                 date_column: str=None):
+        codes = pd.Index(tickers).get_indexer(report['Ticker'])
+        report = report.assign(code=codes)[codes >= 0]
+        report = report.sort_values(by=['code', 'Fiscal Year'], ascending=[True, False], kind='mergesort')
+        rank = report.groupby('code').cumcount().values
+        if depth is None:
+            # Keep the whole history
+            depth = max(int(rank.max()) + 1 if len(rank) else 1, 1)
+        report = report[rank < depth]
+        rank = rank[rank < depth]
+        codes = report['code'].values
+        values = np.full((len(tickers), depth, len(columns)), np.nan)
+        years = np.full((len(tickers), depth), np.nan)
+        values[codes, rank] = np.nan_to_num(report[columns].values.astype(float), nan=0)
+        years[codes, rank] = report['Fiscal Year'].values
+        dates = None
+        if date_column is not None:
+            dates = np.full((len(tickers), depth), np.datetime64('NaT'), dtype='datetime64[D]')
+            dates[codes, rank] = pd.to_datetime(report[date_column]).values.astype('datetime64[D]')
+        self._set_arrays(tickers, columns, values, years, dates)
+
+    def _set_arrays(self, tickers, columns, values, years, dates=None):
+        self.tickers = tickers
+        self.columns = columns
+        self.column_index = {column: idx for idx, column in enumerate(columns)}
+        self.values = values
+        self.years = years
+        self.dates = dates
+
+    def as_of(self, date, depth: int=5):
+        """
+        The tensor of the records whose date (of date_column) is on or before date, i.e. the
+        records that were available at that point in time. Record 0 is the latest of them.
+        """
+        if self.dates is None:
+            raise ValueError("The tensor was built without a date column")
+        available = self.dates <= np.datetime64(date, 'D')
+        if available.shape[1] < depth:
+            pad = depth - available.shape[1]
+            available = np.pad(available, ((0, 0), (0, pad)), constant_values=False)
+        # A stable sort moves the available records to the front, keeping them latest first
+        order = np.argsort(~available, axis=1, kind='stable')[:, :depth]
+        available = np.take_along_axis(available, order, axis=1)
+        order = np.clip(order, 0, self.years.shape[1] - 1)
+        values = np.where(available[:, :, None], np.take_along_axis(self.values, order[:, :, None], axis=1), np.nan)
+        years = np.where(available, np.take_along_axis(self.years, order, axis=1), np.nan)
+        tensor = StatementTensor.__new__(StatementTensor)
+        tensor._set_arrays(self.tickers, self.columns, values, years)
+        return tensor
+
+    def window(self, column: str, years_back: int):
+        """
+        The column's values of the reports from the last years_back fiscal years of every firm.
+
+        Returns
+        ---------
+            values (np.ndarray): (ticker x record) values, NaN outside of the window
+            mask (np.ndarray): (ticker x record) booleans, True inside of the window
+        """
+        mask = self.years > (self.years[:, :1] - years_back)
+        values = np.where(mask, self.values[:, :, self.column_index[column]], np.nan)
+        return values, mask
+
+
+class MarketData:
+    """
+    The financial statements and latest share prices of every firm in a market, aligned
+    on one universe of tickers: the firms that have income statements, balance sheets
+    and share prices.
+
+    Attributes
+    ----------
+    market: str
+        The market where the firms are traded
+    data_dir: str (default='data')
+        The directory of Simfin's data
+    tickers: np.ndarray
+        The sorted universe of tickers
+    statements: dict
+        Maps a report kind ('income', 'balance') to its StatementTensor
+    share_prices: dict
+        Maps 'Close' and 'Shares Outstanding' to arrays aligned on the tickers
+    variant: str (default='annual')
+        The variant of the statements, 'annual' or 'ttm' (see Firm)
+    """
+    def __init__(self, market: str='us', data_dir: str='data', depth: int=5, variant: str='annual',
+                 keep_cached: bool=True):
+        # With keep_cached=False, the whole-market datasets that aren't cached yet are dropped once
+        # their columns are copied into the arrays, instead of being kept in the process-wide cache
+        reports = load_statement_columns(market, data_dir, variant=variant, keep_cached=keep_cached)
+        curr_share_data = load_latest_share_prices(market, data_dir, keep_cached=keep_cached)
+        tickers = set(curr_share_data.index.dropna())
+        for report in reports.values():
+            tickers &= set(report['Ticker'].dropna())
+        tickers = np.array(sorted(tickers))
+        statements = {report_kind: StatementTensor(report, tickers, statement_columns[report_kind], depth)
+                      for report_kind, report in reports.items()}
+        share_prices = align_share_prices(curr_share_data, tickers)
+        self._set_data(market, data_dir, tickers, statements, share_prices, variant)
+        logger.info(f"Loaded the {variant} data of {len(self.tickers)} firms in market {market}")
+
+    def _set_data(self, market, data_dir, tickers, statements, share_prices, variant='annual'):
+        self.market = market
+        self.variant = variant
+        self.data_dir = data_dir
+        self.tickers = tickers
+        self.statements = statements
+        self.share_prices = share_prices
+
+    @classmethod
+    def from_arrays(cls, market: str, data_dir: str, tickers: np.ndarray, statements: dict, share_prices: dict):
+        """ Market data of already aligned arrays, e.g. the statements and prices as of a past date """
+        data = cls.__new__(cls)
+        data._set_data(market, data_dir, tickers, statements, share_prices)
+        return data
+
+
+def load_statement_columns(market: str='us', data_dir: str='data', extra_columns: list=None,
+                           variant: str='annual', keep_cached: bool=True) -> dict:
+    """ The columns of statement_columns (plus extra_columns) of every firm, by report kind """
+    extra_columns = extra_columns or list()
+    return {report_kind: get_ticker_indexed_dataset(report_kind, market, data_dir, variant,
+                                                    keep_cached=keep_cached).get_columns(
+                ['Ticker', 'Fiscal Year'] + extra_columns + columns)
+            for report_kind, columns in statement_columns.items()}
+
+
+def load_latest_share_prices(market: str='us', data_dir: str='data', keep_cached: bool=True) -> pd.DataFrame:
+    """ The columns of share_columns of the latest share prices, indexed by ticker """
+    curr_share_data = get_ticker_indexed_dataset('shareprices', market, data_dir, variant='latest',
+                                                 keep_cached=keep_cached).get_columns(['Ticker'] + share_columns)
+    # Like Firm, the first share prices record of every ticker is used
+    return curr_share_data.drop_duplicates(subset='Ticker', keep='first').set_index('Ticker')
+
+
+def align_share_prices(curr_share_data: pd.DataFrame, tickers: np.ndarray) -> dict:
+    """ Maps each column of share_columns to an array aligned on tickers, NaN for tickers without share prices """
+    curr_share_data = curr_share_data.reindex(tickers)
+    return {column: curr_share_data[column].values.astype(float) for column in share_columns}
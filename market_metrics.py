@@ -0,0 +1,371 @@
+import numpy as np
+
+from market_data import MarketData
+from metric_engine import metric
+from price_factors import load_price_factors, align_price_factors
+
+
+def _nth_last(values: np.ndarray, mask: np.ndarray, n: int):
+    """ The n-th last value inside every row's window (like values[-n] of a Firm's array), NaN if there is none """
+    idx = mask.sum(axis=1) - n
+    nth_last = np.take_along_axis(values, np.clip(idx, 0, None)[:, None], axis=1)[:, 0]
+    return np.where(idx >= 0, nth_last, np.nan)
+
+
+def _masked_mean(values: np.ndarray, mask: np.ndarray):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(mask, values, 0).sum(axis=1) / mask.sum(axis=1)
+
+
+class MarketMetrics:
+    """
+    Calculates the metrics and tests of Firm for every firm in a market at once. Every
+    method has the same name and arguments as the Firm method it mirrors, but returns an
+    array with a value per ticker (or a (ticker x year) array, where the Firm method
+    returns an array of years, padded with NaN).
+
+    Attributes
+    ----------
+    data: MarketData
+        The market's statements and share prices
+    tickers: np.ndarray
+        The tickers, in the order of the returned arrays
+    """
+    def __init__(self, data: MarketData):
+        self.data = data
+        self.tickers = data.tickers
+        self._metric_cache = None
+        self._price_factors = None
+
+    def _window(self, report_kind: str, column: str, years_back: int):
+        if report_kind not in self.data.statements:
+            raise ValueError(f"A report named {report_kind} does not exist")
+        return self.data.statements[report_kind].window(column, years_back)
+
+    def get_latest_annual_data(self, report_kind: str, column: str, years_back: int):
+        values, mask = self._window(report_kind, column, years_back)
+        if years_back == 1:
+            return values[:, 0]
+        return values
+
+    @metric('income')
+    def get_last_revenues(self, years_back: int=1):
+        return self.get_latest_annual_data(report_kind='income', column='Revenue', years_back=years_back)
+
+    @metric('get_last_revenues')
+    def last_revenue_test(self):
+        return self.get_last_revenues() > (350 * 10 ^ 6)
+
+    @metric('income')
+    def get_last_profits(self, years_back: int=5):
+        return self.get_latest_annual_data(report_kind='income', column='Net Income (Common)', years_back=years_back)
+
+    @metric('income')
+    def positive_last_profits_test(self, years_back: int=5):
+        profits, mask = self._window('income', 'Net Income (Common)', years_back)
+        return np.where(mask, profits, np.inf).min(axis=1) > 0
+
+    @metric('income')
+    def consistent_profits_growth_test(self, years_back: int=5):
+        profits, mask = self._window('income', 'Net Income (Common)', years_back)
+        pair_mask = mask[:, 1:]
+        failed = pair_mask & ((profits[:, :-1] < 0) | (profits[:, 1:] > profits[:, :-1]))
+        return ~failed.any(axis=1)
+
+    @metric('income')
+    def get_profits_growth_rolling_2_years(self):
+        profits, mask = self._window('income', 'Net Income (Common)', 5)
+        return ((profits[:, 0] + _nth_last(profits, mask, 1)) /
+                (_nth_last(profits, mask, 2) + _nth_last(profits, mask, 3))) - 1
+
+    @metric('income')
+    def _profits_growth_array(self, years_back: int=5):
+        profits, mask = self._window('income', 'Net Income (Common)', years_back)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ratio = profits[:, :-1] / profits[:, 1:]
+        percentage = np.where(ratio > 0, ratio - 1, ratio + 1)
+        return percentage, mask[:, 1:]
+
+    @metric('_profits_growth_array')
+    def get_profits_growth_array(self, years_back: int=5):
+        growth, mask = self._profits_growth_array(years_back=years_back)
+        return np.where(mask, growth, np.nan)
+
+    @metric('_profits_growth_array')
+    def get_avg_profit_growth(self, years_back=5):
+        growth, mask = self._profits_growth_array(years_back=years_back)
+        return _masked_mean(growth, mask)
+
+    @metric('consistent_profits_growth_test', 'get_profits_growth_rolling_2_years')
+    def profits_growth_test(self, threshold: float=0.3):
+        return self.consistent_profits_growth_test(years_back=5) & (self.get_profits_growth_rolling_2_years() > threshold)
+
+    @metric('curr_share_data')
+    def get_shares_outstanding(self):
+        return self.data.share_prices['Shares Outstanding']
+
+    @metric('get_shares_outstanding', 'get_last_profits')
+    def get_eps(self):
+        return self.get_last_profits(years_back=1) / self.get_shares_outstanding()
+
+    @metric('curr_share_data')
+    def get_current_stock_price(self):
+        return self.data.share_prices['Close']
+
+    @metric('get_current_stock_price', 'get_eps')
+    def get_earnings_multiplier(self):
+        return self.get_current_stock_price() / self.get_eps()
+
+    @metric('get_earnings_multiplier')
+    def earnings_multiplier_test(self, threshold: float=15.0):
+        return self.get_earnings_multiplier() < threshold
+
+    @metric('balance')
+    def get_current_ratio(self):
+        current_assets = \
+            self.get_latest_annual_data(report_kind='balance', column='Total Current Assets', years_back=1)
+        current_liabilities = \
+            self.get_latest_annual_data(report_kind='balance', column='Total Current Liabilities', years_back=1)
+        return current_assets / current_liabilities
+
+    @metric('get_current_ratio')
+    def current_ratio_test(self, threshold: float=2):
+        return self.get_current_ratio() > threshold
+
+    @metric('balance')
+    def get_shareholders_equity(self, years_back: int=1):
+        total_assets = self.get_latest_annual_data(report_kind='balance', column='Total Assets', years_back=years_back)
+        total_liabilities = \
+            self.get_latest_annual_data(report_kind='balance', column='Total Liabilities', years_back=years_back)
+        return total_assets - total_liabilities
+
+    @metric('balance', 'get_shareholders_equity')
+    def get_equity_multiplier(self):
+        total_assets = self.get_latest_annual_data(report_kind='balance', column='Total Assets', years_back=1)
+        return total_assets / self.get_shareholders_equity(years_back=1)
+
+    @metric('get_earnings_multiplier', 'get_equity_multiplier')
+    def equity_earnings_test(self, threshold: float=22.0):
+        return (self.get_earnings_multiplier() * self.get_equity_multiplier()) < threshold
+
+    @metric('balance')
+    def get_working_capital(self, years_back: int=1):
+        current_assets = \
+            self.get_latest_annual_data(report_kind='balance', column='Total Current Assets', years_back=years_back)
+        current_liabilities = \
+            self.get_latest_annual_data(report_kind='balance', column='Total Current Liabilities', years_back=years_back)
+        return current_assets - current_liabilities
+
+    @metric('get_working_capital')
+    def get_delta_working_capital(self):
+        working_capital = self.get_working_capital(years_back=2)
+        return working_capital[:, 0] - working_capital[:, 1]
+
+    @metric('balance')
+    def get_long_term_liabilities(self):
+        return self.get_latest_annual_data(report_kind='balance', column='Total Noncurrent Liabilities', years_back=1)
+
+    @metric('get_working_capital', 'get_long_term_liabilities')
+    def working_capital_long_term_liabilities_test(self):
+        return self.get_working_capital() > self.get_long_term_liabilities()
+
+    @metric('income')
+    def get_tax_rate(self):
+        pre_tax_income = self.get_latest_annual_data(report_kind='income', column='Pretax Income (Loss)', years_back=1)
+        income_tax_expense = \
+            self.get_latest_annual_data(report_kind='income', column='Income Tax (Expense) Benefit, Net', years_back=1)
+        return ((-1) * income_tax_expense) / pre_tax_income
+
+    @metric('income', 'get_tax_rate')
+    def get_nopat(self):
+        operating_income = \
+            self.get_latest_annual_data(report_kind='income', column='Operating Income (Loss)', years_back=1)
+        return operating_income * (1 - self.get_tax_rate())
+
+    @metric('income', 'balance')
+    def get_capex(self):
+        depreciation_amortization = \
+            self.get_latest_annual_data(report_kind='income', column='Depreciation & Amortization', years_back=1)
+        PPE = self.get_latest_annual_data(report_kind='balance', column='Property, Plant & Equipment, Net', years_back=2)
+        return PPE[:, 0] - PPE[:, 1] + depreciation_amortization
+
+    @metric('income', 'get_nopat', 'get_capex', 'get_delta_working_capital')
+    def get_fcff(self):
+        depreciation_amortization = \
+            self.get_latest_annual_data(report_kind='income', column='Depreciation & Amortization', years_back=1)
+        return self.get_nopat() + depreciation_amortization - self.get_capex() - self.get_delta_working_capital()
+
+    @metric('get_fcff')
+    def positive_fcff_test(self):
+        return self.get_fcff() > 0
+
+    @metric('income', 'balance')
+    def get_roa(self):
+        net_income = self.get_latest_annual_data(report_kind='income', column='Net Income', years_back=1)
+        total_assets = self.get_latest_annual_data(report_kind='balance', column='Total Assets', years_back=1)
+        return net_income / total_assets
+
+    @metric('get_roa')
+    def roa_test(self, threshold: int=0.12):
+        return self.get_roa() > threshold
+
+    @metric('income', 'get_shareholders_equity')
+    def get_average_roe(self, years_back: int=5):
+        net_income, income_mask = self._window('income', 'Net Income', years_back)
+        shareholders_equity = self.get_shareholders_equity(years_back=years_back)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            roe_array = net_income / shareholders_equity
+        return _masked_mean(roe_array, income_mask & ~np.isnan(shareholders_equity))
+
+    @metric('get_average_roe')
+    def roe_5_years_test(self, threshold: int=0.15):
+        return self.get_average_roe() > threshold
+
+    @metric('income')
+    def get_net_income_5_years(self):
+        net_income, mask = self._window('income', 'Net Income', 5)
+        return np.where(mask, net_income, 0).sum(axis=1)
+
+    @metric('get_net_income_5_years', 'get_long_term_liabilities')
+    def net_income_long_liabilities_test(self):
+        return self.get_net_income_5_years() > self.get_long_term_liabilities()
+
+    @metric('income')
+    def get_last_year_net_income_growth(self):
+        net_income = self.get_latest_annual_data(report_kind='income', column='Net Income', years_back=2)
+        return net_income[:, 0] - net_income[:, 1]
+
+    @metric('balance')
+    def get_retained_earnings(self, years_back: int=1):
+        return self.get_latest_annual_data(report_kind='balance', column='Retained Earnings', years_back=years_back)
+
+    @metric('get_last_year_net_income_growth', 'get_retained_earnings')
+    def get_profits_growth_to_surplus(self):
+        return self.get_last_year_net_income_growth() / self.get_retained_earnings()
+
+    @metric('get_profits_growth_to_surplus')
+    def profits_growth_to_surplus_test(self, threshold: float=0.12):
+        return self.get_profits_growth_to_surplus() > threshold
+
+    @metric('get_current_stock_price', 'get_eps')
+    def get_pe_ratio(self):
+        return self.get_current_stock_price() / self.get_eps()
+
+    @metric('get_pe_ratio', 'get_avg_profit_growth')
+    def get_peg_ratio(self):
+        return self.get_pe_ratio() / self.get_avg_profit_growth()
+
+    @metric('get_peg_ratio')
+    def peg_ratio_test(self, threshold: float=1.0):
+        return self.get_peg_ratio() < threshold
+
+    @metric('balance')
+    def get_net_debt(self):
+        short_term_debt = self.get_latest_annual_data(report_kind='balance', column='Short Term Debt', years_back=1)
+        long_term_debt = self.get_latest_annual_data(report_kind='balance', column='Long Term Debt', years_back=1)
+        cash_and_equivalents = self.get_latest_annual_data(report_kind='balance',
+                                                           column='Cash, Cash Equivalents & Short Term Investments',
+                                                           years_back=1)
+        return short_term_debt + long_term_debt - cash_and_equivalents
+
+    @metric('get_net_debt', 'get_shareholders_equity')
+    def get_debt_equity_ratio(self):
+        return self.get_net_debt() / self.get_shareholders_equity()
+
+    @metric('get_debt_equity_ratio')
+    def debt_equity_ratio_test(self, threshold: float=0.8):
+        return self.get_debt_equity_ratio() < threshold
+
+    @metric('get_profits_growth_array')
+    def get_last_profits_growth_rate(self):
+        return self.get_profits_growth_array()[:, 0]
+
+    @metric('get_avg_profit_growth', 'get_last_profits_growth_rate')
+    def lynch_profits_growth_test(self, years_back: int=5):
+        avg_profits_growth = self.get_avg_profit_growth(years_back=years_back)
+        last_profits_growth = self.get_last_profits_growth_rate()
+        return ((avg_profits_growth > 0.2) & (last_profits_growth > 0.2)) | \
+               ((avg_profits_growth > 0.1) & (last_profits_growth > 0.1) & (last_profits_growth > avg_profits_growth))
+
+    @metric('balance')
+    def get_last_inventories(self, years_back: int=2):
+        return self.get_latest_annual_data(report_kind='balance', column='Inventories', years_back=years_back)
+
+    @metric('get_last_revenues', 'get_last_inventories')
+    def get_inventories_revenue_ratio(self, years_back: int=2):
+        return self.get_last_inventories(years_back=years_back) / self.get_last_revenues(years_back=years_back)
+
+    @metric('get_inventories_revenue_ratio')
+    def get_inventories_revenue_growth(self):
+        ratio_array = self.get_inventories_revenue_ratio(years_back=2)
+        return (ratio_array[:, 0] / ratio_array[:, 1]) - 1
+
+    @metric('get_inventories_revenue_growth')
+    def inventories_revenue_growth_test(self, threshold: float=0.05):
+        return self.get_inventories_revenue_growth() < threshold
+
+    @metric('get_last_profits')
+    def get_two_years_profits(self):
+        return self.get_last_profits(years_back=2)
+
+    @metric('positive_last_profits_test')
+    def positive_last_two_profits_test(self):
+        return self.positive_last_profits_test(years_back=2)
+
+    @metric('get_avg_profit_growth', 'get_last_revenues')
+    def lynch_profit_revenue_test(self, years_back: int=5):
+        avg_profits_growth = self.get_avg_profit_growth(years_back=years_back)
+        revenue = self.get_last_revenues(years_back=1)
+        return np.where(avg_profits_growth > 0.2, revenue > (1000 * 10 ^ 6),
+                        (avg_profits_growth > 0) & (revenue > (1900 * 10 ^ 6)))
+
+    @metric('get_current_stock_price', 'get_shares_outstanding')
+    def get_market_cap(self):
+        return self.get_current_stock_price() * self.get_shares_outstanding()
+
+    @metric('get_market_cap')
+    def market_cap_test(self, threshold: int=150000000):
+        return self.get_market_cap() > threshold
+
+    @metric('get_market_cap', 'get_last_revenues')
+    def get_market_cap_revenue(self):
+        return self.get_market_cap() / self.get_last_revenues()
+
+    @metric('get_market_cap_revenue')
+    def market_cap_revenue_test(self, threshold: float=1.5):
+        return self.get_market_cap_revenue() < threshold
+
+    def get_price_factor(self, column: str) -> np.ndarray:
+        """ A factor of the daily share prices of every firm, from the factor table of price_factors.py """
+        if self._price_factors is None:
+            self._price_factors = align_price_factors(load_price_factors(self.data.market, self.data.data_dir),
+                                                      self.tickers)
+        return self._price_factors[column]
+
+    @metric('price_factors')
+    def get_momentum_12_1(self):
+        return self.get_price_factor('momentum_12_1')
+
+    @metric('price_factors')
+    def get_momentum_6m(self):
+        return self.get_price_factor('momentum_6m')
+
+    @metric('price_factors')
+    def get_volatility_1y(self):
+        return self.get_price_factor('volatility_1y')
+
+    @metric('price_factors')
+    def get_max_drawdown_1y(self):
+        return self.get_price_factor('max_drawdown_1y')
+
+    @metric('price_factors')
+    def get_high_52w(self):
+        return self.get_price_factor('high_52w')
+
+    @metric('price_factors')
+    def get_low_52w(self):
+        return self.get_price_factor('low_52w')
+
+    @metric('price_factors')
+    def get_range_position_52w(self):
+        return self.get_price_factor('range_position_52w')
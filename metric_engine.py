@@ -0,0 +1,135 @@
+import inspect
+import functools
+from contextlib import contextmanager
+
+
+def metric(*depends_on: str):
+    """
+    Declare a method as a node of the metric graph. depends_on are the names of the
+    metrics the method uses, or of the datasets it reads directly ('income', 'balance',
+    'cash_flow', 'curr_share_data').
+    While a metric scope is open on the instance, the method's result is memoized per
+    arguments (after applying the defaults), so every metric is calculated only once.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            cache = self._metric_cache
+            if cache is None:
+                return func(self, *args, **kwargs)
+            bound_args = signature.bind(self, *args, **kwargs)
+            bound_args.apply_defaults()
+            key = (func.__name__,) + tuple(bound_args.arguments.values())[1:]
+            try:
+                hash(key)
+            except TypeError:
+                # e.g. an array of thresholds
+                return func(self, *args, **kwargs)
+            if key not in cache:
+                cache[key] = func(self, *args, **kwargs)
+            return cache[key]
+
+        wrapper.depends_on = depends_on
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def metric_scope(obj):
+    """ Memoize obj's metrics until the scope is closed. Nested scopes share the outer scope's results """
+    if obj._metric_cache is not None:
+        yield obj
+        return
+    obj._metric_cache = dict()
+    try:
+        yield obj
+    finally:
+        obj._metric_cache = None
+
+
+def get_metric_graph(cls) -> dict:
+    """ Maps the name of each metric of cls to the names of the metrics and datasets it depends on """
+    return {name: member.depends_on for name, member in inspect.getmembers(cls)
+            if callable(member) and hasattr(member, 'depends_on')}
+
+
+def persist_metrics(obj):
+    """ Memoize obj's metrics from now on, across scopes, until they're invalidated with invalidate_metrics """
+    if obj._metric_cache is None:
+        obj._metric_cache = dict()
+
+
+def get_dependent_metrics(cls, datasets: list) -> set:
+    """ The names of the metrics of cls that depend on any of datasets, directly or through other metrics """
+    graph = get_metric_graph(cls)
+    dependent = set()
+
+    def depends(name, visiting=()):
+        if name in dependent or name in datasets:
+            return True
+        if name not in graph or name in visiting:
+            return False
+        return any(depends(dependency, visiting + (name,)) for dependency in graph[name])
+
+    for name in graph:
+        if depends(name):
+            dependent.add(name)
+    return dependent
+
+
+def invalidate_metrics(obj, datasets: list):
+    """ Forget the memoized results of obj's metrics that depend on any of datasets, and keep the rest """
+    if obj._metric_cache is None:
+        return
+    dependent = get_dependent_metrics(type(obj), datasets)
+    for key in [key for key in obj._metric_cache if key[0] in dependent]:
+        del obj._metric_cache[key]
+
+
+def get_required_metrics(cls, tests: dict, include_display: bool=True) -> list:
+    """
+    The metrics of cls that are needed to run and display tests, ordered so each
+    metric comes after the metrics it depends on.
+
+    Parameters
+    ---------
+        cls: A class with metric methods (e.g. Firm)
+        tests (dict): Tests in the format of config.display_tests
+        include_display (bool): If False, only the metrics that are needed to run the tests
+    """
+    graph = get_metric_graph(cls)
+    required = list()
+
+    def visit(name):
+        if name in required or name not in graph:
+            return
+        for dependency in graph[name]:
+            visit(dependency)
+        required.append(name)
+
+    for investor in tests.keys():
+        for test in tests[investor]:
+            if 'rule' in tests[investor][test]:
+                # Imported here since rules evaluate metrics within a metric_scope
+                from rules import compile_rule
+                for method_name in compile_rule(tests[investor][test]['rule']).metric_methods:
+                    visit(method_name)
+            else:
+                visit('_'.join(test.split()) + '_test')
+            if include_display:
+                for display_func in tests[investor][test]['display_functions']:
+                    visit(display_func)
+    return required
+
+
+def get_required_datasets(cls, tests: dict) -> list:
+    """ The datasets (leaves of the metric graph) that are read to run and display tests """
+    graph = get_metric_graph(cls)
+    required_datasets = list()
+    for name in get_required_metrics(cls, tests):
+        for dependency in graph[name]:
+            if dependency not in graph and dependency not in required_datasets:
+                required_datasets.append(dependency)
+    return required_datasets
@@ -0,0 +1,171 @@
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+from get_financial_report import get_dataset_path, _get_file_mtime, _get_simfin, _simfin_lock
+from market_data import MarketData
+from market_metrics import MarketMetrics
+from metric_engine import metric_scope, get_metric_graph
+from utils.logger import get_logger
+from utils.profiling import global_profiler
+
+logger = get_logger(__name__)
+
+group_levels = ['sector', 'industry']
+
+_index_cache = dict()
+_index_cache_lock = threading.Lock()
+
+
+def get_scalar_metric_names(cls=MarketMetrics) -> list:
+    """ The get_* metrics of cls that can be called without arguments """
+    return [name for name in get_metric_graph(cls) if name.startswith('get_')]
+
+
+def load_company_groups(market: str='us', data_dir: str='data') -> pd.DataFrame:
+    """ The sector and industry of every firm in a market (from SimFin's companies and industries datasets), indexed by ticker """
+    sf = _get_simfin()
+    with _simfin_lock:
+        sf.set_data_dir(data_dir)
+        companies = sf.load_companies(market=market)
+        industries = sf.load_industries()
+    groups = companies[['IndustryId']].join(industries[['Sector', 'Industry']], on='IndustryId')
+    groups = groups[groups.index.notna()]
+    return groups[~groups.index.duplicated(keep='first')].rename(columns={'Sector': 'sector', 'Industry': 'industry'})
+
+
+class PercentileIndex:
+    """
+    The sorted distribution of every scalar metric within every peer group (sector or industry)
+    of a market. The values of a metric are sorted once by (group, value) into one array, with
+    the row range of every group, so a percentile is a binary search within the group's range
+    instead of a regroup of the whole market.
+
+    Attributes
+    ----------
+    level: str
+        The peer groups, 'sector' or 'industry'
+    groups: dict
+        Maps each ticker to its group
+    sorted_values: dict
+        Maps each metric to its non-NaN values, sorted by group and then by value
+    group_offsets: dict
+        Maps each metric to a dict of group -> (start, stop) range in sorted_values
+    """
+    def __init__(self, metrics: MarketMetrics, groups: pd.Series, level: str='industry', metric_names: list=None):
+        if level not in group_levels:
+            raise ValueError(f"Peer groups are one of {group_levels}, not {level}")
+        self.level = level
+        ticker_groups = groups.reindex(metrics.tickers).values
+        self.groups = {ticker: group for ticker, group in zip(metrics.tickers, ticker_groups) if not pd.isnull(group)}
+        has_group = ~pd.isnull(ticker_groups)
+        group_codes, group_names = pd.factorize(ticker_groups[has_group])
+        self.sorted_values = dict()
+        self.group_offsets = dict()
+        with np.errstate(all='ignore'), metric_scope(metrics):
+            for name in metric_names or get_scalar_metric_names(type(metrics)):
+                values = np.asarray(getattr(metrics, name)(), dtype=float)
+                if values.shape != (len(metrics.tickers),):
+                    # (ticker x year) metrics have no single value per firm
+                    continue
+                values = values[has_group]
+                valid = ~np.isnan(values)
+                codes = group_codes[valid]
+                # The last key of np.lexsort is the primary one
+                order = np.lexsort((values[valid], codes))
+                self.sorted_values[name] = values[valid][order]
+                starts = np.searchsorted(codes[order], np.arange(len(group_names)), side='left')
+                stops = np.searchsorted(codes[order], np.arange(len(group_names)), side='right')
+                self.group_offsets[name] = {group: (start, stop) for group, start, stop in
+                                            zip(group_names, starts, stops) if stop > start}
+
+    def get_group_values(self, metric_name: str, group) -> np.ndarray:
+        """ The sorted values of a metric within a group """
+        if metric_name not in self.sorted_values:
+            raise ValueError(f"A metric named {metric_name} is not in the index")
+        start, stop = self.group_offsets[metric_name].get(group, (0, 0))
+        return self.sorted_values[metric_name][start:stop]
+
+    def get_percentile(self, metric_name: str, group, value: float) -> float:
+        """
+        The percentile (0-100) of value within the group's values of the metric, counting ties as
+        half below and half above. NaN if the value is NaN or the group has no values.
+        """
+        group_values = self.get_group_values(metric_name, group)
+        if pd.isnull(value) or not len(group_values):
+            return np.nan
+        below = np.searchsorted(group_values, value, side='left')
+        below_or_equal = np.searchsorted(group_values, value, side='right')
+        return 100 * (below + below_or_equal) / (2 * len(group_values))
+
+    def get_percentiles(self, metric_name: str, groups: np.ndarray, values: np.ndarray) -> np.ndarray:
+        """ The vectorized version of get_percentile, a binary search per group """
+        groups = np.asarray(groups, dtype=object)
+        values = np.asarray(values, dtype=float)
+        percentiles = np.full(len(values), np.nan)
+        for group in self.group_offsets[metric_name].keys():
+            in_group = (groups == group) & ~np.isnan(values)
+            group_values = self.get_group_values(metric_name, group)
+            below = np.searchsorted(group_values, values[in_group], side='left')
+            below_or_equal = np.searchsorted(group_values, values[in_group], side='right')
+            percentiles[in_group] = 100 * (below + below_or_equal) / (2 * len(group_values))
+        return percentiles
+
+    def get_ticker_group(self, ticker: str):
+        return self.groups.get(ticker)
+
+
+def _get_source_mtimes(market: str, data_dir: str, variant: str) -> tuple:
+    paths = [get_dataset_path(report_kind, market, data_dir, 'quarterly' if variant == 'ttm' else variant)
+             for report_kind in ['income', 'balance', 'cashflow']]
+    paths += [get_dataset_path('shareprices', market, data_dir, 'latest'),
+              os.path.join(data_dir, f"{market}-companies.csv"), os.path.join(data_dir, 'industries.csv')]
+    return tuple(_get_file_mtime(path) for path in paths)
+
+
+def _get_cached_index(market: str, data_dir: str, level: str, variant: str) -> tuple:
+    """ The percentile index of a market and the MarketMetrics it was built from, through the process-wide cache """
+    key = (market, data_dir, level, variant)
+    with _index_cache_lock:
+        cached = _index_cache.get(key)
+        mtimes = _get_source_mtimes(market, data_dir, variant)
+        if cached is not None and None not in mtimes and cached[0] == mtimes:
+            return cached[1], cached[2]
+        global_profiler.count('percentile_index_miss')
+        metrics = MarketMetrics(MarketData(market, data_dir, variant=variant))
+        groups = load_company_groups(market, data_dir)[level]
+        index = PercentileIndex(metrics, groups, level)
+        logger.info(f"Built the {level} percentile index of market {market} over {len(index.groups)} firms")
+        # sf.load might have downloaded the files, so their mtimes are read again
+        _index_cache[key] = (_get_source_mtimes(market, data_dir, variant), index, metrics)
+        return index, metrics
+
+
+def get_percentile_index(market: str='us', data_dir: str='data', level: str='industry',
+                         variant: str='annual') -> PercentileIndex:
+    """
+    Get a market's percentile index through a process-wide cache. The index is built once per
+    load of the market's data, and built again only if one of its datasets' files has changed.
+    """
+    return _get_cached_index(market, data_dir, level, variant)[0]
+
+
+def get_market_percentiles(market: str='us', data_dir: str='data', level: str='industry',
+                           variant: str='annual') -> pd.DataFrame:
+    '''
+    The percentile of every firm's scalar metrics within its sector or industry.
+
+    Returns
+    ---------
+        percentiles (pd.DataFrame): A row per ticker, with its group and a column per metric
+            (named like the metric, e.g. 'get_roa'), with NaN for firms without a group or a value
+    '''
+    # The metrics are cached with the index, so the market's data is loaded once for both
+    index, metrics = _get_cached_index(market, data_dir, level, variant)
+    groups = np.array([index.get_ticker_group(ticker) for ticker in metrics.tickers], dtype=object)
+    percentiles = pd.DataFrame({'ticker': metrics.tickers, level: groups})
+    with np.errstate(all='ignore'), metric_scope(metrics):
+        for name in index.sorted_values.keys():
+            percentiles[name] = index.get_percentiles(name, groups, getattr(metrics, name)())
+    return percentiles
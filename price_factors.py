@@ -0,0 +1,225 @@
+import os
+import sys
+import time
+import threading
+import numpy as np
+import pandas as pd
+
+from get_financial_report import TickerIndexedDataset, get_dataset_path, _get_file_mtime
+from columnar_store import get_store_path, write_store, open_store
+from utils.logger import get_logger
+from utils.profiling import global_profiler
+
+logger = get_logger(__name__)
+
+trading_days_per_year = 252
+trading_days_per_month = 21
+factor_columns = ['momentum_12_1', 'momentum_6m', 'volatility_1y', 'max_drawdown_1y', 'high_52w', 'low_52w',
+                  'range_position_52w']
+# The factor table is stored like a dataset, as data/columnar/<market>-pricefactors-daily
+FACTORS_DATASET = 'pricefactors'
+FACTORS_VARIANT = 'daily'
+
+_recompute_lock = threading.Lock()
+
+
+def get_price_windows(tickers: np.ndarray, days: np.ndarray, prices: np.ndarray, window: int):
+    '''
+    Arrange the last window prices of every ticker in a dense (ticker x day) matrix.
+
+    Returns
+    ---------
+        tickers (np.ndarray): The tickers, in the order of the matrix's rows
+        last_days (np.ndarray): The date of every ticker's last price
+        matrix (np.ndarray): The prices, oldest first, with the latest price in the last column.
+            NaN-padded on the left for tickers with a shorter history
+    '''
+    codes, unique_tickers = pd.factorize(tickers)
+    order = np.lexsort((days, codes))
+    codes, days, prices = codes[order], days[order], prices[order]
+    counts = np.bincount(codes, minlength=len(unique_tickers))
+    ends = np.cumsum(counts)
+    # 0 for every ticker's latest price, 1 for the one before it, etc.
+    from_end = np.repeat(ends, counts) - 1 - np.arange(len(codes))
+    keep = from_end < window
+    matrix = np.full((len(unique_tickers), window), np.nan)
+    matrix[codes[keep], window - 1 - from_end[keep]] = prices[keep]
+    return np.asarray(unique_tickers), days[ends - 1], matrix
+
+
+def get_window_factors(matrix: np.ndarray) -> dict:
+    """
+    The factors of every row of a (ticker x day) price matrix, latest price last, with window
+    operations along the days: a year of returns, the running maximum for the drawdown, and
+    the range of the last 52 weeks. Factors that need a longer history than a ticker has are NaN.
+    """
+    last = matrix[:, -1]
+    with np.errstate(all='ignore'):
+        log_returns = np.diff(np.log(matrix), axis=1)
+        returns_num = np.sum(~np.isnan(log_returns), axis=1)
+        deviations = log_returns - np.nansum(log_returns, axis=1, keepdims=True) / returns_num[:, None]
+        # The annualized standard deviation of the daily returns, of tickers with at least a month of returns
+        volatility = np.where(returns_num >= trading_days_per_month,
+                              np.sqrt(np.nansum(deviations ** 2, axis=1) / (returns_num - 1) * trading_days_per_year),
+                              np.nan)
+        # np.fmax ignores NaN, so the running maximum starts at every ticker's first price
+        drawdowns = matrix / np.fmax.accumulate(matrix, axis=1) - 1
+        high = np.nanmax(matrix, axis=1)
+        low = np.nanmin(matrix, axis=1)
+        return {
+            'momentum_12_1': matrix[:, -1 - trading_days_per_month] / matrix[:, -1 - trading_days_per_year] - 1,
+            'momentum_6m': last / matrix[:, -1 - trading_days_per_year // 2] - 1,
+            'volatility_1y': volatility,
+            'max_drawdown_1y': np.nanmin(drawdowns, axis=1),
+            'high_52w': high,
+            'low_52w': low,
+            'range_position_52w': np.where(high > low, (last - low) / (high - low), np.nan)
+        }
+
+
+def _get_chunk_factors(chunk: pd.DataFrame, window: int) -> pd.DataFrame:
+    tickers, last_days, matrix = get_price_windows(chunk['Ticker'].values.astype(str),
+                                                   chunk['Date'].values.astype('datetime64[D]'),
+                                                   chunk['Adj. Close'].values.astype(float), window)
+    factors = pd.DataFrame({'Ticker': tickers, 'Date': last_days.astype(str), 'Adj. Close': matrix[:, -1]})
+    for column, values in get_window_factors(matrix).items():
+        factors[column] = values
+    return factors
+
+
+def ensure_daily_share_prices(market: str='us', data_dir: str='data') -> str:
+    """
+    The path of the daily shareprices dataset, which refresh_data.py keeps up to date with the
+    other datasets. It's downloaded through refresh_data only if it's missing.
+    """
+    path = get_dataset_path('shareprices', market, data_dir, 'daily')
+    if not os.path.exists(path):
+        # Imported here, since the download needs requests
+        from refresh_data import refresh_data
+        result = refresh_data(data_dir, [market], [('shareprices', 'daily')])
+        if result['errors']:
+            raise FileNotFoundError(f"Failed to download the daily share prices of market {market}: {result['errors']}")
+    return path
+
+
+def compute_price_factors(market: str='us', data_dir: str='data', as_of: str=None,
+                          chunksize: int=10 ** 6) -> pd.DataFrame:
+    '''
+    Compute the price factors of every ticker by streaming the daily shareprices dataset in
+    chunks. SimFin's daily dataset is grouped by ticker, so every chunk holds complete
+    histories apart from its last ticker, whose rows are carried over to the next chunk. Only
+    the last year of every history is kept, as one (ticker x day) matrix per chunk, and the
+    factors are calculated over its rows at once.
+
+    Parameters
+    ---------
+        as_of (str): Optional date, the factors are calculated from the prices until it
+
+    Returns
+    ---------
+        factors (pd.DataFrame): A row per ticker, with the 'Date' and 'Adj. Close' of its last
+            price and a column per factor of factor_columns
+    '''
+    path = ensure_daily_share_prices(market, data_dir)
+    # A year of returns needs one more price
+    window = trading_days_per_year + 1
+    start = time.perf_counter()
+    factor_list = list()
+    done_tickers = set()
+    carry = None
+    for chunk in pd.read_csv(path, sep=';', usecols=['Ticker', 'Date', 'Adj. Close'], chunksize=chunksize):
+        chunk = chunk[chunk['Ticker'].notna()]
+        if as_of is not None:
+            chunk = chunk[chunk['Date'].values.astype('datetime64[D]') <= np.datetime64(as_of, 'D')]
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        if not len(chunk):
+            continue
+        is_last_ticker = chunk['Ticker'].values == chunk['Ticker'].values[-1]
+        # Only the last window prices of the carried over ticker are used
+        carry = chunk[is_last_ticker].sort_values(by='Date', kind='mergesort').iloc[-window:]
+        complete = chunk[~is_last_ticker]
+        if not len(complete):
+            continue
+        chunk_tickers = set(complete['Ticker'].unique())
+        if not done_tickers.isdisjoint(chunk_tickers):
+            raise ValueError(f"The daily share prices in {path} are not grouped by ticker")
+        done_tickers |= chunk_tickers
+        factor_list.append(_get_chunk_factors(complete, window))
+    if carry is not None and len(carry):
+        if carry['Ticker'].values[0] in done_tickers:
+            raise ValueError(f"The daily share prices in {path} are not grouped by ticker")
+        factor_list.append(_get_chunk_factors(carry, window))
+    factors = pd.concat(factor_list, ignore_index=True) if factor_list else \
+        pd.DataFrame(columns=['Ticker', 'Date', 'Adj. Close'] + factor_columns)
+    global_profiler.record('compute_price_factors', time.perf_counter() - start, rows=len(factors))
+    logger.info(f"Computed the price factors of {len(factors)} tickers in market {market}")
+    return factors
+
+
+def store_price_factors(market: str='us', data_dir: str='data', as_of: str=None, chunksize: int=10 ** 6) -> str:
+    """
+    Compute the price factors and persist them as a columnar store with a ticker index, which
+    Firm and MarketMetrics read without reading the daily history again.
+
+    Returns
+    ---------
+        path (str): The path of the written store
+    """
+    source_mtime = _get_file_mtime(get_dataset_path('shareprices', market, data_dir, 'daily'))
+    factors = TickerIndexedDataset(compute_price_factors(market, data_dir, as_of, chunksize), source_mtime)
+    path = get_store_path(FACTORS_DATASET, market, data_dir, FACTORS_VARIANT)
+    write_store(factors.data, factors.ticker_offsets, path, source_mtime)
+    return path
+
+
+def is_stale(factors, market: str='us', data_dir: str='data') -> bool:
+    """ Whether a factor table was computed from another version of the daily shareprices file than the current one """
+    source_mtime = _get_file_mtime(get_dataset_path('shareprices', market, data_dir, 'daily'))
+    return source_mtime is not None and source_mtime != factors.source_mtime
+
+
+def load_price_factors(market: str='us', data_dir: str='data', recompute: bool=True):
+    """
+    The persisted factor table of a market (a ColumnarDataset), None if it was never stored.
+    A table that was computed before the daily shareprices file was refreshed is computed again,
+    or raises a ValueError if recompute is False.
+    """
+    factors = open_store(FACTORS_DATASET, market, data_dir, FACTORS_VARIANT)
+    if factors is None:
+        logger.warning(f"The price factors of market {market} weren't computed, run price_factors.py {market} {data_dir}")
+        return None
+    if not is_stale(factors, market, data_dir):
+        return factors
+    if not recompute:
+        raise ValueError(f"The price factors of market {market} are older than its daily share prices, "
+                         f"run price_factors.py {market} {data_dir}")
+    with _recompute_lock:
+        # Another thread might have computed them while this one waited
+        factors = open_store(FACTORS_DATASET, market, data_dir, FACTORS_VARIANT)
+        if is_stale(factors, market, data_dir):
+            logger.info(f"The price factors of market {market} are older than its daily share prices, computing them again")
+            store_price_factors(market, data_dir)
+            factors = open_store(FACTORS_DATASET, market, data_dir, FACTORS_VARIANT)
+    return factors
+
+
+def get_price_factors_dataset(market: str='us', data_dir: str='data'):
+    """ The persisted factor table of a market, or an empty table if it was never stored, so every ticker has no factors """
+    factors = load_price_factors(market, data_dir)
+    if factors is None:
+        return TickerIndexedDataset(pd.DataFrame(columns=['Ticker', 'Date', 'Adj. Close'] + factor_columns), None)
+    return factors
+
+
+def align_price_factors(factors, tickers: np.ndarray) -> dict:
+    """ Maps each column of factor_columns to an array aligned on tickers, NaN for tickers without factors """
+    if factors is None:
+        return {column: np.full(len(tickers), np.nan) for column in factor_columns}
+    factors_df = factors.get_columns(['Ticker'] + factor_columns).set_index('Ticker').reindex(tickers)
+    return {column: factors_df[column].values.astype(float) for column in factor_columns}
+
+
+if __name__ == '__main__':
+    # Usage: python price_factors.py [market] [data_dir]
+    store_price_factors(*sys.argv[1:3])
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+from Firm import Firm
+from market_data import MarketData
+from market_metrics import MarketMetrics
+from rules import compile_rule
+from screener import get_test_results
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Metric expressions that break ties between equal scores, in order, and whether lower values rank first
+default_tie_breakers = [('earnings_multiplier', True), ('average_roe', False)]
+
+
+def get_pass_rates(test_results: dict) -> dict:
+    """ Maps each investor to the investor_test_pass_rate of every ticker """
+    return {investor: np.mean(np.column_stack(list(investor_results.values())), axis=1)
+            for investor, investor_results in test_results.items()}
+
+
+def get_composite_scores(pass_rates: dict, weights: dict=None) -> np.ndarray:
+    """ The weighted mean of the investors' pass rates (by default, every investor has the same weight) """
+    weights = weights or {investor: 1 for investor in pass_rates.keys()}
+    total_weight = sum(weights.values())
+    return sum(pass_rates[investor] * weight for investor, weight in weights.items()) / total_weight
+
+
+def select_top_k(scores: np.ndarray, tie_values: list, k: int) -> np.ndarray:
+    """
+    The indices of the k best scores, best first. Ties are broken by tie_values, arrays where
+    lower is better (NaN ranks last). np.argpartition selects the candidates in linear time:
+    the k best scores plus every score that ties with the k-th one. Only those are sorted.
+    """
+    if k >= len(scores):
+        candidates = np.arange(len(scores))
+    else:
+        kth_score = -np.partition(-scores, k - 1)[k - 1]
+        candidates = np.flatnonzero(scores >= kth_score)
+    # np.lexsort sorts by the last key first, and puts NaN last
+    keys = [values[candidates] for values in reversed(tie_values)] + [-scores[candidates]]
+    return candidates[np.lexsort(keys)][:k]
+
+
+def rank_market(market: str='us', data_dir: str='data', k: int=50, weights: dict=None,
+                tie_breakers: list=default_tie_breakers, variant: str='annual', with_reports: bool=True):
+    '''
+    Rank every firm in a market by a composite score, the weighted mean of the investors'
+    pass rates, and return the top k. The tests and tie breakers are calculated as arrays over
+    the whole market, and firm reports (with their related values) are generated only for the
+    top k firms.
+
+    Parameters
+    ---------
+        weights (dict): Optional weight of every investor in the score
+        tie_breakers (list): (metric expression, ascending) pairs, e.g. ('earnings_multiplier', True),
+            that break ties between equal scores, in order
+        with_reports (bool): Whether to generate the firm reports of the top k firms
+
+    Returns
+    ---------
+        ranking (pd.DataFrame): A row per top firm, best first, with its rank, score, every investor's
+            pass rate and the values of the tie breakers
+        reports (dict): Maps the ticker of every top firm to its report (None if the report failed).
+            Empty if not with_reports
+    '''
+    metrics = MarketMetrics(MarketData(market, data_dir, variant=variant))
+    test_results = get_test_results(metrics)
+    pass_rates = get_pass_rates(test_results)
+    scores = get_composite_scores(pass_rates, weights)
+    with np.errstate(all='ignore'):
+        tie_values = {expression: np.asarray(compile_rule(expression).evaluate(metrics), dtype=float)
+                      for expression, _ in tie_breakers}
+    winners = select_top_k(scores, [tie_values[expression] if ascending else -tie_values[expression]
+                                    for expression, ascending in tie_breakers], k)
+    ranking = pd.DataFrame({'rank': np.arange(1, len(winners) + 1), 'ticker': metrics.tickers[winners],
+                            'score': scores[winners]})
+    for investor, investor_pass_rates in pass_rates.items():
+        ranking[investor] = investor_pass_rates[winners]
+    for expression, values in tie_values.items():
+        ranking[expression] = values[winners]
+    logger.info(f"Ranked {len(metrics.tickers)} firms in market {market}, the top {len(winners)} were selected")
+    reports = dict()
+    if with_reports:
+        for ticker in ranking['ticker']:
+            try:
+                reports[ticker] = Firm(ticker=ticker, market=market, data_dir=data_dir,
+                                       variant=variant).generate_firm_report()
+            except Exception as e:
+                logger.warning(f"Failed to generate the report of {ticker}: {e!r}")
+                reports[ticker] = None
+    return ranking, reports
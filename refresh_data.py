@@ -0,0 +1,212 @@
+import os
+import time
+import shutil
+import zipfile
+import argparse
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from columnar_store import INGESTED_DATASETS
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+SIMFIN_BULK_URL = 'https://simfin.com/api/bulk'
+STAGING_DIR_NAME = '.refresh'
+supported_markets = ['us', 'ca', 'de', 'cn', 'sg', 'it']
+# The datasets of the reports, and the daily share prices of the price factors and the backtests
+refreshed_datasets = INGESTED_DATASETS + [('shareprices', 'daily')]
+
+
+class DownloadError(Exception):
+    pass
+
+
+def get_dataset_name(dataset: str, variant: str, market: str) -> str:
+    return f"{market}-{dataset}-{variant}"
+
+
+def download_file(session: requests.Session, url: str, params: dict, path: str, retries: int=3,
+                  backoff: float=1.0, chunk_size: int=1 << 20, timeout: float=60) -> str:
+    """
+    Download a file, resuming a partial download of an earlier attempt (or an earlier run)
+    with an HTTP Range request. The partial file is kept as path + '.part' and renamed to
+    path once it's complete. The ETag (or Last-Modified) of the partial file is sent as
+    If-Range, so a file that changed on the server is downloaded again from the start.
+    """
+    part_path = path + '.part'
+    validator_path = part_path + '.validator'
+    for attempt in range(retries + 1):
+        try:
+            headers = dict()
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if offset:
+                headers['Range'] = f"bytes={offset}-"
+                if os.path.exists(validator_path):
+                    with open(validator_path, 'r') as validator_file:
+                        headers['If-Range'] = validator_file.read()
+            with session.get(url, params=params, headers=headers, stream=True, timeout=timeout) as response:
+                if response.status_code == 416:
+                    # The partial file is already complete
+                    break
+                if response.status_code == 400:
+                    raise DownloadError(f"The server rejected the request of {url}: {response.text[:200]}")
+                response.raise_for_status()
+                if response.status_code != 206:
+                    # A full response, the download starts over
+                    offset = 0
+                validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+                if validator is not None:
+                    with open(validator_path, 'w') as validator_file:
+                        validator_file.write(validator)
+                expected_size = response.headers.get('Content-Length')
+                expected_size = offset + int(expected_size) if expected_size is not None else None
+                with open(part_path, 'ab' if offset else 'wb') as part_file:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        part_file.write(chunk)
+            if expected_size is not None and os.path.getsize(part_path) < expected_size:
+                raise requests.RequestException(f"The download of {url} ended after {os.path.getsize(part_path)} "
+                                               f"of {expected_size} bytes")
+            break
+        except requests.RequestException as e:
+            status_code = getattr(getattr(e, 'response', None), 'status_code', None)
+            if attempt == retries or (status_code is not None and status_code < 500 and status_code != 429):
+                raise DownloadError(f"The download of {url} failed: {e}")
+            logger.warning(f"The download of {url} failed ({e}), retrying ({attempt + 1}/{retries})")
+            time.sleep(backoff * 2 ** attempt)
+    os.replace(part_path, path)
+    if os.path.exists(validator_path):
+        os.remove(validator_path)
+    return path
+
+
+def extract_dataset(zip_path: str, name: str, staging_dir: str) -> str:
+    """ Extract the dataset's CSV file from its zip file into the staging directory """
+    csv_name = f"{name}.csv"
+    with zipfile.ZipFile(zip_path, 'r') as zip_file:
+        members = [member for member in zip_file.namelist() if os.path.basename(member) == csv_name]
+        if not members:
+            raise DownloadError(f"{zip_path} does not contain {csv_name}")
+        tmp_path = os.path.join(staging_dir, csv_name + '.tmp')
+        with zip_file.open(members[0]) as source, open(tmp_path, 'wb') as target:
+            shutil.copyfileobj(source, target)
+    csv_path = os.path.join(staging_dir, csv_name)
+    os.replace(tmp_path, csv_path)
+    os.remove(zip_path)
+    return csv_path
+
+
+def is_fresh(path: str, refresh_days: float) -> bool:
+    return refresh_days > 0 and os.path.exists(path) and time.time() - os.path.getmtime(path) < refresh_days * 86400
+
+
+def refresh_data(data_dir: str='data', markets: list=None, datasets: list=None, workers: int=4,
+                 base_url: str=SIMFIN_BULK_URL, api_key: str=None, retries: int=3, backoff: float=1.0,
+                 refresh_days: float=0) -> dict:
+    '''
+    Download SimFin's bulk datasets of several markets concurrently, and swap them into data_dir.
+    The files are downloaded and extracted into a staging directory under data_dir first. Once
+    all the datasets of a market are ready, each of them is moved into data_dir with os.replace, so
+    a reader sees either the old or the new version of a file, never a half-written one. The files
+    are replaced one at a time, so a reader that opens several of a market's files during the swap
+    may mix old and new datasets (readers that need a consistent set read a published generation of
+    columnar stores, see columnar_store.publish_generation). A market whose download failed keeps
+    its old files, and its partial downloads are resumed by the next refresh.
+
+    Parameters
+    ---------
+        markets (list): The markets to refresh (default: supported_markets)
+        datasets (list): (dataset, variant) pairs to refresh (default: refreshed_datasets)
+        workers (int): The maximal number of concurrent downloads
+        base_url (str): The URL of SimFin's bulk API, or of a stand-in server
+        refresh_days (float): Datasets whose files are newer than this are skipped (0 refreshes all)
+
+    Returns
+    ---------
+        result (dict): 'refreshed' and 'skipped' list the dataset names, and 'errors' maps the
+            names of the datasets that failed to their error message
+    '''
+    markets = markets or supported_markets
+    datasets = datasets or refreshed_datasets
+    api_key = api_key or os.environ.get('SIMFIN_KEY', 'free')
+    staging_dir = os.path.join(data_dir, STAGING_DIR_NAME)
+    os.makedirs(staging_dir, exist_ok=True)
+    result = {'refreshed': list(), 'skipped': list(), 'errors': dict()}
+    jobs = list()
+    for market in markets:
+        for dataset, variant in datasets:
+            name = get_dataset_name(dataset, variant, market)
+            if is_fresh(os.path.join(data_dir, f"{name}.csv"), refresh_days):
+                result['skipped'].append(name)
+            else:
+                jobs.append((market, dataset, variant, name))
+
+    thread_local = threading.local()
+
+    def fetch(market, dataset, variant, name):
+        # requests sessions aren't thread-safe, so every worker thread keeps its own
+        if not hasattr(thread_local, 'session'):
+            thread_local.session = requests.Session()
+        params = {'dataset': dataset, 'variant': variant, 'market': market, 'api-key': api_key}
+        zip_path = download_file(thread_local.session, base_url, params, os.path.join(staging_dir, f"{name}.zip"),
+                                 retries=retries, backoff=backoff)
+        return extract_dataset(zip_path, name, staging_dir)
+
+    staged = {market: dict() for market in markets}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='refresh') as executor:
+        futures = {executor.submit(fetch, *job): job for job in jobs}
+        for future in as_completed(futures):
+            market, _, _, name = futures[future]
+            try:
+                staged[market][name] = future.result()
+                logger.info(f"Downloaded {name} ({len(staged[market])} of the datasets of market {market})")
+            except Exception as e:
+                logger.warning(f"Failed to download {name}: {e}")
+                result['errors'][name] = str(e)
+
+    for market in markets:
+        failed = [job[3] for job in jobs if job[0] == market and job[3] in result['errors']]
+        if failed:
+            logger.warning(f"Keeping the old datasets of market {market}, since {failed} failed to download")
+            continue
+        for name, csv_path in staged[market].items():
+            os.replace(csv_path, os.path.join(data_dir, f"{name}.csv"))
+            result['refreshed'].append(name)
+    # The failed markets' staged files are removed, their partial downloads are kept to be resumed
+    for file_name in os.listdir(staging_dir):
+        if file_name.endswith('.csv'):
+            os.remove(os.path.join(staging_dir, file_name))
+    logger.info(f"Refreshed {len(result['refreshed'])} datasets in {time.perf_counter() - start:.1f} seconds, "
+                f"skipped {len(result['skipped'])}, {len(result['errors'])} failed")
+    return result
+
+
+def parse_dataset(value: str) -> tuple:
+    dataset, _, variant = value.partition('-')
+    if not variant:
+        raise argparse.ArgumentTypeError("Datasets are given as <dataset>-<variant>, e.g. income-quarterly")
+    return dataset, variant
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download SimFin's bulk datasets concurrently into the data directory")
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--markets', nargs='+', default=supported_markets)
+    parser.add_argument('--datasets', nargs='+', type=parse_dataset, default=None,
+                        help='Datasets as <dataset>-<variant> (default: the datasets of the reports and the daily share prices)')
+    parser.add_argument('--workers', type=int, default=4, help='The maximal number of concurrent downloads')
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--refresh-days', type=float, default=0,
+                        help='Skip the datasets whose files are newer than this number of days')
+    parser.add_argument('--base-url', default=SIMFIN_BULK_URL, help="The URL of SimFin's bulk API")
+    args = parser.parse_args()
+    result = refresh_data(args.data_dir, args.markets, args.datasets, args.workers, args.base_url,
+                          retries=args.retries, refresh_days=args.refresh_days)
+    if result['errors']:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import os
+import json
+import hashlib
+import functools
+import importlib
+import pandas as pd
+
+from Firm import Firm
+from batch import iter_firm_reports
+from config import display_tests, investor_threshold
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+REPORT_CACHE_DIR_NAME = 'report_cache'
+# Bump to invalidate every cached report, e.g. when the report's format changes outside the modules below
+REPORT_FORMAT_VERSION = 1
+# The modules whose code calculates a report
+report_modules = ['Firm', 'market_data', 'metric_engine', 'rules']
+
+
+@functools.lru_cache(maxsize=None)
+def get_code_version() -> str:
+    """ A hash of REPORT_FORMAT_VERSION and of the source of report_modules, so a change of a metric is recomputed """
+    code_hash = hashlib.sha256(str(REPORT_FORMAT_VERSION).encode())
+    for module_name in report_modules:
+        with open(importlib.import_module(module_name).__file__, 'rb') as module_file:
+            code_hash.update(module_file.read())
+    return code_hash.hexdigest()
+
+
+def get_report_key(firm: Firm, tests: dict=display_tests) -> str:
+    """
+    A content hash of everything a firm's report depends on: the firm's rows in the
+    datasets the tests read, the tests, the investors' thresholds and the code that
+    calculates the report.
+    """
+    key_hash = hashlib.sha256(get_code_version().encode())
+    key_hash.update(json.dumps([tests, investor_threshold], sort_keys=True).encode())
+    for statement in sorted(Firm.get_required_datasets(tests)):
+        rows = firm.load_statement(statement)
+        key_hash.update(statement.encode())
+        key_hash.update(json.dumps(list(rows.columns)).encode())
+        key_hash.update(pd.util.hash_pandas_object(rows, index=False).values.tobytes())
+    return key_hash.hexdigest()
+
+
+def get_report_cache_path(key: str, data_dir: str='data') -> str:
+    return os.path.join(data_dir, REPORT_CACHE_DIR_NAME, f"{key}.pkl")
+
+
+def store_report(report: pd.DataFrame, key: str, data_dir: str='data'):
+    path = get_report_cache_path(key, data_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    report.to_pickle(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_report(key: str, data_dir: str='data'):
+    path = get_report_cache_path(key, data_dir)
+    if not os.path.exists(path):
+        return None
+    return pd.read_pickle(path)
+
+
+def _refresh_firm_report(ticker: str, market: str, data_dir: str) -> tuple:
+    # Runs in the batch's workers, which load the market's datasets once, so the key is
+    # calculated from the same rows that the report is generated from
+    firm = Firm(ticker=ticker, market=market, data_dir=data_dir)
+    key = get_report_key(firm)
+    report = load_report(key, data_dir)
+    if report is not None:
+        return report, False
+    report = firm.generate_firm_report()
+    report.insert(0, 'ticker', ticker)
+    store_report(report, key, data_dir)
+    return report, True
+
+
+def refresh_reports(tickers: list, market: str='us', data_dir: str='data', workers: int=None) -> dict:
+    '''
+    Get the reports of several firms, recomputing only the firms whose inputs changed
+    since their report was cached. The firms are spread over a pool of processes, which
+    calculate their keys, and generate and cache on disk (under data_dir) the reports of
+    the firms whose keys aren't cached.
+
+    Returns
+    ---------
+        result (dict): 'reports' maps each ticker to its report, 'refreshed' and 'cached'
+            list the tickers that were recomputed or served from the cache, and 'errors'
+            maps each firm that failed to the error message
+    '''
+    result = {'reports': dict(), 'refreshed': list(), 'cached': list(), 'errors': dict()}
+    for ticker, firm_result, error in iter_firm_reports(tickers, market, data_dir, workers,
+                                                        report_func=_refresh_firm_report):
+        if error is not None:
+            result['errors'][ticker] = repr(error)
+            continue
+        report, refreshed = firm_result
+        result['reports'][ticker] = report
+        result['refreshed' if refreshed else 'cached'].append(ticker)
+    logger.info(f"Refreshed {len(result['refreshed'])} reports, served {len(result['cached'])} from the cache, "
+                f"{len(result['errors'])} firms failed")
+    return result
@@ -0,0 +1,272 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.logger import get_logger
+from utils.ttl_cache import TTLCache
+from utils.profiling import global_profiler
+
+logger = get_logger(__name__)
+
+REPORT_JOBS_DIR_NAME = 'report_jobs'
+
+
+def get_data_version(market: str, data_dir: str='data') -> str:
+    """
+    A short hash of the version of a market's data: the published generation of data_dir and the
+    mtimes of the market's dataset files and columnar stores. It changes with every refresh_data,
+    publish_generation or ingest, so reports of older data aren't served from the cache.
+    """
+    # Imported here, to keep the server's startup fast
+    from columnar_store import STORE_DIR_NAME, META_FILE_NAME, get_current_generation
+    version = [str(get_current_generation(data_dir))]
+    store_dir = os.path.join(data_dir, STORE_DIR_NAME)
+    paths = list()
+    for directory, suffix in [(data_dir, '.csv'), (store_dir, '')]:
+        if os.path.isdir(directory):
+            paths += [os.path.join(directory, file_name, META_FILE_NAME) if not suffix else
+                      os.path.join(directory, file_name) for file_name in sorted(os.listdir(directory))
+                      if file_name.startswith(f"{market}-") and file_name.endswith(suffix)]
+    for path in paths:
+        try:
+            version.append(f"{path}:{os.stat(path).st_mtime_ns}")
+        except OSError:
+            continue
+    return hashlib.sha1('|'.join(version).encode()).hexdigest()[:12]
+
+
+class ReportJobs:
+    """
+    Generates firm reports in background threads. Concurrent requests for the same
+    (ticker, market) are coalesced onto a single in-flight job, and finished reports are
+    published to a cache that is shared by all the requests. The reports are cached by the
+    version of the market's data too, so a refresh of the data is served without waiting for
+    the cached reports to expire.
+
+    The state of every job and its finished report are written to files under
+    data_dir/report_jobs too, so when the server runs in several processes (e.g. gunicorn -w 4),
+    a report that was submitted to one worker can be polled and read from any other worker.
+    Other slow results (e.g. a market's ranking) are generated the same way by submit_task.
+
+    Attributes
+    ----------
+    results: TTLCache
+        The process's cache of finished reports, by job key. Its ttl is the lifetime of the
+        reports and of the failed jobs in every worker
+    prepare: callable
+        Optional function that is applied to a report before it's cached
+    data_dir: str (default='data')
+        The directory of Simfin's data
+    jobs_dir: str
+        The directory of the job files that all the workers share
+    job_timeout: float (default=600)
+        The number of seconds after which an unfinished job whose state wasn't updated is
+        considered failed (e.g. its worker was killed)
+    name: str (default='report_job')
+        The name of the jobs' threads and of their stats in global_profiler
+    """
+    def __init__(self, results: TTLCache, prepare=None, workers: int=4, data_dir: str='data',
+                 job_timeout: float=600, name: str='report_job'):
+        self.results = results
+        self.prepare = prepare
+        self.data_dir = data_dir
+        self.jobs_dir = os.path.join(data_dir, REPORT_JOBS_DIR_NAME)
+        self.job_timeout = job_timeout
+        self.name = name
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name.replace('_', '-'))
+        self._jobs = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_job_key(ticker: str, market: str, data_version: str) -> str:
+        return f"{market}:{ticker}:{data_version}"
+
+    def submit(self, ticker: str, market: str) -> str:
+        """
+        Start generating a firm's report from the current version of the market's data, unless
+        it's already cached or in progress (in this worker or in another one). Returns the job's key
+        """
+        key = self.get_job_key(ticker, market, get_data_version(market, self.data_dir))
+        return self.submit_task(key, functools.partial(self._generate_report, key), ticker, market)
+
+    def submit_task(self, key: str, task, *args) -> str:
+        """
+        Start task(*args) as the job of key, unless its result is already cached or it's in
+        progress (in this worker or in another one). The key must identify the result, e.g. by
+        the version of the data it's calculated from (see get_data_version). Returns the key
+        """
+        self._remove_expired()
+        with self._lock:
+            if key in self.results or self._load_shared_result(key) is not None:
+                global_profiler.count('report_job_coalesced')
+                return key
+            job = self._jobs.get(key) or self._read_shared_job(key)
+            if job is not None and job['state'] in ['pending', 'running']:
+                logger.info(f"Joining the in-flight job of {key}")
+                global_profiler.count('report_job_coalesced')
+                return key
+            self._jobs[key] = {'state': 'pending', 'stage': 'Waiting for a worker', 'error': None,
+                               'updated': time.time()}
+            self._write_shared_job(key, self._jobs[key])
+            self._executor.submit(self._run, key, task, args)
+        return key
+
+    def get_status(self, key: str) -> dict:
+        """
+        Returns
+        ---------
+            status (dict): 'state' is one of 'pending', 'running', 'done', 'failed' or 'unknown',
+                'stage' describes the job's progress and 'error' is the error message of a failed job
+        """
+        if self.get_result(key) is not None:
+            return {'state': 'done', 'stage': 'Done', 'error': None}
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job['state'] == 'failed' and self._is_expired(job['updated']):
+                self._jobs.pop(key)
+                job = None
+        job = job or self._read_shared_job(key)
+        if job is None:
+            return {'state': 'unknown', 'stage': None, 'error': None}
+        return {'state': job['state'], 'stage': job['stage'], 'error': job['error']}
+
+    def get_result(self, key: str):
+        """ The finished (prepared) report of a job, from this worker's cache or from the shared files, None if it's missing """
+        result = self.results.get(key)
+        if result is None:
+            result = self._load_shared_result(key)
+        return result
+
+    def _get_job_path(self, key: str, extension: str) -> str:
+        return os.path.join(self.jobs_dir, f"{hashlib.sha1(key.encode()).hexdigest()}.{extension}")
+
+    def _is_expired(self, timestamp: float) -> bool:
+        return time.time() - timestamp > self.results.ttl
+
+    def _write_shared_file(self, path: str, write, mode: str='w'):
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        # A temporary file per process and thread, replaced atomically, so readers never see a partial file
+        tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp_path, mode) as shared_file:
+            write(shared_file)
+        os.replace(tmp_path, path)
+
+    def _write_shared_job(self, key: str, job: dict):
+        try:
+            self._write_shared_file(self._get_job_path(key, 'json'), lambda job_file: json.dump(job, job_file))
+        except OSError as e:
+            logger.warning(f"Failed to share the state of the report job of {key}: {e!r}")
+
+    def _write_shared_result(self, key: str, result):
+        """ Publish a finished report to the other workers, and remove its job's state which is no longer needed """
+        try:
+            self._write_shared_file(self._get_job_path(key, 'pkl'),
+                                    lambda result_file: pickle.dump(result, result_file), mode='wb')
+            os.remove(self._get_job_path(key, 'json'))
+        except OSError as e:
+            logger.warning(f"Failed to share the report of {key}: {e!r}")
+
+    def _read_shared_job(self, key: str):
+        """ The state of a job from the shared files, None if there's none or it expired """
+        path = self._get_job_path(key, 'json')
+        try:
+            with open(path, 'r') as job_file:
+                job = json.load(job_file)
+        except (OSError, ValueError):
+            return None
+        if job['state'] == 'failed' and self._is_expired(job['updated']):
+            return None
+        if job['state'] in ['pending', 'running'] and time.time() - job['updated'] > self.job_timeout:
+            return dict(job, state='failed', stage='Failed', error="The job's worker stopped responding")
+        return job
+
+    def _load_shared_result(self, key: str):
+        """ A finished report from the shared files, which is then cached by this worker too """
+        path = self._get_job_path(key, 'pkl')
+        try:
+            if self._is_expired(os.path.getmtime(path)):
+                return None
+            with open(path, 'rb') as result_file:
+                result = pickle.load(result_file)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        self.results.set(key, result)
+        return result
+
+    def _remove_expired(self):
+        """ Remove the failed jobs and the shared files that outlived the results' ttl """
+        with self._lock:
+            for key in [key for key, job in self._jobs.items() if job['state'] == 'failed' and
+                        self._is_expired(job['updated'])]:
+                self._jobs.pop(key)
+        try:
+            file_names = os.listdir(self.jobs_dir)
+        except OSError:
+            return
+        for file_name in file_names:
+            path = os.path.join(self.jobs_dir, file_name)
+            try:
+                if self._is_expired(os.path.getmtime(path)):
+                    os.remove(path)
+            except OSError:
+                # Already removed by another worker
+                continue
+
+    def preload(self, markets: list):
+        """
+        Load the whole-market datasets of the reports of every market in the background, so the
+        first report of a market doesn't wait for its datasets to be parsed
+        """
+        for market in markets:
+            self._executor.submit(self._preload, market)
+
+    def _preload(self, market: str):
+        from Firm import Firm
+        start = time.perf_counter()
+        try:
+            for statement in Firm.get_required_datasets():
+                Firm.load_market_dataset(statement, market, self.data_dir)
+            global_profiler.record('preload', time.perf_counter() - start)
+            logger.info(f"Preloaded the datasets of market {market} in {time.perf_counter() - start:.1f} seconds")
+        except Exception as e:
+            logger.warning(f"Failed to preload the datasets of market {market}: {e!r}")
+
+    def _set_job(self, key: str, **kwargs):
+        with self._lock:
+            job = self._jobs[key]
+            job.update(kwargs, updated=time.time())
+            job = dict(job)
+        self._write_shared_job(key, job)
+
+    def _generate_report(self, key: str, ticker: str, market: str):
+        self._set_job(key, stage="Loading the firm's statements")
+        # Firm (with pandas and simfin) is imported by the first job, to keep the server's startup fast
+        from Firm import Firm
+        firm = Firm(ticker=ticker, market=market, data_dir=self.data_dir)
+        for statement in Firm.get_required_datasets():
+            firm.load_statement(statement)
+        self._set_job(key, stage='Calculating the metrics')
+        return firm.generate_firm_report()
+
+    def _run(self, key: str, task, args: tuple):
+        start = time.perf_counter()
+        try:
+            self._set_job(key, state='running', stage='Running')
+            result = task(*args)
+            if self.prepare is not None:
+                result = self.prepare(result)
+            self.results.set(key, result)
+            self._write_shared_result(key, result)
+            with self._lock:
+                # From now on the job's status comes from the shared results
+                self._jobs.pop(key, None)
+            global_profiler.record(self.name, time.perf_counter() - start)
+        except Exception as e:
+            logger.warning(f"The job of {key} failed: {e!r}")
+            self._set_job(key, state='failed', stage='Failed', error=str(e))
+            global_profiler.record(f"failed_{self.name}", time.perf_counter() - start)
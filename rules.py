@@ -0,0 +1,145 @@
+import ast
+import functools
+import numpy as np
+
+from metric_engine import metric_scope
+
+_comparison_functions = {ast.Lt: 'less', ast.LtE: 'less_equal', ast.Gt: 'greater', ast.GtE: 'greater_equal',
+                         ast.Eq: 'equal', ast.NotEq: 'not_equal'}
+_binary_functions = {ast.Add: 'add', ast.Sub: 'subtract', ast.Mult: 'multiply', ast.Div: 'true_divide',
+                     ast.Pow: 'power'}
+_unary_functions = {ast.Not: 'logical_not', ast.USub: 'negative', ast.UAdd: 'positive'}
+_allowed_calls = {'abs': 'absolute'}
+
+
+def get_metric_method_name(metric_name: str) -> str:
+    return metric_name if metric_name.startswith('get_') else f"get_{metric_name}"
+
+
+class _RuleTransformer(ast.NodeTransformer):
+    """
+    Rewrites a rule's expression into NumPy calls, which evaluate the same way on scalars
+    (one firm) and on arrays (a whole market): 'and', 'or', 'not' and chained comparisons
+    become element-wise NumPy functions, and every name becomes a lookup of a metric's values.
+    """
+    def __init__(self):
+        self.metric_names = list()
+
+    @staticmethod
+    def _np_call(func_name: str, args: list):
+        return ast.Call(func=ast.Attribute(value=ast.Name(id='np', ctx=ast.Load()), attr=func_name, ctx=ast.Load()),
+                        args=args, keywords=[])
+
+    def _reduce(self, func_name: str, values: list):
+        result = values[0]
+        for value in values[1:]:
+            result = self._np_call(func_name, [result, value])
+        return result
+
+    def visit_Expression(self, node):
+        return ast.Expression(body=self.visit(node.body))
+
+    def visit_BoolOp(self, node):
+        func_name = 'logical_and' if isinstance(node.op, ast.And) else 'logical_or'
+        return self._reduce(func_name, [self.visit(value) for value in node.values])
+
+    def visit_Compare(self, node):
+        operands = [self.visit(node.left)] + [self.visit(comparator) for comparator in node.comparators]
+        comparisons = list()
+        for idx, op in enumerate(node.ops):
+            if type(op) not in _comparison_functions:
+                raise ValueError(f"Unsupported comparison in rule: {ast.dump(op)}")
+            comparisons.append(self._np_call(_comparison_functions[type(op)], [operands[idx], operands[idx + 1]]))
+        return self._reduce('logical_and', comparisons)
+
+    def visit_BinOp(self, node):
+        if type(node.op) not in _binary_functions:
+            raise ValueError(f"Unsupported operator in rule: {ast.dump(node.op)}")
+        return self._np_call(_binary_functions[type(node.op)], [self.visit(node.left), self.visit(node.right)])
+
+    def visit_UnaryOp(self, node):
+        if type(node.op) not in _unary_functions:
+            raise ValueError(f"Unsupported operator in rule: {ast.dump(node.op)}")
+        return self._np_call(_unary_functions[type(node.op)], [self.visit(node.operand)])
+
+    def visit_Call(self, node):
+        if not isinstance(node.func, ast.Name) or node.func.id not in _allowed_calls or node.keywords:
+            raise ValueError(f"Unsupported function call in rule, only {list(_allowed_calls)} are allowed")
+        return self._np_call(_allowed_calls[node.func.id], [self.visit(arg) for arg in node.args])
+
+    def visit_Name(self, node):
+        if node.id not in self.metric_names:
+            self.metric_names.append(node.id)
+        return ast.Subscript(value=ast.Name(id='metrics', ctx=ast.Load()), slice=ast.Constant(value=node.id),
+                             ctx=ast.Load())
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise ValueError(f"Only numeric constants are allowed in rules, got {node.value!r}")
+        return node
+
+    def generic_visit(self, node):
+        raise ValueError(f"Unsupported syntax in rule: {type(node).__name__}")
+
+
+class CompiledRule:
+    """
+    An investor rule over named metrics, e.g. 'earnings_multiplier < 15 and current_ratio > 2',
+    compiled once into a NumPy expression. A name refers to the metric of the get_<name>
+    method (e.g. earnings_multiplier -> get_earnings_multiplier).
+
+    Attributes
+    ----------
+    expression: str
+        The rule's expression
+    metric_names: list
+        The names of the metrics the rule uses
+    """
+    def __init__(self, expression: str):
+        self.expression = expression
+        transformer = _RuleTransformer()
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as e:
+            raise ValueError(f"Invalid rule {expression!r}: {e.msg}")
+        tree = ast.fix_missing_locations(transformer.visit(tree))
+        self.metric_names = transformer.metric_names
+        self._code = compile(tree, filename=f"<rule {expression}>", mode='eval')
+
+    @property
+    def metric_methods(self) -> list:
+        return [get_metric_method_name(name) for name in self.metric_names]
+
+    def evaluate_metrics(self, metrics: dict):
+        """ Evaluate the rule over the given metric values (scalars or aligned arrays) """
+        with np.errstate(all='ignore'):
+            return eval(self._code, {'__builtins__': {}, 'np': np}, {'metrics': metrics})
+
+    def evaluate(self, source):
+        """
+        Evaluate the rule for a Firm (returns a boolean) or for a MarketMetrics (returns a
+        boolean array, a value per ticker).
+        """
+        metrics = dict()
+        with metric_scope(source):
+            for name in self.metric_names:
+                method = getattr(source, get_metric_method_name(name), None)
+                if method is None:
+                    raise ValueError(f"{type(source).__name__} has no metric named {name}")
+                metrics[name] = method()
+        return self.evaluate_metrics(metrics)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_rule(expression: str) -> CompiledRule:
+    return CompiledRule(expression)
+
+
+def run_test(source, test: str, test_config: dict):
+    """
+    Run a test of display_tests for a Firm or a MarketMetrics: the test's 'rule' if it has
+    one, and otherwise its *_test method.
+    """
+    if 'rule' in test_config:
+        return compile_rule(test_config['rule']).evaluate(source)
+    return getattr(source, '_'.join(test.split()) + '_test')()
@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+
+from market_data import MarketData, load_latest_share_prices, align_share_prices
+from market_metrics import MarketMetrics
+from metric_engine import metric_scope, persist_metrics, invalidate_metrics, get_dependent_metrics, \
+    get_required_metrics
+from rules import compile_rule, run_test
+from config import display_tests, investor_threshold
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def check_investor_thresholds(pass_rates: np.ndarray, investor: str) -> np.ndarray:
+    """ The vectorized version of Firm.check_investor_threshold """
+    return np.select([pass_rates > investor_threshold[investor]['buy'],
+                      pass_rates > investor_threshold[investor]['hold']],
+                     ['buy', 'hold'], default='sell')
+
+
+def get_test_results(metrics: MarketMetrics, tests: list=None) -> dict:
+    """
+    Run every test of display_tests (or only the (investor, test id) pairs of tests) for every
+    firm in the market.
+
+    Returns
+    ---------
+        test_results (dict): Maps each investor to a dict of test id -> boolean array (one value per ticker)
+    """
+    test_results = dict()
+    with np.errstate(all='ignore'), metric_scope(metrics):
+        for investor in display_tests.keys():
+            test_results[investor] = dict()
+            for test in display_tests[investor]:
+                if tests is not None and (investor, test) not in tests:
+                    continue
+                test_results[investor][test] = np.asarray(run_test(metrics, test, display_tests[investor][test]),
+                                                          dtype=bool)
+    return test_results
+
+
+def summarize_market_tests(tickers: np.ndarray, test_results: dict) -> pd.DataFrame:
+    """
+    Build a report with a row per ticker and test, with the same columns as the report of
+    Firm.generate_firm_report (apart from 'related_values').
+    """
+    df_list = list()
+    for investor, investor_tests in test_results.items():
+        test_ids = list(investor_tests.keys())
+        passed = np.column_stack([investor_tests[test] for test in test_ids])
+        pass_rates = passed.mean(axis=1)
+        df_list.append(pd.DataFrame({
+            'ticker': np.repeat(tickers, len(test_ids)),
+            'investor': investor,
+            'test_id': np.tile(test_ids, len(tickers)),
+            'description': np.tile([display_tests[investor][test]['description'] for test in test_ids], len(tickers)),
+            'test_passed': passed.ravel(),
+            'investor_test_pass_rate': np.repeat(pass_rates, len(test_ids)),
+            'investor_recommendation': np.repeat(check_investor_thresholds(pass_rates, investor), len(test_ids))
+        }))
+    summary_df = pd.concat(df_list, ignore_index=True)
+    # Order the rows like a concatenation of the firms' reports
+    summary_df['investor_order'] = summary_df['investor'].map({investor: idx for idx, investor in
+                                                               enumerate(test_results.keys())})
+    summary_df.sort_values(by=['ticker', 'investor_order'], kind='mergesort', inplace=True)
+    return summary_df.drop(columns='investor_order').reset_index(drop=True)
+
+
+def screen_market(market: str='us', data_dir: str='data', variant: str='annual') -> pd.DataFrame:
+    '''
+    Screen every firm in a market at once. All the metrics behind display_tests are
+    calculated as arrays over the whole market, instead of one Firm at a time.
+    With variant='ttm', the firms are screened by their trailing-twelve-month statements.
+
+    Returns
+    ---------
+        report (pd.DataFrame): A report with a row per ticker and test, with the test_passed,
+            investor_test_pass_rate and investor_recommendation columns of Firm.generate_firm_report
+    '''
+    metrics = MarketMetrics(MarketData(market, data_dir, variant=variant))
+    test_results = get_test_results(metrics)
+    logger.info(f"Screened {len(metrics.tickers)} firms in market {market}")
+    return summarize_market_tests(metrics.tickers, test_results)
+
+
+def screen_rules(rules: dict, market: str='us', data_dir: str='data', variant: str='annual') -> pd.DataFrame:
+    '''
+    Screen every firm in a market with custom rules, e.g.
+    {'cheap and liquid': 'earnings_multiplier < 15 and current_ratio > 2'}.
+    Each rule is compiled once and evaluated over the metric arrays of the whole market.
+
+    Returns
+    ---------
+        results (pd.DataFrame): A row per ticker and a boolean column per rule
+    '''
+    compiled_rules = {name: compile_rule(rule) for name, rule in rules.items()}
+    metrics = MarketMetrics(MarketData(market, data_dir, variant=variant))
+    results = pd.DataFrame({'ticker': metrics.tickers})
+    with metric_scope(metrics):
+        for name, compiled_rule in compiled_rules.items():
+            results[name] = np.broadcast_to(np.asarray(compiled_rule.evaluate(metrics), dtype=bool),
+                                            (len(metrics.tickers),))
+    logger.info(f"Screened {len(metrics.tickers)} firms in market {market} with {len(rules)} rules")
+    return results
+
+
+class IncrementalScreener:
+    """
+    Screens a market like screen_market, and keeps every metric and test result, so when a
+    new snapshot of share prices arrives, only the metrics and tests that depend on the share
+    prices are calculated again (as arrays over the whole market), and the fundamental ones
+    are reused.
+
+    Attributes
+    ----------
+    metrics: MarketMetrics
+        The market's metrics, memoized across updates
+    test_results: dict
+        The latest results of every test, in the format of get_test_results
+    price_dependent_tests: list
+        The (investor, test id) pairs of the tests that depend on the share prices
+    """
+    def __init__(self, market: str='us', data_dir: str='data', variant: str='annual'):
+        self.metrics = MarketMetrics(MarketData(market, data_dir, variant=variant))
+        persist_metrics(self.metrics)
+        self.test_results = get_test_results(self.metrics)
+        price_metrics = get_dependent_metrics(MarketMetrics, ['curr_share_data'])
+        self.price_dependent_tests = [
+            (investor, test) for investor in display_tests.keys() for test in display_tests[investor]
+            if price_metrics & set(get_required_metrics(MarketMetrics, {investor: {test: display_tests[investor][test]}},
+                                                        include_display=False))]
+
+    def get_report(self) -> pd.DataFrame:
+        """ The report of screen_market, from the latest test results """
+        return summarize_market_tests(self.metrics.tickers, self.test_results)
+
+    def update_share_prices(self, curr_share_data: pd.DataFrame=None) -> pd.DataFrame:
+        '''
+        Re-screen the market with new share prices.
+
+        Parameters
+        ---------
+            curr_share_data (pd.DataFrame): The new share prices, with 'Close' and 'Shares Outstanding'
+                columns and indexed by ticker. By default, the latest shareprices dataset is read again
+
+        Returns
+        ---------
+            report (pd.DataFrame): The updated report of screen_market
+        '''
+        data = self.metrics.data
+        if curr_share_data is None:
+            curr_share_data = load_latest_share_prices(data.market, data.data_dir)
+        data.share_prices = align_share_prices(curr_share_data, self.metrics.tickers)
+        invalidate_metrics(self.metrics, ['curr_share_data'])
+        for investor, investor_results in get_test_results(self.metrics, self.price_dependent_tests).items():
+            self.test_results[investor].update(investor_results)
+        logger.info(f"Re-screened {len(self.price_dependent_tests)} price-dependent tests of "
+                    f"{len(self.metrics.tickers)} firms in market {data.market}")
+        return self.get_report()
@@ -0,0 +1,18 @@
+import os
+import sys
+import logging
+import pytest
+
+# The modules are flat modules at the repository's root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.disable(logging.INFO)
+
+
+@pytest.fixture(scope='module')
+def market_dir(tmp_path_factory):
+    """ A synthetic 'us' market, with the annual datasets and latest share prices """
+    from benchmarks.synthetic_data import generate_market_data
+    from firm_reports import TICKERS_NUM
+    data_dir = str(tmp_path_factory.mktemp('market'))
+    generate_market_data(data_dir, tickers_num=TICKERS_NUM)
+    return data_dir
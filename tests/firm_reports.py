@@ -0,0 +1,46 @@
+""" The reports of Firm on a synthetic market, which the faster screeners and firms are compared with """
+import warnings
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic_data import get_tickers
+from Firm import Firm
+
+TICKERS_NUM = 40
+compared_columns = ['investor', 'test_id', 'test_passed', 'investor_test_pass_rate', 'investor_recommendation']
+
+
+def get_firm_reports(data_dir: str, share_prices: pd.DataFrame=None) -> dict:
+    """ The report of every synthetic firm that Firm can report on, by ticker """
+    reports = dict()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for ticker in get_tickers(TICKERS_NUM):
+            firm = Firm(ticker=ticker, data_dir=data_dir)
+            if share_prices is not None:
+                firm.update_share_prices(share_prices.loc[[ticker]].reset_index())
+            try:
+                reports[ticker] = firm.generate_firm_report()
+            except (IndexError, OverflowError):
+                # The synthetic data has firms with too short a history for some metrics
+                continue
+    assert len(reports) > TICKERS_NUM // 2
+    return reports
+
+
+def assert_matches_firm_reports(market_report: pd.DataFrame, firm_reports: dict):
+    for ticker, firm_report in firm_reports.items():
+        ticker_report = market_report[market_report['ticker'] == ticker].reset_index(drop=True)
+        expected = firm_report[compared_columns]
+        actual = ticker_report[compared_columns]
+        pd.testing.assert_frame_equal(actual.drop(columns='investor_test_pass_rate'),
+                                      expected.drop(columns='investor_test_pass_rate'), check_dtype=False,
+                                      obj=ticker)
+        np.testing.assert_allclose(actual['investor_test_pass_rate'].values.astype(float),
+                                   expected['investor_test_pass_rate'].values.astype(float), err_msg=ticker)
+
+
+def load_scaled_share_prices(data_dir: str, factor: float) -> pd.DataFrame:
+    share_prices = pd.read_csv(f"{data_dir}/us-shareprices-latest.csv", sep=';').set_index('Ticker')
+    share_prices['Close'] *= factor
+    return share_prices
@@ -0,0 +1,36 @@
+import warnings
+import numpy as np
+import pytest
+
+from benchmarks.synthetic_data import generate_market_data
+from Firm import Firm
+
+# Young firms whose first TTM income record is a year after their first balance sheet
+UNEVEN_TICKERS = ['SYN00009', 'SYN00037']
+
+
+@pytest.fixture(scope='module')
+def data_dir(tmp_path_factory):
+    data_dir = str(tmp_path_factory.mktemp('market'))
+    generate_market_data(data_dir, tickers_num=40, quarterly=True, companies=True)
+    return data_dir
+
+
+@pytest.mark.parametrize('ticker', UNEVEN_TICKERS)
+def test_average_roe_pairs_uneven_ttm_histories_by_year(data_dir, ticker):
+    firm = Firm(ticker=ticker, data_dir=data_dir, variant='ttm')
+    income = firm.load_statement('income').set_index('Fiscal Year')
+    balance = firm.load_statement('balance').set_index('Fiscal Year')
+    assert len(income) < len(balance)
+    years = income.index.intersection(balance.index)
+    equity = balance.loc[years, 'Total Assets'] - balance.loc[years, 'Total Liabilities']
+    expected = np.mean(income.loc[years, 'Net Income'] / equity)
+    np.testing.assert_allclose(firm.get_average_roe(), expected)
+
+
+@pytest.mark.parametrize('ticker', UNEVEN_TICKERS)
+def test_percentiles_of_uneven_ttm_histories(data_dir, ticker):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        percentiles = Firm(ticker=ticker, data_dir=data_dir, variant='ttm').get_percentiles()
+    assert 0 <= percentiles['get_average_roe'] <= 100
@@ -0,0 +1,51 @@
+import warnings
+import pandas as pd
+
+import get_financial_report
+from Firm import Firm
+from firm_store import FirmStore
+from firm_reports import compared_columns, get_firm_reports, load_scaled_share_prices
+
+
+def test_compact_firms_match_firm_reports(market_dir):
+    store = FirmStore(data_dir=market_dir)
+    for ticker, firm_report in get_firm_reports(market_dir).items():
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            compact_report = store.get_firm(ticker).generate_firm_report()
+        pd.testing.assert_frame_equal(compact_report[compared_columns], firm_report[compared_columns], obj=ticker)
+        assert list(compact_report['related_values'].astype(str)) == list(firm_report['related_values'].astype(str))
+
+
+def test_compact_firms_read_the_statements_the_store_does_not_hold(market_dir):
+    store = FirmStore(data_dir=market_dir)
+    assert 'cash_flow' not in store.data.statements
+    for ticker in store.data.tickers[:5]:
+        compact_firm, firm = store.get_firm(ticker), Firm(ticker=ticker, data_dir=market_dir)
+        pd.testing.assert_frame_equal(compact_firm.cash_flow, firm.cash_flow)
+        matrix = compact_firm.get_statement_matrix('cash_flow')
+        assert (matrix.years == firm.get_statement_matrix('cash_flow').years).all()
+
+
+def test_store_does_not_keep_the_market_datasets_cached(market_dir):
+    get_financial_report.clear_dataset_cache()
+    FirmStore(data_dir=market_dir)
+    assert not [key for key in get_financial_report._dataset_cache if key[3] == market_dir]
+
+
+def test_incremental_compact_firms_follow_store_price_updates(market_dir):
+    store = FirmStore(data_dir=market_dir)
+    firm_reports = get_firm_reports(market_dir)
+    firms = {ticker: store.get_firm(ticker, incremental=True) for ticker in firm_reports}
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for firm in firms.values():
+            firm.generate_firm_report()
+        share_prices = load_scaled_share_prices(market_dir, 0.25)
+        store.update_share_prices(share_prices[['Close', 'Shares Outstanding']])
+        updated_reports = get_firm_reports(market_dir, share_prices)
+        for ticker, firm in firms.items():
+            if ticker not in updated_reports:
+                continue
+            pd.testing.assert_frame_equal(firm.generate_firm_report()[compared_columns],
+                                          updated_reports[ticker][compared_columns], obj=ticker)
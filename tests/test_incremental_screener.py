@@ -0,0 +1,12 @@
+from firm_reports import assert_matches_firm_reports, get_firm_reports, load_scaled_share_prices
+from screener import screen_market, IncrementalScreener
+
+
+def test_incremental_screener_matches_firm_reports_after_price_update(market_dir):
+    screener = IncrementalScreener(data_dir=market_dir)
+    share_prices = load_scaled_share_prices(market_dir, 0.25)
+    report = screener.update_share_prices(share_prices[['Close', 'Shares Outstanding']])
+    firm_reports = get_firm_reports(market_dir, share_prices)
+    assert_matches_firm_reports(report, firm_reports)
+    # The cheaper prices change some of the price-dependent tests
+    assert not report['test_passed'].equals(screen_market(data_dir=market_dir)['test_passed'])
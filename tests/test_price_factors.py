@@ -0,0 +1,41 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic_data import generate_market_data
+from get_financial_report import get_dataset_path
+from price_factors import store_price_factors, load_price_factors
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    data_dir = str(tmp_path)
+    generate_market_data(data_dir, tickers_num=10, years_num=2, daily_prices=True)
+    store_price_factors('us', data_dir)
+    return data_dir
+
+
+def refresh_daily_prices(data_dir: str, factor: float):
+    """ Rewrite the daily share prices, like a refresh that downloaded newer prices """
+    path = get_dataset_path('shareprices', 'us', data_dir, 'daily')
+    prices = pd.read_csv(path, sep=';')
+    prices['Adj. Close'] *= factor
+    prices.to_csv(path, sep=';', index=False)
+    mtime = os.path.getmtime(path) + 60
+    os.utime(path, (mtime, mtime))
+    return mtime
+
+
+def test_stale_price_factors_are_computed_again(data_dir):
+    old_highs = load_price_factors('us', data_dir).get_columns(['high_52w'])['high_52w'].values
+    mtime = refresh_daily_prices(data_dir, 2)
+    factors = load_price_factors('us', data_dir)
+    assert factors.source_mtime == mtime
+    np.testing.assert_allclose(factors.get_columns(['high_52w'])['high_52w'].values, old_highs * 2)
+
+
+def test_stale_price_factors_raise_without_recompute(data_dir):
+    refresh_daily_prices(data_dir, 2)
+    with pytest.raises(ValueError):
+        load_price_factors('us', data_dir, recompute=False)
@@ -0,0 +1,110 @@
+import os
+import filecmp
+import pytest
+import requests
+
+from benchmarks.bulk_server import build_fixture_zips, start_bulk_server
+from benchmarks.synthetic_data import generate_market_data
+from refresh_data import refresh_data, download_file, DownloadError, refreshed_datasets, STAGING_DIR_NAME
+
+
+@pytest.fixture(scope='module')
+def source_dir(tmp_path_factory):
+    """ A synthetic 'us' market, with the datasets that refresh_data fetches by default """
+    data_dir = str(tmp_path_factory.mktemp('source'))
+    generate_market_data(data_dir, tickers_num=20, years_num=3, daily_prices=True)
+    return data_dir
+
+
+@pytest.fixture
+def bulk_server(source_dir, tmp_path):
+    servers = list()
+
+    def start(truncated_responses: int=0):
+        fixtures_dir = str(tmp_path / 'fixtures')
+        build_fixture_zips(source_dir, fixtures_dir)
+        server = start_bulk_server(fixtures_dir, truncated_responses=truncated_responses)
+        servers.append(server)
+        return server, f"http://127.0.0.1:{server.server_port}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def get_names(market: str='us') -> list:
+    return [f"{market}-{dataset}-{variant}" for dataset, variant in refreshed_datasets]
+
+
+def assert_same_files(source_dir: str, data_dir: str, market: str='us'):
+    for name in get_names(market):
+        assert filecmp.cmp(os.path.join(source_dir, f"{name}.csv"), os.path.join(data_dir, f"{name}.csv"),
+                           shallow=False), name
+
+
+def test_refresh_downloads_every_dataset(source_dir, bulk_server, tmp_path):
+    _, url = bulk_server()
+    data_dir = str(tmp_path / 'data')
+    result = refresh_data(data_dir, ['us'], base_url=url, backoff=0)
+    assert sorted(result['refreshed']) == sorted(get_names())
+    assert result['errors'] == {}
+    assert_same_files(source_dir, data_dir)
+    # Nothing is left in the staging directory
+    assert os.listdir(os.path.join(data_dir, STAGING_DIR_NAME)) == []
+
+
+def test_refresh_retries_truncated_downloads(source_dir, bulk_server, tmp_path):
+    server, url = bulk_server(truncated_responses=2)
+    data_dir = str(tmp_path / 'data')
+    result = refresh_data(data_dir, ['us'], base_url=url, retries=3, backoff=0)
+    assert result['errors'] == {}
+    assert_same_files(source_dir, data_dir)
+    # Every file was cut twice, and completed by a third request
+    assert all(server.requests_count[name] == 3 for name in get_names())
+
+
+def test_refresh_resumes_partial_download_of_earlier_run(source_dir, bulk_server, tmp_path):
+    server, url = bulk_server(truncated_responses=1)
+    data_dir = str(tmp_path / 'data')
+    staging_dir = os.path.join(data_dir, STAGING_DIR_NAME)
+    os.makedirs(staging_dir)
+    zip_path = os.path.join(staging_dir, 'us-income-annual.zip')
+    params = {'dataset': 'income', 'variant': 'annual', 'market': 'us', 'api-key': 'free'}
+    # An earlier run whose connection dropped, with small chunks so the received part is kept
+    with pytest.raises(DownloadError):
+        download_file(requests.Session(), url, params, zip_path, retries=0, backoff=0, chunk_size=1024)
+    zip_size = os.path.getsize(os.path.join(str(tmp_path / 'fixtures'), 'us-income-annual.zip'))
+    assert 0 < os.path.getsize(zip_path + '.part') < zip_size
+
+    result = refresh_data(data_dir, ['us'], [('income', 'annual')], base_url=url, retries=0, backoff=0)
+    assert result['refreshed'] == ['us-income-annual']
+    assert server.resumed_count['us-income-annual'] == 1
+    assert filecmp.cmp(os.path.join(source_dir, 'us-income-annual.csv'),
+                       os.path.join(data_dir, 'us-income-annual.csv'), shallow=False)
+    assert os.listdir(staging_dir) == []
+
+
+def test_failing_market_keeps_its_old_files(source_dir, bulk_server, tmp_path):
+    # The stand-in only serves the 'us' market, so every dataset of 'ca' fails
+    _, url = bulk_server()
+    data_dir = str(tmp_path / 'data')
+    os.makedirs(data_dir)
+    old_path = os.path.join(data_dir, 'ca-income-annual.csv')
+    with open(old_path, 'w') as old_file:
+        old_file.write('old')
+    result = refresh_data(data_dir, ['us', 'ca'], base_url=url, retries=1, backoff=0)
+    assert sorted(result['refreshed']) == sorted(get_names('us'))
+    assert sorted(result['errors'].keys()) == sorted(get_names('ca'))
+    assert_same_files(source_dir, data_dir)
+    with open(old_path, 'r') as old_file:
+        assert old_file.read() == 'old'
+
+
+def test_fresh_datasets_are_skipped(source_dir, bulk_server, tmp_path):
+    server, url = bulk_server()
+    data_dir = str(tmp_path / 'data')
+    refresh_data(data_dir, ['us'], base_url=url, backoff=0)
+    result = refresh_data(data_dir, ['us'], base_url=url, backoff=0, refresh_days=1)
+    assert sorted(result['skipped']) == sorted(get_names())
+    assert all(server.requests_count[name] == 1 for name in get_names())
@@ -0,0 +1,49 @@
+import time
+
+from report_jobs import ReportJobs
+from utils.ttl_cache import TTLCache
+
+
+def wait_for(jobs: ReportJobs, key: str, timeout: float=30) -> dict:
+    deadline = time.time() + timeout
+    status = jobs.get_status(key)
+    while status['state'] in ['pending', 'running'] and time.time() < deadline:
+        time.sleep(0.05)
+        status = jobs.get_status(key)
+    return status
+
+
+def test_report_submitted_to_one_worker_is_read_by_another(market_dir):
+    # Two processes' jobs, which only share the data directory
+    submitting, polling = ReportJobs(TTLCache(), data_dir=market_dir), ReportJobs(TTLCache(), data_dir=market_dir)
+    key = submitting.submit('SYN00000', 'us')
+    assert wait_for(polling, key)['state'] == 'done'
+    report = polling.get_result(key)
+    assert report is not None
+    assert list(report['investor']) == list(submitting.get_result(key)['investor'])
+    # The other worker joins the finished report instead of generating it again
+    assert polling.submit('SYN00000', 'us') == key
+    assert not polling._jobs
+
+
+def test_failed_jobs_expire(market_dir):
+    jobs = ReportJobs(TTLCache(ttl=0.5), data_dir=market_dir)
+    key = jobs.submit('MISSING', 'us')
+    assert wait_for(jobs, key)['state'] == 'failed'
+    assert ReportJobs(TTLCache(ttl=0.5), data_dir=market_dir).get_status(key)['state'] == 'failed'
+    time.sleep(0.6)
+    assert jobs.get_status(key)['state'] == 'unknown'
+    assert key not in jobs._jobs
+
+
+def test_ranking_task_is_shared_between_workers(market_dir):
+    from ranking import rank_market
+
+    def rank(market: str, k: int):
+        return rank_market(market, market_dir, k=k, with_reports=False)[0]
+
+    submitting = ReportJobs(TTLCache(), data_dir=market_dir, name='ranking_job')
+    polling = ReportJobs(TTLCache(), data_dir=market_dir, name='ranking_job')
+    key = submitting.submit_task('ranking:us:5:test', rank, 'us', 5)
+    assert wait_for(polling, key)['state'] == 'done'
+    assert len(polling.get_result(key)) == 5
@@ -0,0 +1,6 @@
+from firm_reports import assert_matches_firm_reports, get_firm_reports
+from screener import screen_market
+
+
+def test_screen_market_matches_firm_reports(market_dir):
+    assert_matches_firm_reports(screen_market(data_dir=market_dir), get_firm_reports(market_dir))
@@ -0,0 +1,150 @@
+import inspect
+import itertools
+import numpy as np
+import pandas as pd
+
+from market_data import MarketData
+from market_metrics import MarketMetrics
+from metric_engine import metric_scope
+from rules import run_test
+from config import display_tests, investor_threshold
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def get_test_method_name(test: str) -> str:
+    return '_'.join(test.split()) + '_test'
+
+
+def get_default_thresholds(cls=MarketMetrics) -> dict:
+    """ Maps the id of every test of display_tests that has a threshold argument to its default threshold """
+    thresholds = dict()
+    for investor in display_tests.keys():
+        for test, test_config in display_tests[investor].items():
+            method = getattr(cls, get_test_method_name(test), None)
+            if 'rule' in test_config or method is None:
+                continue
+            parameter = inspect.signature(method).parameters.get('threshold')
+            if parameter is not None:
+                thresholds[test] = parameter.default
+    return thresholds
+
+
+def _get_cutoff_points(cutoff_grid: dict, investor: str) -> list:
+    """ The (buy, hold) cutoffs of an investor's grid, by default the cutoffs of config.investor_threshold """
+    cutoffs = (cutoff_grid or dict()).get(investor, dict())
+    return list(itertools.product(np.atleast_1d(cutoffs.get('buy', investor_threshold[investor]['buy'])),
+                                  np.atleast_1d(cutoffs.get('hold', investor_threshold[investor]['hold']))))
+
+
+def _count_pass_levels(test_values: list, grid_index: np.ndarray, chunk_size: int) -> np.ndarray:
+    """
+    The number of firms that passed 0, 1, ..., len(test_values) of an investor's tests, at every grid point.
+    test_values are (values x ticker) boolean arrays and grid_index maps each grid point to a row of each of them.
+    """
+    tests_num = len(test_values)
+    grid_size = len(grid_index)
+    levels_counts = np.empty((grid_size, tests_num + 1), dtype=np.int64)
+    # A chunk of grid points at a time, so the (grid point x ticker) pass counts fit in memory
+    for start in range(0, grid_size, chunk_size):
+        stop = min(start + chunk_size, grid_size)
+        passed_num = sum(values[grid_index[start:stop, col]] for col, values in enumerate(test_values))
+        passed_num = np.asarray(passed_num, dtype=np.int64)
+        # One bincount over the chunk, with every grid point's counts offset into its own row
+        offsets = np.arange(stop - start)[:, None] * (tests_num + 1)
+        levels_counts[start:stop] = np.bincount((passed_num + offsets).ravel(),
+                                                minlength=(stop - start) * (tests_num + 1)).reshape(-1, tests_num + 1)
+    return levels_counts
+
+
+def sweep_thresholds(metrics: MarketMetrics, test_grid: dict, cutoff_grid: dict=None,
+                     chunk_size: int=256) -> pd.DataFrame:
+    '''
+    Evaluate every combination of test thresholds and investors' buy/hold cutoffs over a whole
+    market, without generating reports. Each swept test is run once, with its thresholds as a
+    column array that broadcasts against the tickers, and the tests that aren't swept are run
+    once with their defaults. A grid point's pass rates only take the values k / tests_num, so
+    the recommendations of every (buy, hold) cutoff are counted from the number of firms at
+    each pass rate, instead of comparing every firm against every cutoff.
+
+    Parameters
+    ---------
+        metrics (MarketMetrics): The market's metrics, e.g. MarketMetrics(MarketData('us'))
+        test_grid (dict): Maps test ids of display_tests to the thresholds to try, e.g.
+            {'earnings_multiplier': [10, 15, 20], 'roa': [0.08, 0.12]}. A test id that several
+            investors use is swept for all of them
+        cutoff_grid (dict): Optional map of investors to their cutoffs to try, e.g.
+            {'Peter Lynch': {'buy': [0.7, 0.82], 'hold': [0.5, 0.65]}}. Cutoffs that are
+            missing are those of config.investor_threshold
+        chunk_size (int): The number of grid points that are counted at once
+
+    Returns
+    ---------
+        sweep (pd.DataFrame): A row per test grid point, investor and (buy, hold) cutoffs, with a
+            column per swept test's threshold, 'grid_point', 'investor', 'buy_cutoff',
+            'hold_cutoff', the investor's 'mean_pass_rate' over the firms, and the number of
+            firms whose recommendation is 'buy', 'hold' and 'sell'
+    '''
+    default_thresholds = get_default_thresholds(type(metrics))
+    for test in test_grid:
+        if test not in default_thresholds:
+            raise ValueError(f"{test} is not a test with a threshold, the tests with thresholds are "
+                             f"{list(default_thresholds.keys())}")
+    swept_tests = list(test_grid.keys())
+    grid_values = [np.atleast_1d(np.asarray(test_grid[test], dtype=float)) for test in swept_tests]
+    # Every combination of the swept thresholds, as indices into their lists
+    grid_index = np.indices([len(values) for values in grid_values]).reshape(len(grid_values), -1).T \
+        if grid_values else np.zeros((1, 0), dtype=int)
+    grid_size = len(grid_index)
+    tickers_num = len(metrics.tickers)
+
+    # Each swept test is evaluated once, for all of its thresholds, as a (threshold x ticker) array
+    with np.errstate(all='ignore'), metric_scope(metrics):
+        swept_values = {test: np.broadcast_to(getattr(metrics, get_test_method_name(test))(
+                            threshold=values[:, None]), (len(values), tickers_num))
+                        for test, values in zip(swept_tests, grid_values)}
+        df_list = list()
+        for investor in display_tests.keys():
+            test_values = list()
+            index_columns = list()
+            for test, test_config in display_tests[investor].items():
+                if test in swept_values:
+                    test_values.append(swept_values[test])
+                    index_columns.append(grid_index[:, swept_tests.index(test)])
+                else:
+                    values = np.asarray(run_test(metrics, test, test_config), dtype=bool)
+                    test_values.append(np.broadcast_to(values, (tickers_num,))[None, :])
+                    index_columns.append(np.zeros(grid_size, dtype=int))
+            tests_num = len(test_values)
+            levels_counts = _count_pass_levels(test_values, np.column_stack(index_columns), chunk_size)
+            levels = np.arange(tests_num + 1) / tests_num
+            mean_pass_rates = levels_counts @ levels / max(tickers_num, 1)
+            cutoff_points = _get_cutoff_points(cutoff_grid, investor)
+            buy_cutoffs = np.array([buy for buy, _ in cutoff_points])
+            hold_cutoffs = np.array([hold for _, hold in cutoff_points])
+            # (cutoff point x level) masks, with the precedence of check_investor_thresholds
+            buy_levels = levels[None, :] > buy_cutoffs[:, None]
+            hold_levels = ~buy_levels & (levels[None, :] > hold_cutoffs[:, None])
+            buy_counts = levels_counts @ buy_levels.T
+            hold_counts = levels_counts @ hold_levels.T
+            investor_df = pd.DataFrame({'grid_point': np.repeat(np.arange(grid_size), len(cutoff_points))})
+            for col, test in enumerate(swept_tests):
+                investor_df[f"{test}_threshold"] = np.repeat(grid_values[col][grid_index[:, col]], len(cutoff_points))
+            investor_df['investor'] = investor
+            investor_df['buy_cutoff'] = np.tile(buy_cutoffs, grid_size)
+            investor_df['hold_cutoff'] = np.tile(hold_cutoffs, grid_size)
+            investor_df['mean_pass_rate'] = np.repeat(mean_pass_rates, len(cutoff_points))
+            investor_df['buy'] = buy_counts.ravel()
+            investor_df['hold'] = hold_counts.ravel()
+            investor_df['sell'] = tickers_num - investor_df['buy'] - investor_df['hold']
+            df_list.append(investor_df)
+    logger.info(f"Swept {grid_size} threshold combinations over {tickers_num} firms")
+    return pd.concat(df_list, ignore_index=True)
+
+
+def sweep_market(test_grid: dict, cutoff_grid: dict=None, market: str='us', data_dir: str='data',
+                 variant: str='annual') -> pd.DataFrame:
+    """ sweep_thresholds over the metrics of a whole market """
+    metrics = MarketMetrics(MarketData(market, data_dir, variant=variant))
+    return sweep_thresholds(metrics, test_grid, cutoff_grid)
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+# The statements whose values are flows over a period, and are summed over the trailing four quarters
+flow_statements = ['income', 'cashflow']
+# Numeric columns that identify a record or are point-in-time values, and are never summed
+non_summed_columns = ['SimFinId', 'Fiscal Year', 'Shares (Basic)', 'Shares (Diluted)']
+quarter_numbers = {'Q1': 1, 'Q2': 2, 'Q3': 3, 'Q4': 4}
+
+
+def get_ttm_report(quarterly: pd.DataFrame, report_kind: str) -> pd.DataFrame:
+    '''
+    Derive trailing-twelve-month (TTM) records of a whole market from its quarterly records.
+    For flow statements (income, cashflow) every numeric column is summed over four consecutive
+    quarters, with one vectorized rolling sum over the whole market. Balance sheets keep the
+    values of their quarter.
+    Every firm keeps the records that end at the same fiscal period as its latest record, so
+    its records are a year apart and can be used like annual records: the latest record covers
+    the last twelve months, the one before it the twelve months before those, etc.
+
+    Returns
+    ---------
+        ttm_report (pd.DataFrame): The TTM records, with the columns of the quarterly records.
+            'Fiscal Year' and 'Fiscal Period' are those of the record's last quarter
+    '''
+    quarters = quarterly['Fiscal Period'].map(quarter_numbers)
+    quarterly = quarterly.assign(quarter_idx=quarterly['Fiscal Year'] * 4 + quarters - 1)[quarters.notna()]
+    quarterly = quarterly.sort_values(by=['Ticker', 'quarter_idx'], kind='mergesort').reset_index(drop=True)
+    tickers = quarterly['Ticker'].values
+    quarter_idx = quarterly['quarter_idx'].values
+    if report_kind in flow_statements:
+        columns = [column for column in quarterly.select_dtypes(include='number').columns
+                   if column not in non_summed_columns + ['quarter_idx']]
+        # A window ending at row i is valid if rows i-3..i are four consecutive quarters of one firm
+        valid = np.zeros(len(quarterly), dtype=bool)
+        valid[3:] = (tickers[3:] == tickers[:-3]) & (quarter_idx[3:] - quarter_idx[:-3] == 3)
+        ttm_report = quarterly[valid].copy()
+        if valid.any():
+            values = quarterly[columns].values.astype(float)
+            # Like the annual records, a missing value counts as 0, unless it's missing in all four quarters
+            windows = np.lib.stride_tricks.sliding_window_view(np.nan_to_num(values, nan=0), 4, axis=0)
+            reported = np.lib.stride_tricks.sliding_window_view(~np.isnan(values), 4, axis=0).any(axis=-1)
+            sums = np.where(reported, windows.sum(axis=-1), np.nan)
+            ttm_report[columns] = sums[valid[3:]]
+    else:
+        ttm_report = quarterly
+    # Keep the records that end at the same fiscal period as every firm's latest record
+    latest_quarter = ttm_report.groupby('Ticker')['quarter_idx'].transform('max')
+    ttm_report = ttm_report[(latest_quarter - ttm_report['quarter_idx']) % 4 == 0]
+    return ttm_report.drop(columns='quarter_idx').reset_index(drop=True)
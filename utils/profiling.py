@@ -0,0 +1,53 @@
+import bisect
+import threading
+
+# Upper bounds (in seconds) of the latency histograms' buckets
+latency_buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf')]
+
+
+class Profiler:
+    """
+    Collects structured timing stats: per name, the number of calls, the cumulative and
+    maximal time, the number of rows processed and a latency histogram. Also keeps plain
+    counters, e.g. cache hits and misses.
+    """
+    def __init__(self):
+        self._stats = dict()
+        self._counters = dict()
+        self._lock = threading.Lock()
+
+    def record(self, name: str, elapsed: float, rows: int=0):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = {'calls': 0, 'total_time': 0.0, 'max_time': 0.0, 'rows': 0,
+                         'histogram': [0] * len(latency_buckets)}
+                self._stats[name] = stats
+            stats['calls'] += 1
+            stats['total_time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            stats['rows'] += rows
+            stats['histogram'][bisect.bisect_left(latency_buckets, elapsed)] += 1
+
+    def count(self, name: str, num: int=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + num
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {name: dict(stats, histogram=list(stats['histogram'])) for name, stats in self._stats.items()}
+
+    def get_counters(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
+
+    def get_hit_rate(self, name: str):
+        """ The hit rate of the counters '<name>_hit' and '<name>_miss', None if there were no lookups """
+        counters = self.get_counters()
+        hits = counters.get(f"{name}_hit", 0)
+        lookups = hits + counters.get(f"{name}_miss", 0)
+        return hits / lookups if lookups else None
+
+
+# Collects the stats of code that isn't tied to one Firm, e.g. dataset loads
+global_profiler = Profiler()